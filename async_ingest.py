@@ -0,0 +1,204 @@
+import argparse
+import asyncio
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from urllib.parse import urljoin
+
+import numpy as np
+
+from database import (create_async_pool, CREATE_PARTITIONS_SQL, IMAGE_COLUMNS, STAGING_TABLE_SQL, STORAGE_LAYOUTS,
+                      IMAGE_STORE_DIR, merge_staging_sql, image_row)
+from download_images import (BASE_URL, DOWNLOAD_CHUNK_SIZE, IMAGE_FORMATS, get_cifar_links, get_cifar_url,
+                             download_image_set, iter_batches, sample_images, encode_images, perceptual_hash,
+                             apply_label_names)
+
+# Marks the end of the stream on every queue.
+DONE = object()
+
+
+@dataclass
+class StageStats:
+    name: str
+    items: int = 0
+    busy_seconds: float = 0.0
+    wait_seconds: float = 0.0
+
+    def report(self):
+        rate = self.items / self.busy_seconds if self.busy_seconds > 0 else 0.0
+        return {
+            "stage": self.name,
+            "items": self.items,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "wait_seconds": round(self.wait_seconds, 3),
+            "items_per_sec": round(rate, 1),
+        }
+
+
+async def _get(queue, stats):
+    started = time.perf_counter()
+    item = await queue.get()
+    stats.wait_seconds += time.perf_counter() - started
+    return item
+
+
+async def _put(queue, item, stats):
+    # Time spent blocked on a full queue is backpressure from the next stage.
+    started = time.perf_counter()
+    await queue.put(item)
+    stats.wait_seconds += time.perf_counter() - started
+
+
+async def download_stage(archives, out_queue, stats, connections=1, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    for url, filename in archives:
+        started = time.perf_counter()
+        tar_path = await asyncio.to_thread(download_image_set, url, filename,
+                                           chunk_size=chunk_size, connections=connections)
+        stats.busy_seconds += time.perf_counter() - started
+        stats.items += 1
+        await _put(out_queue, (url, tar_path), stats)
+    await out_queue.put(DONE)
+
+
+async def decode_stage(in_queue, out_queue, stats, pool, max_images=1000, seed=None, chunk_size=500):
+    loop = asyncio.get_running_loop()
+
+    def exclude_hashes(hashes):
+        # Runs in the decode thread; the query itself runs on the event loop.
+        return asyncio.run_coroutine_threadsafe(existing_hashes_async(pool, hashes), loop).result()
+
+    while (item := await _get(in_queue, stats)) is not DONE:
+        url, tar_path = item
+        started = time.perf_counter()
+        label_names = {}
+        selected, _ = await asyncio.to_thread(sample_images, iter_batches(tar_path, label_names=label_names),
+                                              max_images, seed, exclude_hashes)
+        apply_label_names(selected, label_names)
+        stats.busy_seconds += time.perf_counter() - started
+        stats.items += len(selected)
+        for start in range(0, len(selected), chunk_size):
+            await _put(out_queue, (url, selected[start:start + chunk_size]), stats)
+    await out_queue.put(DONE)
+
+
+async def encode_stage(in_queue, out_queue, stats, executor, image_format="PNG", quality=90):
+    loop = asyncio.get_running_loop()
+    while (item := await _get(in_queue, stats)) is not DONE:
+        url, chunk = item
+        started = time.perf_counter()
+        pixels = np.stack([image.pop('pixels') for image in chunk])
+        encoding = loop.run_in_executor(executor, encode_images, pixels, image_format, quality)
+        phashes = perceptual_hash(pixels).tolist()
+        encoded = await encoding
+        stats.busy_seconds += time.perf_counter() - started
+        stats.items += len(chunk)
+        records = [{**image, 'image': image_bytes, 'url': url, 'phash': phash}
+                   for image, image_bytes, phash in zip(chunk, encoded, phashes)]
+        await _put(out_queue, records, stats)
+    await out_queue.put(DONE)
+
+
+async def write_stage(in_queue, stats, pool, storage="inline", store_dir=IMAGE_STORE_DIR):
+    inserted = 0
+    downloaded_at = datetime.utcnow()
+    while (records := await _get(in_queue, stats)) is not DONE:
+        started = time.perf_counter()
+        # Off the event loop: with the file layout building a row writes its payload to disk.
+        rows = await asyncio.to_thread(
+            lambda: [image_row({**record, 'downloaded_at': downloaded_at}, storage, store_dir) for record in records])
+        inserted += await write_rows_async(pool, rows, storage)
+        stats.busy_seconds += time.perf_counter() - started
+        stats.items += len(rows)
+    return inserted
+
+
+async def existing_hashes_async(pool, hashes):
+    if not hashes:
+        return set()
+    async with pool.acquire() as conn:
+        rows = await conn.fetch("SELECT content_hash FROM tb_images WHERE content_hash = ANY($1::bytea[]);",
+                                list(hashes))
+    return {bytes(row[0]) for row in rows}
+
+
+async def write_rows_async(pool, rows, storage="inline"):
+    """Copy one batch into the staging table and merge it, in one transaction. Returns rows inserted."""
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute(STAGING_TABLE_SQL)
+            await conn.copy_records_to_table("tb_images_staging", records=rows, columns=list(IMAGE_COLUMNS))
+            await conn.execute(CREATE_PARTITIONS_SQL)
+            status = await conn.execute(merge_staging_sql(storage))
+    return int(status.split()[-1])
+
+
+async def run_pipeline(archives=None, max_images=1000, seed=None, image_format="PNG", quality=90, workers=1,
+                       storage="inline", chunk_size=500, queue_size=4, connections=1, pool=None):
+    """
+    Ingest archives with download, decode, encode and DB write running as concurrent stages.
+
+    Stages are joined by bounded queues, so a slow stage holds back the ones
+    before it instead of letting work pile up in memory. archives is a list
+    of (url, filename); by default one random CIFAR archive is picked, as in
+    download_and_store_images. Returns the per-stage throughput report.
+    """
+    if archives is None:
+        archives = [await asyncio.to_thread(get_cifar_url)]
+    own_pool = pool is None
+    if own_pool:
+        pool = await create_async_pool(max_size=4)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else ThreadPoolExecutor(max_workers=1)
+
+    stats = [StageStats("download"), StageStats("decode"), StageStats("encode"), StageStats("write")]
+    downloaded, decoded, encoded = (asyncio.Queue(maxsize=queue_size) for _ in range(3))
+    started = time.perf_counter()
+    try:
+        async with asyncio.TaskGroup() as group:
+            group.create_task(download_stage(archives, downloaded, stats[0], connections))
+            group.create_task(decode_stage(downloaded, decoded, stats[1], pool, max_images, seed, chunk_size))
+            group.create_task(encode_stage(decoded, encoded, stats[2], executor, image_format, quality))
+            writer = group.create_task(write_stage(encoded, stats[3], pool, storage))
+    finally:
+        executor.shutdown()
+        if own_pool:
+            await pool.close()
+
+    elapsed = time.perf_counter() - started
+    report = {
+        "inserted": writer.result(),
+        "elapsed_seconds": round(elapsed, 3),
+        "images_per_sec": round(stats[3].items / elapsed, 1) if elapsed > 0 else 0.0,
+        "stages": [stage.report() for stage in stats],
+    }
+    for stage in report["stages"]:
+        print(f"{stage['stage']:<10}{stage['items']:>8} items  busy {stage['busy_seconds']:>8.3f}s  "
+              f"waiting {stage['wait_seconds']:>8.3f}s  {stage['items_per_sec']:>10.1f}/s")
+    print(f"Inserted {report['inserted']} images in {report['elapsed_seconds']}s "
+          f"({report['images_per_sec']} images/sec end to end).")
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest CIFAR archives through the asyncio pipeline.")
+    parser.add_argument("--all-archives", action="store_true", help="ingest every archive listed on cifar.html")
+    parser.add_argument("--max-images", type=int, default=1000, help="number of images to store per archive")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the random sample")
+    parser.add_argument("--format", dest="image_format", choices=IMAGE_FORMATS, default="PNG",
+                        type=str.upper, help="stored image format")
+    parser.add_argument("--quality", type=int, default=90, help="JPEG/WEBP quality")
+    parser.add_argument("--workers", type=int, default=1, help="encoder processes (1 = one encoder thread)")
+    parser.add_argument("--storage", choices=STORAGE_LAYOUTS, default="inline", help="payload layout")
+    parser.add_argument("--chunk-size", type=int, default=500, help="images per encode/write chunk")
+    parser.add_argument("--queue-size", type=int, default=4, help="chunks buffered between stages")
+    parser.add_argument("--connections", type=int, default=1, help="parallel ranged connections per download")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    selected_archives = [(urljoin(BASE_URL, href), href) for href in get_cifar_links()] if args.all_archives else None
+    asyncio.run(run_pipeline(selected_archives, max_images=args.max_images, seed=args.seed,
+                             image_format=args.image_format, quality=args.quality, workers=args.workers,
+                             storage=args.storage, chunk_size=args.chunk_size, queue_size=args.queue_size,
+                             connections=args.connections))
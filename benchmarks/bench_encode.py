@@ -0,0 +1,42 @@
+import io
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from download_images import encode_images, IMAGE_FORMATS
+
+
+def per_row_png(raw_bytes) -> bytes:
+    # The original convert_to_jpeg_bytes: one reshape/transpose and one PIL image per row.
+    np_array = np.frombuffer(raw_bytes, dtype=np.uint8).reshape(3, 32, 32)
+    img = Image.fromarray(np.transpose(np_array, (1, 2, 0)))
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def images_per_sec(fn, count, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started)
+    return count / best
+
+
+def main(count=5000):
+    pixels = np.random.default_rng(0).integers(0, 256, size=(count, 3 * 32 * 32), dtype=np.uint8)
+
+    baseline = images_per_sec(lambda: [per_row_png(row) for row in pixels], count)
+    print(f"{'per-row PNG':<16}{baseline:>12.0f} images/sec")
+    for image_format in IMAGE_FORMATS:
+        rate = images_per_sec(lambda: encode_images(pixels, image_format=image_format), count)
+        print(f"{'batch ' + image_format:<16}{rate:>12.0f} images/sec  ({rate / baseline:.2f}x)")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
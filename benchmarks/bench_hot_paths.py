@@ -0,0 +1,82 @@
+import shutil
+
+import numpy as np
+import pytest
+
+import database
+import download_images
+import get_random_image_from_db
+
+EXTRACT_SIZES = (1_000, 10_000, 50_000)
+INSERT_SIZES = (100, 1_000, 5_000)
+TABLE_SIZES = (1_000, 10_000)
+
+
+def _records(images, count):
+    """Encoded records ready for insert_images_to_db, taken from the synthetic archive."""
+    return list(download_images.extract_images(images, max_images=count, seed=0))
+
+
+def _fill_table(conn, tarball, rows):
+    with conn.cursor() as cur:
+        cur.execute("TRUNCATE tb_images CASCADE;")
+    conn.commit()
+    download_images.insert_images_to_db(_records(tarball, rows), "http://bench", conn=conn)
+    with conn.cursor() as cur:
+        cur.execute("ANALYZE tb_images;")
+    conn.commit()
+
+
+@pytest.mark.benchmark(group="convert_to_jpeg_bytes")
+@pytest.mark.parametrize("image_format", download_images.IMAGE_FORMATS)
+def test_convert_to_jpeg_bytes(benchmark, image_format):
+    raw = np.random.default_rng(0).integers(0, 256, 3072, dtype=np.uint8).tobytes()
+    benchmark(download_images.convert_to_jpeg_bytes, raw, image_format)
+
+
+@pytest.mark.benchmark(group="extract_images")
+@pytest.mark.parametrize("size", EXTRACT_SIZES)
+@pytest.mark.parametrize("cache", ["cold", "warm"])
+def test_extract_images(benchmark, cifar_tarball, size, cache):
+    tarball = cifar_tarball(size)
+
+    def setup():
+        if cache == "cold":
+            shutil.rmtree(download_images.batch_cache_dir(tarball), ignore_errors=True)
+        else:
+            list(download_images.iter_batches(tarball))
+
+    selected = benchmark.pedantic(lambda: list(download_images.extract_images(tarball, max_images=1000, seed=0)),
+                                  setup=setup, rounds=5)
+    assert len(selected) == min(size, 1000)
+
+
+@pytest.mark.benchmark(group="insert_images_to_db")
+@pytest.mark.parametrize("size", INSERT_SIZES)
+def test_insert_images_to_db(benchmark, cifar_tarball, db_conn, size):
+    records = _records(cifar_tarball(size), size)
+
+    def setup():
+        with db_conn.cursor() as cur:
+            cur.execute("TRUNCATE tb_images CASCADE;")
+        db_conn.commit()
+
+    benchmark.pedantic(download_images.insert_images_to_db, args=(records, "http://bench"),
+                       kwargs={"conn": db_conn}, setup=setup, rounds=5)
+
+
+@pytest.mark.benchmark(group="select_image")
+@pytest.mark.parametrize("rows", TABLE_SIZES)
+def test_select_image(benchmark, cifar_tarball, db_conn, rows):
+    _fill_table(db_conn, cifar_tarball(rows), rows)
+    images = benchmark(lambda: list(database.select_image(db_conn)))
+    assert len(images) == 1
+
+
+@pytest.mark.benchmark(group="get_random_image")
+@pytest.mark.parametrize("rows", TABLE_SIZES)
+def test_get_random_image(benchmark, cifar_tarball, db_conn, rows, tmp_path, monkeypatch):
+    _fill_table(db_conn, cifar_tarball(rows), rows)
+    monkeypatch.chdir(tmp_path)
+    benchmark(get_random_image_from_db.get_random_image)
+    assert (tmp_path / "random_image.png").exists()
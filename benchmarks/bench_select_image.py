@@ -0,0 +1,74 @@
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from database import IMAGE_COLUMNS_DDL, get_connection, select_image
+
+SIZES = (10_000, 100_000, 1_000_000)
+
+# Session-local copy of the schema: it shadows the real tb_images and
+# tb_image_blobs for this connection only and disappears when it closes.
+CREATE_TEMP_TABLE = f"""
+    CREATE TEMP TABLE tb_images ({IMAGE_COLUMNS_DDL},
+        PRIMARY KEY (id)
+    );
+    CREATE UNIQUE INDEX ON tb_images (seq);
+    CREATE TEMP TABLE tb_image_blobs (
+        id UUID PRIMARY KEY,
+        image BYTEA NOT NULL
+    );
+"""
+
+FILL_ROWS = """
+    INSERT INTO tb_images (id, title, batch_name, url, image)
+    SELECT md5(g::text)::uuid, 'image_' || g || '.png', 'bench', 'http://bench', decode(repeat('ab', 3000), 'hex')
+    FROM generate_series(%s, %s) AS g;
+    ANALYZE tb_images;
+"""
+
+LEGACY_QUERY = """
+    SELECT id, title, batch_name, url, downloaded_at, image
+    FROM tb_images
+    ORDER BY RANDOM()
+    LIMIT 1;
+"""
+
+
+def latency_ms(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def legacy_select(conn):
+    with conn.cursor() as cur:
+        cur.execute(LEGACY_QUERY)
+        cur.fetchone()
+
+
+def main(repeat=50):
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(CREATE_TEMP_TABLE)
+        rows = 0
+        print(f"{'rows':>10}{'select_image ms':>18}{'ORDER BY RANDOM() ms':>24}")
+        for size in SIZES:
+            with conn.cursor() as cur:
+                cur.execute(FILL_ROWS, (rows + 1, size))
+            conn.commit()
+            rows = size
+            probe = latency_ms(lambda: list(select_image(conn)), repeat)
+            legacy = latency_ms(lambda: legacy_select(conn), max(repeat // 10, 3))
+            print(f"{size:>10}{probe:>18.3f}{legacy:>24.3f}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
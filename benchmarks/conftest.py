@@ -0,0 +1,90 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import database
+from synthetic import write_cifar_tarball
+
+# Directory holding initdb/pg_ctl; defaults to whatever is on PATH.
+PG_BIN_ENV = "PG_BIN"
+
+
+def _pg_tool(name):
+    pg_bin = os.environ.get(PG_BIN_ENV)
+    return os.path.join(pg_bin, name) if pg_bin else shutil.which(name)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope="session")
+def cifar_tarball(tmp_path_factory):
+    """Factory returning the path of a synthetic archive with the given number of images, built once per size."""
+    built = {}
+
+    def build(images, images_per_batch=10000):
+        if images not in built:
+            path = tmp_path_factory.mktemp("archives") / f"cifar-{images}.tar.gz"
+            batches = max(1, -(-images // images_per_batch))
+            built[images] = write_cifar_tarball(path, min(images, images_per_batch), batches)
+        return built[images]
+
+    return build
+
+
+@pytest.fixture(scope="session")
+def postgres():
+    """
+    Throwaway PostgreSQL cluster for the whole session.
+
+    initdb runs in a temporary directory and the server listens on a free
+    port; PG* variables point database.get_connection at it, and the cluster
+    is stopped and deleted at the end. Skips when initdb is not available.
+    """
+    initdb, pg_ctl = _pg_tool("initdb"), _pg_tool("pg_ctl")
+    if not initdb or not pg_ctl or not os.path.exists(initdb):
+        pytest.skip(f"PostgreSQL server binaries not found (set {PG_BIN_ENV})")
+    data_dir = tempfile.mkdtemp(prefix="bench_pg_")
+    port = _free_port()
+    subprocess.run([initdb, "-D", data_dir, "-U", "bench", "-A", "trust", "--no-sync"],
+                   check=True, capture_output=True)
+    subprocess.run([pg_ctl, "-D", data_dir, "-w", "-l", os.path.join(data_dir, "server.log"),
+                    "-o", f"-p {port} -k {data_dir} -c listen_addresses='' -c fsync=off", "start"],
+                   check=True, capture_output=True)
+    environ = {"PGHOST": data_dir, "PGPORT": str(port), "PGDATABASE": "postgres", "PGUSER": "bench",
+               "PGPASSWORD": ""}
+    saved = {name: os.environ.get(name) for name in environ}
+    os.environ.update(environ)
+    database.clear_db_config_cache()
+    try:
+        conn = database.get_connection()
+        database.create_table(conn)
+        conn.close()
+        yield
+    finally:
+        database.close_pool()
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        database.clear_db_config_cache()
+        subprocess.run([pg_ctl, "-D", data_dir, "-m", "immediate", "stop"], capture_output=True)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+@pytest.fixture
+def db_conn(postgres):
+    conn = database.get_connection()
+    yield conn
+    conn.close()
@@ -0,0 +1,59 @@
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(int(len(sorted_values) * fraction), len(sorted_values) - 1)]
+
+
+async def worker(session, base_url, deadline, latencies, statuses, etags, revalidate):
+    while time.perf_counter() < deadline:
+        headers = {}
+        path = "/images/random"
+        if revalidate and etags:
+            # Re-request an image we already hold, as a browser cache would.
+            location, etag = etags[len(latencies) % len(etags)]
+            path, headers = location, {"If-None-Match": etag}
+        started = time.perf_counter()
+        async with session.get(base_url + path, headers=headers) as response:
+            await response.read()
+            if response.status == 200 and "Content-Location" in response.headers:
+                etags.append((response.headers["Content-Location"], response.headers["ETag"]))
+        latencies.append((time.perf_counter() - started) * 1000)
+        statuses[response.status] = statuses.get(response.status, 0) + 1
+
+
+async def run(base_url, concurrency, duration, revalidate):
+    latencies, statuses, etags = [], {}, []
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        deadline = time.perf_counter() + duration
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session, base_url, deadline, latencies, statuses, etags, revalidate)
+                               for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(f"{len(latencies)} requests in {elapsed:.1f}s with {concurrency} clients: "
+          f"{len(latencies) / elapsed:.1f} req/s")
+    print(f"p50 {percentile(latencies, 0.50):.2f} ms  p99 {percentile(latencies, 0.99):.2f} ms  "
+          f"statuses {dict(sorted(statuses.items()))}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test serve_images.py.")
+    parser.add_argument("--url", default="http://localhost:8080")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+    parser.add_argument("--revalidate", action="store_true",
+                        help="re-request seen images with If-None-Match to measure 304 responses")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    asyncio.run(run(args.url.rstrip("/"), args.concurrency, args.duration, args.revalidate))
@@ -0,0 +1,39 @@
+import io
+import pickle
+import tarfile
+
+import numpy as np
+
+LABEL_NAMES = [b"airplane", b"automobile", b"bird", b"cat", b"deer", b"dog", b"frog", b"horse", b"ship", b"truck"]
+
+
+def _add_member(tar, name, payload):
+    info = tarfile.TarInfo(name=name)
+    info.size = len(payload)
+    tar.addfile(info, io.BytesIO(payload))
+
+
+def write_cifar_tarball(path, images_per_batch=1000, batches=1, seed=0):
+    """
+    Write a CIFAR-10 (python version) style .tar.gz with random pixels.
+
+    Members and pickle keys match the real archive (data_batch_N, batches.meta,
+    data/filenames/labels/batch_label), so every reader in download_images
+    treats it like the download. The same seed always gives the same bytes.
+    """
+    rng = np.random.default_rng(seed)
+    with tarfile.open(path, "w:gz") as tar:
+        _add_member(tar, "cifar-10-batches-py/batches.meta", pickle.dumps({
+            b"label_names": LABEL_NAMES,
+            b"num_cases_per_batch": images_per_batch,
+            b"num_vis": 3072,
+        }))
+        for batch in range(1, batches + 1):
+            offset = (batch - 1) * images_per_batch
+            _add_member(tar, f"cifar-10-batches-py/data_batch_{batch}", pickle.dumps({
+                b"batch_label": f"training batch {batch} of {batches}".encode(),
+                b"labels": rng.integers(0, len(LABEL_NAMES), images_per_batch).tolist(),
+                b"data": rng.integers(0, 256, (images_per_batch, 3072), dtype=np.uint8),
+                b"filenames": [f"synthetic_{offset + i}.png".encode() for i in range(images_per_batch)],
+            }))
+    return str(path)
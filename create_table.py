@@ -1,16 +1,39 @@
+import argparse
+
 from database import get_connection
-from database import create_table
+from database import create_table, drop_batch
 
 
-def create_images_table():
+def create_images_table(partitioned=False):
     conn = get_connection()
     try:
-        create_table(conn)
+        create_table(conn, partitioned=partitioned)
     except Exception as e:
         print(f"Error creating table: {e}")
     finally:
         conn.close()
 
 
+def drop_image_batch(batch_name):
+    conn = get_connection()
+    try:
+        drop_batch(conn, batch_name)
+    except Exception as e:
+        print(f"Error dropping batch: {e}")
+    finally:
+        conn.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Create tb_images, or drop one batch from it.")
+    parser.add_argument("--partitioned", action="store_true", help="partition a new table by batch_name")
+    parser.add_argument("--drop-batch", metavar="BATCH_NAME", help="remove every image of this batch")
+    return parser.parse_args(argv)
+
+
 if __name__ == '__main__':
-    create_images_table()
+    args = parse_args()
+    if args.drop_batch:
+        drop_image_batch(args.drop_batch)
+    else:
+        create_images_table(partitioned=args.partitioned)
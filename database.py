@@ -1,7 +1,53 @@
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+import hashlib
+import io
 import json
+import os
+import random
+import struct
+import threading
+import time
 import uuid
-from image_structure import ImageStructure
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from image_structure import FrozenImageStructure, ImageBatch, ImageStructure
+from metrics import metrics
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+IMAGE_COLUMNS = ("id", "title", "batch_name", "url", "downloaded_at", "image", "content_hash", "image_path", "phash",
+                 "label", "label_name", "coarse_label", "coarse_label_name")
+# Where image payloads live: inline in tb_images, in tb_image_blobs, or as files under IMAGE_STORE_DIR.
+STORAGE_LAYOUTS = ("inline", "blob", "file")
+# Class columns select_stratified can sample by; each has a (column, seq) index.
+STRATIFY_COLUMNS = ("label_name", "coarse_label_name")
+IMAGE_STORE_DIR = os.environ.get("IMAGE_STORE_DIR", "image_store")
+COPY_BINARY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+PG_EPOCH = datetime(2000, 1, 1)
+DB_CONFIG_PATH = "db_config.json"
+# Environment variables that override keys of db_config.json.
+DB_CONFIG_ENV = {
+    "PGHOST": "host",
+    "PGPORT": "port",
+    "PGDATABASE": "dbname",
+    "PGUSER": "user",
+    "PGPASSWORD": "password",
+}
+
+_config_cache = {}
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+_pool_stats = {}
+
+# Let psycopg2 send uuid.UUID ids as UUID parameters.
+psycopg2.extras.register_uuid()
 
 
 def load_db_config(path="db_config.json"):
@@ -9,69 +55,925 @@ def load_db_config(path="db_config.json"):
         return json.load(f)
 
 
+async def create_async_pool(max_size=10):
+    """Create an asyncpg pool from the same settings as get_connection (asyncpg is optional)."""
+    if asyncpg is None:
+        raise RuntimeError("asyncpg is required for async database access (pip install asyncpg)")
+    config = get_db_config()
+    return await asyncpg.create_pool(
+        host=config.get("host"),
+        port=config.get("port"),
+        user=config.get("user"),
+        password=config.get("password"),
+        database=config.get("dbname"),
+        min_size=1,
+        max_size=max_size,
+    )
+
+
+def get_db_config(path=DB_CONFIG_PATH):
+    """Return the connection settings, read once per process and overlaid with PG* environment variables."""
+    if path not in _config_cache:
+        config = load_db_config(path)
+        for env_name, key in DB_CONFIG_ENV.items():
+            if os.environ.get(env_name):
+                config[key] = os.environ[env_name]
+        _config_cache[path] = config
+    return dict(_config_cache[path])
+
+
+def clear_db_config_cache():
+    _config_cache.clear()
+
+
 def get_connection():
-    config = load_db_config("db_config.json")
+    config = get_db_config()
     return psycopg2.connect(**config)
 
 
+def _reset_pool_stats(minconn, maxconn):
+    _pool_stats.clear()
+    _pool_stats.update({
+        "min_size": minconn,
+        "max_size": maxconn,
+        "in_use": 0,
+        "checkouts": 0,
+        "timeouts": 0,
+        "wait_seconds_total": 0.0,
+        "wait_seconds_max": 0.0,
+        "checkout_seconds_total": 0.0,
+        "checkout_seconds_max": 0.0,
+    })
+
+
+def get_pool(minconn=None, maxconn=None):
+    """
+    Return the process-wide ThreadedConnectionPool, creating it on first use.
+
+    Sizes default to DB_POOL_MIN_SIZE / DB_POOL_MAX_SIZE (1 and 10).
+    """
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is None:
+            minconn = minconn if minconn is not None else int(os.environ.get("DB_POOL_MIN_SIZE", 1))
+            maxconn = maxconn if maxconn is not None else int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+            _pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, **get_db_config())
+            _pool_slots = threading.BoundedSemaphore(maxconn)
+            _reset_pool_stats(minconn, maxconn)
+        return _pool
+
+
+def close_pool():
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+        _pool = None
+        _pool_slots = None
+
+
+@contextmanager
+def pooled_connection(timeout=None):
+    """
+    Check a connection out of the pool for the duration of a with block.
+
+    Waits up to timeout seconds (forever if None) when every connection is in
+    use, then raises PoolError. Any open transaction is rolled back before the
+    connection goes back to the pool; if the rollback fails the connection is
+    closed instead of reused, and its slot is always released.
+    """
+    pool = get_pool()
+    slots = _pool_slots
+    started = time.perf_counter()
+    if not slots.acquire(timeout=timeout):
+        with _pool_lock:
+            _pool_stats["timeouts"] += 1
+        raise psycopg2.pool.PoolError(f"No pooled connection available after {timeout}s")
+    waited = time.perf_counter() - started
+    try:
+        conn = pool.getconn()
+    except Exception:
+        slots.release()
+        raise
+    checkout = time.perf_counter() - started
+    with _pool_lock:
+        _pool_stats["in_use"] += 1
+        _pool_stats["checkouts"] += 1
+        _pool_stats["wait_seconds_total"] += waited
+        _pool_stats["wait_seconds_max"] = max(_pool_stats["wait_seconds_max"], waited)
+        _pool_stats["checkout_seconds_total"] += checkout
+        _pool_stats["checkout_seconds_max"] = max(_pool_stats["checkout_seconds_max"], checkout)
+
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        try:
+            if not broken and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            # E.g. the server dropped an idle-in-transaction session: the socket is dead.
+            broken = True
+        finally:
+            try:
+                pool.putconn(conn, close=broken)
+            finally:
+                slots.release()
+                with _pool_lock:
+                    _pool_stats["in_use"] -= 1
+
+
+def pool_stats():
+    """Snapshot of pool size, usage, wait-time and checkout-latency counters."""
+    with _pool_lock:
+        stats = dict(_pool_stats)
+    if stats.get("checkouts"):
+        stats["checkout_seconds_avg"] = stats["checkout_seconds_total"] / stats["checkouts"]
+        stats["wait_seconds_avg"] = stats["wait_seconds_total"] / stats["checkouts"]
+    return stats
+
+
 def insert_image_record(conn, image_record):
-    insert_image_qeury = """
-            INSERT INTO tb_images (id, title, batch_name, url, downloaded_at, image)
-            VALUES (%s, %s, %s, %s, %s, %s)
+    insert_image_qeury = f"""
+            INSERT INTO tb_images ({", ".join(IMAGE_COLUMNS)})
+            VALUES ({", ".join(["%s"] * len(IMAGE_COLUMNS))})
+            ON CONFLICT DO NOTHING
         """
-    with conn.cursor() as cur:
-        cur.execute(insert_image_qeury, (
-            str(uuid.uuid4()),
-            image_record['title'],
-            image_record['batch_name'],
-            image_record['url'],
-            image_record['downloaded_at'],
-            psycopg2.Binary(image_record['image'])
-        ))
+    with metrics.timer("db_insert_row", items=1), conn.cursor() as cur:
+        cur.execute(insert_image_qeury, _binary_row(image_row(image_record)))
         conn.commit()
 
 
-def select_image(conn):
-    select_image_query = """
-            SELECT id, title, batch_name, url, downloaded_at, image
-            FROM tb_images
-            ORDER BY RANDOM()
+def write_payload_file(payload, store_dir=IMAGE_STORE_DIR):
+    """Store a payload under its BLAKE2b digest (store_dir/ab/cd/<digest>) and return the absolute path."""
+    digest = hashlib.blake2b(payload, digest_size=16).hexdigest()
+    path = os.path.abspath(os.path.join(store_dir, digest[:2], digest[2:4], digest))
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+    return path
+
+
+def read_payload_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def load_image_payload(conn, image_id):
+    """Fetch the payload of one image from whichever layout it was stored in."""
+    with metrics.timer("load_payload"), conn.cursor() as cur:
+        cur.execute("""
+            SELECT COALESCE(t.image, b.image), t.image_path
+            FROM tb_images t
+            LEFT JOIN tb_image_blobs b ON b.id = t.id
+            WHERE t.id = %s;
+        """, (image_id,))
+        row = cur.fetchone()
+    if row is None:
+        return None
+    image, image_path = row
+    if image is None and image_path:
+        return read_payload_file(image_path)
+    return image
+
+
+def existing_hashes(conn, hashes):
+    """Return the subset of content hashes that are already stored, in one query."""
+    hashes = list(hashes)
+    if not hashes:
+        return set()
+    with metrics.timer("dedup_lookup", items=len(hashes)), conn.cursor() as cur:
+        cur.execute(
+            "SELECT content_hash FROM tb_images WHERE content_hash = ANY(%s);",
+            ([psycopg2.Binary(h) for h in hashes],)
+        )
+        return {bytes(row[0]) for row in cur.fetchall()}
+
+
+def _encode_copy_value(value):
+    if value is None:
+        return struct.pack("!i", -1)
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        delta = value - PG_EPOCH
+        micros = (delta.days * 86400 + delta.seconds) * 1_000_000 + delta.microseconds
+        return struct.pack("!iq", 8, micros)
+    if isinstance(value, int) and not isinstance(value, bool):
+        return struct.pack("!iq", 8, value)
+    if isinstance(value, uuid.UUID):
+        value = value.bytes
+    elif isinstance(value, str):
+        value = value.encode("utf-8")
+    value = bytes(value)
+    return struct.pack("!i", len(value)) + value
+
+
+def build_copy_buffer(rows):
+    """Serialise rows into a PostgreSQL binary COPY stream (UUID, TEXT, TIMESTAMP, BIGINT and BYTEA columns)."""
+    buffer = io.BytesIO()
+    buffer.write(COPY_BINARY_SIGNATURE)
+    buffer.write(struct.pack("!ii", 0, 0))
+    for row in rows:
+        buffer.write(struct.pack("!h", len(row)))
+        for value in row:
+            buffer.write(_encode_copy_value(value))
+    buffer.write(struct.pack("!h", -1))
+    buffer.seek(0)
+    return buffer
+
+
+def image_row(image_record, storage="inline", store_dir=IMAGE_STORE_DIR):
+    """
+    Turn an image record dict into a tuple in IMAGE_COLUMNS order, with a new UUID id.
+
+    With storage="file" the payload is written to store_dir here (blocking
+    file I/O) and only its path goes into the row.
+    """
+    image = image_record['image']
+    image_path = None
+    if storage == "file":
+        image_path = write_payload_file(image, store_dir)
+        image = None
+    return (
+        uuid.uuid4(),
+        image_record['title'],
+        image_record['batch_name'],
+        image_record['url'],
+        image_record['downloaded_at'],
+        image,
+        image_record.get('content_hash'),
+        image_path,
+        image_record.get('phash'),
+        image_record.get('label'),
+        image_record.get('label_name'),
+        image_record.get('coarse_label'),
+        image_record.get('coarse_label_name')
+    )
+
+
+def _binary_row(row):
+    return tuple(psycopg2.Binary(value) if isinstance(value, (bytes, memoryview)) else value for value in row)
+
+
+STAGING_TABLE_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS tb_images_staging (
+        id UUID,
+        title TEXT,
+        batch_name TEXT,
+        url TEXT,
+        downloaded_at TIMESTAMP,
+        image BYTEA,
+        content_hash BYTEA,
+        image_path TEXT,
+        phash BIGINT,
+        -- BIGINT because binary COPY sends every int as int8; the merge narrows it to SMALLINT.
+        label BIGINT,
+        label_name TEXT,
+        coarse_label BIGINT,
+        coarse_label_name TEXT
+    ) ON COMMIT DELETE ROWS;
+"""
+
+
+# When tb_images is partitioned, adds the LIST partition for every batch_name
+# in the staging table that does not have one yet. A no-op otherwise.
+CREATE_PARTITIONS_SQL = """
+    DO $partitions$
+    DECLARE
+        staged_batch TEXT;
+    BEGIN
+        IF (SELECT relkind FROM pg_class WHERE oid = to_regclass('tb_images')) = 'p' THEN
+            FOR staged_batch IN SELECT DISTINCT batch_name FROM tb_images_staging LOOP
+                EXECUTE format(
+                    'CREATE TABLE IF NOT EXISTS %I PARTITION OF tb_images FOR VALUES IN (%L)',
+                    'tb_images_' || left(regexp_replace(lower(staged_batch), '[^a-z0-9_]+', '_', 'g'), 40)
+                        || '_' || left(md5(staged_batch), 8),
+                    staged_batch
+                );
+            END LOOP;
+        END IF;
+    END
+    $partitions$;
+"""
+
+
+def merge_staging_sql(storage="inline"):
+    """
+    Statement moving tb_images_staging into tb_images, skipping stored content hashes.
+
+    With the blob layout the payloads of the rows actually inserted go to
+    tb_image_blobs in the same statement.
+    """
+    columns = ", ".join(IMAGE_COLUMNS)
+    staged = ", ".join("NULL" if storage == "blob" and column == "image" else f"s.{column}"
+                       for column in IMAGE_COLUMNS)
+    merge = f"""
+        INSERT INTO tb_images ({columns})
+        SELECT {staged} FROM tb_images_staging s
+        WHERE s.content_hash IS NULL
+           OR NOT EXISTS (SELECT 1 FROM tb_images t WHERE t.content_hash = s.content_hash)
+        ON CONFLICT DO NOTHING
+    """
+    if storage == "blob":
+        return f"""
+            WITH inserted AS ({merge} RETURNING id)
+            INSERT INTO tb_image_blobs (id, image)
+            SELECT s.id, s.image FROM tb_images_staging s JOIN inserted i ON i.id = s.id;
+        """
+    return merge + ";"
+
+
+def _write_rows(cur, rows, use_copy, storage="inline"):
+    """
+    Write one batch, skipping images whose content_hash is already stored. Returns rows inserted.
+
+    The batch is loaded into a session-local staging table (COPY cannot resolve
+    conflicts) and merged from there with merge_staging_sql, after creating
+    any partitions the batch needs.
+    """
+    columns = ", ".join(IMAGE_COLUMNS)
+    cur.execute(STAGING_TABLE_SQL)
+    if use_copy:
+        cur.copy_expert(
+            f"COPY tb_images_staging ({columns}) FROM STDIN WITH (FORMAT binary)",
+            build_copy_buffer(rows)
+        )
+    else:
+        psycopg2.extras.execute_values(
+            cur,
+            f"INSERT INTO tb_images_staging ({columns}) VALUES %s",
+            [_binary_row(row) for row in rows],
+            page_size=len(rows)
+        )
+    cur.execute(CREATE_PARTITIONS_SQL)
+    cur.execute(merge_staging_sql(storage))
+    return max(cur.rowcount, 0)
+
+
+def insert_images_bulk(conn, image_records, batch_size=1000, use_copy=True, storage="inline",
+                       store_dir=IMAGE_STORE_DIR, checkpoint=None):
+    """
+    Insert image records in batches, committing once per batch.
+
+    Uses binary COPY by default and falls back to execute_values pages when
+    use_copy is False. Accepts any iterable, so records can be streamed in.
+    Records whose content_hash is already stored are skipped. storage picks
+    the payload layout (see STORAGE_LAYOUTS). checkpoint, if given, is called
+    as checkpoint(cur, records) with each batch's records just before its
+    commit, so progress written through cur (see advance_manifest) commits
+    atomically with the rows. Returns the number of rows inserted.
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    if storage not in STORAGE_LAYOUTS:
+        raise ValueError(f"Unknown storage layout: {storage}")
+
+    inserted = 0
+    received = 0
+    started = time.perf_counter()
+    with conn.cursor() as cur:
+        def flush(rows, records):
+            with metrics.timer("db_write", items=len(rows)):
+                written = _write_rows(cur, rows, use_copy, storage)
+            if checkpoint is not None:
+                checkpoint(cur, records)
+            with metrics.timer("db_commit"):
+                conn.commit()
+            return written
+
+        rows, records = [], []
+        for image_record in image_records:
+            rows.append(image_row(image_record, storage, store_dir))
+            records.append(image_record)
+            if len(rows) >= batch_size:
+                inserted += flush(rows, records)
+                received += len(rows)
+                rows, records = [], []
+        if rows:
+            inserted += flush(rows, records)
+            received += len(rows)
+
+    elapsed = time.perf_counter() - started
+    rate = received / elapsed if elapsed > 0 else 0.0
+    print(f"Inserted {inserted} images in {elapsed:.2f}s ({rate:.0f} rows/sec), "
+          f"{received - inserted} duplicates skipped.")
+    metrics.count("images_inserted", inserted)
+    metrics.count("duplicates_skipped", received - inserted)
+    return inserted
+
+
+def _payload_sql(lazy):
+    """Payload columns and join for a query over tb_images aliased as t."""
+    if lazy:
+        return "NULL::bytea AS image, t.image_path", ""
+    return "COALESCE(t.image, b.image) AS image, t.image_path", "LEFT JOIN tb_image_blobs b ON b.id = t.id"
+
+
+def select_image(conn, lazy=False):
+    """
+    Yield one random image in constant time.
+
+    Probes the seq index at a random point between min(seq) and max(seq) and
+    takes the first row at or after it, so no scan or sort is needed. Gaps left
+    by deleted rows fall through to the next existing row. With lazy=True only
+    metadata is read; the payload is fetched by ImageStructure.load_image().
+    """
+    payload, payload_join = _payload_sql(lazy)
+    select_image_query = f"""
+            SELECT t.id, t.title, t.batch_name, t.url, t.downloaded_at, {payload}, t.label_name
+            FROM tb_images t
+            {payload_join}
+            WHERE t.seq >= (
+                SELECT min(seq) + floor(random() * (max(seq) - min(seq) + 1))::bigint
+                FROM tb_images
+            )
+            ORDER BY t.seq
             LIMIT 1;
         """
     with conn.cursor() as cur:
-        cur.execute(select_image_query)
-        row = cur.fetchone()
+        with metrics.timer("select_image"):
+            cur.execute(select_image_query)
+            row = cur.fetchone()
         if row:
-            yield ImageStructure(
-                id=row[0],
-                title=row[1],
-                batch_name=row[2],
-                url=row[3],
-                downloaded_at=row[4],
-                image=row[5]
+            yield image_from_row(row, conn, lazy)
+
+
+def select_images_sql(lazy=False):
+    """
+    Random-sample query behind select_images, with %(n)s, %(probes)s and %(batch_name)s parameters.
+
+    Probes the seq index at random keys and, only when the probes come up
+    short (gaps, or a selective batch_name), tops up with a random scan of the
+    remaining rows. Payloads are joined in only for the chosen rows.
+    """
+    payload, payload_join = _payload_sql(lazy)
+    return f"""
+            WITH bounds AS (
+                SELECT min(seq) AS lo, max(seq) AS hi FROM tb_images
+            ),
+            probes AS (
+                SELECT DISTINCT lo + floor(random() * (hi - lo + 1))::bigint AS seq
+                FROM bounds, generate_series(1, %(probes)s)
+            ),
+            picked AS (
+                SELECT t.seq
+                FROM tb_images t
+                JOIN probes p ON t.seq = p.seq
+                WHERE %(batch_name)s::text IS NULL OR t.batch_name = %(batch_name)s
+                ORDER BY random()
+                LIMIT %(n)s
+            ),
+            chosen AS (
+                SELECT seq FROM picked
+                UNION ALL
+                (
+                    SELECT seq
+                    FROM tb_images
+                    WHERE (%(batch_name)s::text IS NULL OR batch_name = %(batch_name)s)
+                      AND seq NOT IN (SELECT seq FROM picked)
+                    ORDER BY random()
+                    LIMIT %(n)s - (SELECT count(*) FROM picked)
+                )
+            )
+            SELECT t.id, t.title, t.batch_name, t.url, t.downloaded_at, {payload}, t.label_name
+            FROM chosen c
+            JOIN tb_images t ON t.seq = c.seq
+            {payload_join};
+    """
+
+
+def _set_seed(conn, seed):
+    """Seed the session's random() so the next sampling query is repeatable; a no-op for seed=None."""
+    if seed is not None:
+        with conn.cursor() as cur:
+            cur.execute("SELECT setseed(%s);", (random.Random(seed).uniform(-1, 1),))
+
+
+def _select_image_rows(conn, n, batch_name=None, seed=None, itersize=500, lazy=False):
+    if n <= 0:
+        return
+    select_images_query = select_images_sql(lazy)
+    _set_seed(conn, seed)
+
+    with conn.cursor(name=f"select_images_{uuid.uuid4().hex}") as cur:
+        cur.itersize = itersize
+        cur.execute(select_images_query, {
+            "n": n,
+            "probes": max(2 * n, n + 32),
+            "batch_name": batch_name
+        })
+        yield from cur
+
+
+def select_images(conn, n, batch_name=None, seed=None, itersize=500, lazy=False, frozen=False):
+    """
+    Yield up to n distinct random images, optionally restricted to one batch.
+
+    Runs select_images_sql as a single statement; with lazy=True no payloads
+    are read. Rows stream through a server-side cursor, itersize at a time.
+    Passing a seed makes the sample repeatable for the same table contents.
+    frozen=True yields FrozenImageStructure records.
+    """
+    for row in _select_image_rows(conn, n, batch_name, seed, itersize, lazy):
+        yield image_from_row(row, conn, lazy, frozen)
+
+
+def select_image_batch(conn, n, batch_name=None, seed=None, itersize=500):
+    """Like select_images, but returns one columnar ImageBatch with every payload packed into a single buffer."""
+    return ImageBatch.from_rows(
+        row if row[5] is not None or not row[6] else row[:5] + (read_payload_file(row[6]),)
+        for row in _select_image_rows(conn, n, batch_name, seed, itersize)
+    )
+
+
+def select_stratified_sql(by="label_name", lazy=False):
+    """
+    Class-stratified sampling query behind select_stratified, with %(k)s, %(probes)s and %(labels)s parameters.
+
+    The distinct classes are found with a recursive skip scan of the
+    (class, seq) index, one index probe per class instead of a scan of the
+    table. Each class is then sampled like select_images_sql: random seq keys
+    between the class's first and last seq, each resolved to the next row of
+    that class through the same index. Classes the probes leave short are
+    topped up with a random scan of just that class. Rows come back ordered
+    by class, with the class as the last column.
+    """
+    if by not in STRATIFY_COLUMNS:
+        raise ValueError(f"by must be one of {STRATIFY_COLUMNS}, not {by!r}")
+    payload, payload_join = _payload_sql(lazy)
+    return f"""
+            WITH RECURSIVE classes AS (
+                (SELECT {by} AS class FROM tb_images WHERE {by} IS NOT NULL ORDER BY {by} LIMIT 1)
+                UNION ALL
+                SELECT (SELECT t.{by} FROM tb_images t WHERE t.{by} > c.class ORDER BY t.{by} LIMIT 1)
+                FROM classes c
+                WHERE c.class IS NOT NULL
+            ),
+            wanted AS (
+                SELECT class FROM classes
+                WHERE class IS NOT NULL
+                  AND (%(labels)s::text[] IS NULL OR class = ANY(%(labels)s::text[]))
+            ),
+            bounds AS (
+                SELECT w.class, lo.seq AS lo, hi.seq AS hi
+                FROM wanted w
+                CROSS JOIN LATERAL (
+                    SELECT t.seq FROM tb_images t WHERE t.{by} = w.class ORDER BY t.seq LIMIT 1
+                ) lo
+                CROSS JOIN LATERAL (
+                    SELECT t.seq FROM tb_images t WHERE t.{by} = w.class ORDER BY t.seq DESC LIMIT 1
+                ) hi
+            ),
+            probes AS (
+                SELECT b.class, b.lo + floor(random() * (b.hi - b.lo + 1))::bigint AS target
+                FROM bounds b, generate_series(1, %(probes)s)
+            ),
+            hits AS (
+                SELECT DISTINCT p.class, h.seq
+                FROM probes p
+                CROSS JOIN LATERAL (
+                    SELECT t.seq FROM tb_images t
+                    WHERE t.{by} = p.class AND t.seq >= p.target
+                    ORDER BY t.seq
+                    LIMIT 1
+                ) h
+            ),
+            picked AS (
+                SELECT class, seq
+                FROM (
+                    SELECT class, seq, row_number() OVER (PARTITION BY class ORDER BY random()) AS rn
+                    FROM hits
+                ) ranked
+                WHERE rn <= %(k)s
+            ),
+            short AS (
+                SELECT w.class, %(k)s - count(p.seq) AS missing
+                FROM wanted w
+                LEFT JOIN picked p ON p.class = w.class
+                GROUP BY w.class
+                HAVING count(p.seq) < %(k)s
+            ),
+            chosen AS (
+                SELECT class, seq FROM picked
+                UNION ALL
+                SELECT s.class, extra.seq
+                FROM short s
+                CROSS JOIN LATERAL (
+                    SELECT t.seq FROM tb_images t
+                    WHERE t.{by} = s.class
+                      AND t.seq NOT IN (SELECT seq FROM picked WHERE class = s.class)
+                    ORDER BY random()
+                    LIMIT s.missing
+                ) extra
             )
+            SELECT t.id, t.title, t.batch_name, t.url, t.downloaded_at, {payload}, t.label_name, c.class
+            FROM chosen c
+            JOIN tb_images t ON t.seq = c.seq
+            {payload_join}
+            ORDER BY c.class;
+    """
+
+
+def select_stratified(conn, k, labels=None, by="label_name", seed=None, lazy=False):
+    """
+    Sample up to k random images from every class, as {class name: [ImageStructure]}.
+
+    by picks the class column (label_name, or coarse_label_name for the
+    CIFAR-100 superclasses); labels restricts the sample to those classes.
+    Classes with fewer than k images return all of them; images stored
+    without labels are never sampled. Seeds and lazy payloads work as in
+    select_images.
+    """
+    query = select_stratified_sql(by, lazy)
+    samples = {}
+    if k <= 0:
+        return samples
+    _set_seed(conn, seed)
+    with metrics.timer("select_stratified"), conn.cursor() as cur:
+        cur.execute(query, {
+            "k": k,
+            "probes": max(2 * k, k + 8),
+            "labels": list(labels) if labels is not None else None
+        })
+        rows = cur.fetchall()
+    for row in rows:
+        samples.setdefault(row[8], []).append(image_from_row(row, conn, lazy))
+    return samples
+
+
+def image_from_row(row, conn=None, lazy=False, frozen=False):
+    """
+    Build an ImageStructure (or FrozenImageStructure) from a select row.
+
+    Rows are (id, title, batch_name, url, downloaded_at, image, image_path),
+    optionally followed by label_name. A file-layout payload is read from disk here unless lazy, in which case
+    the record gets a loader instead (through conn for the blob layout).
+    """
+    image_id, image, image_path = row[0], row[5], row[6]
+    loader = None
+    if lazy:
+        if image_path:
+            loader = lambda: read_payload_file(image_path)
+        else:
+            loader = lambda: load_image_payload(conn, image_id)
+    elif image is None and image_path:
+        image = read_payload_file(image_path)
+    record_type = FrozenImageStructure if frozen else ImageStructure
+    return record_type(
+        id=str(image_id),
+        title=row[1],
+        batch_name=row[2],
+        url=row[3],
+        downloaded_at=row[4],
+        image=image,
+        label_name=row[7] if len(row) > 7 else None,
+        loader=loader
+    )
 
 
-def create_table(conn):
-    create_table_query = """
-        CREATE TABLE IF NOT EXISTS tb_images (
-            id TEXT PRIMARY KEY,
+IMAGE_COLUMNS_DDL = """
+            id UUID NOT NULL,
+            seq BIGSERIAL NOT NULL,
             title TEXT NOT NULL,
             batch_name TEXT NOT NULL,
             url TEXT NOT NULL,
             downloaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            image BYTEA,
+            content_hash BYTEA,
+            image_path TEXT,
+            phash BIGINT,
+            label SMALLINT,
+            label_name TEXT,
+            coarse_label SMALLINT,
+            coarse_label_name TEXT"""
+
+LABEL_INDEXES_SQL = "\n        ".join(
+    f"CREATE INDEX IF NOT EXISTS tb_images_{column}_seq_idx ON tb_images ({column}, seq);"
+    for column in STRATIFY_COLUMNS
+)
+
+# One row per batch member of each ingested archive: the member's sampled row
+# positions in insertion order, and how many of them are committed to tb_images.
+INGEST_MANIFEST_DDL = """
+        CREATE TABLE IF NOT EXISTS tb_ingest_manifest (
+            archive TEXT NOT NULL,
+            member TEXT NOT NULL,
+            ordinal INTEGER NOT NULL,
+            url TEXT NOT NULL,
+            positions INTEGER[] NOT NULL,
+            committed INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP NOT NULL DEFAULT now(),
+            PRIMARY KEY (archive, member)
+        );
+"""
+
+# Tables created before ids were UUIDs get their id columns converted in place.
+MIGRATE_ID_TO_UUID_SQL = """
+        DO $migrate$
+        BEGIN
+            IF (SELECT atttypid FROM pg_attribute
+                WHERE attrelid = to_regclass('tb_images') AND attname = 'id') = 'text'::regtype THEN
+                IF to_regclass('tb_image_blobs') IS NOT NULL THEN
+                    ALTER TABLE tb_image_blobs DROP CONSTRAINT IF EXISTS tb_image_blobs_id_fkey;
+                    ALTER TABLE tb_image_blobs ALTER COLUMN id TYPE UUID USING id::uuid;
+                END IF;
+                ALTER TABLE tb_images ALTER COLUMN id TYPE UUID USING id::uuid;
+                IF to_regclass('tb_image_blobs') IS NOT NULL THEN
+                    ALTER TABLE tb_image_blobs ADD CONSTRAINT tb_image_blobs_id_fkey
+                        FOREIGN KEY (id) REFERENCES tb_images (id) ON DELETE CASCADE;
+                END IF;
+            END IF;
+        END
+        $migrate$;
+"""
+
+
+def create_table(conn, partitioned=False):
+    """
+    Create tb_images, tb_image_blobs and tb_ingest_manifest, or bring an existing tb_images up to date.
+
+    batch_name gets a B-tree index and downloaded_at a BRIN index, which stays
+    tiny because rows arrive in downloaded_at order. With partitioned=True a
+    new tb_images is LIST-partitioned by batch_name, with one partition per
+    batch created on first insert, so drop_batch can detach a whole batch.
+    Unique keys of a partitioned table must include batch_name, so there
+    content_hash is only enforced unique per batch by the index (the insert
+    pre-filter still skips hashes stored in any batch), and tb_image_blobs
+    has no foreign key. An existing table keeps its layout, so pass the
+    partitioned value it was created with.
+    """
+    if partitioned:
+        table_query = f"""
+        CREATE TABLE IF NOT EXISTS tb_images ({IMAGE_COLUMNS_DDL},
+            PRIMARY KEY (id, batch_name)
+        ) PARTITION BY LIST (batch_name);
+        ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS phash BIGINT;
+        ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS label SMALLINT;
+        ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS label_name TEXT;
+        ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS coarse_label SMALLINT;
+        ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS coarse_label_name TEXT;
+        CREATE INDEX IF NOT EXISTS tb_images_seq_idx ON tb_images (seq);
+        CREATE UNIQUE INDEX IF NOT EXISTS tb_images_content_hash_idx ON tb_images (content_hash, batch_name);
+        CREATE INDEX IF NOT EXISTS tb_images_downloaded_at_idx ON tb_images USING BRIN (downloaded_at);
+        {LABEL_INDEXES_SQL}
+        CREATE TABLE IF NOT EXISTS tb_image_blobs (
+            id UUID PRIMARY KEY,
             image BYTEA NOT NULL
         );
+        {INGEST_MANIFEST_DDL}
+        """
+    else:
+        table_query = f"""
+        CREATE TABLE IF NOT EXISTS tb_images ({IMAGE_COLUMNS_DDL},
+            PRIMARY KEY (id)
+        );
+        ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS seq BIGSERIAL NOT NULL;
+        ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS content_hash BYTEA;
+        ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS image_path TEXT;
+        ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS phash BIGINT;
+        ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS label SMALLINT;
+        ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS label_name TEXT;
+        ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS coarse_label SMALLINT;
+        ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS coarse_label_name TEXT;
+        ALTER TABLE tb_images ALTER COLUMN image DROP NOT NULL;
+        {MIGRATE_ID_TO_UUID_SQL}
+        CREATE UNIQUE INDEX IF NOT EXISTS tb_images_seq_idx ON tb_images (seq);
+        CREATE UNIQUE INDEX IF NOT EXISTS tb_images_content_hash_idx ON tb_images (content_hash);
+        CREATE INDEX IF NOT EXISTS tb_images_batch_name_idx ON tb_images (batch_name);
+        CREATE INDEX IF NOT EXISTS tb_images_downloaded_at_idx ON tb_images USING BRIN (downloaded_at);
+        {LABEL_INDEXES_SQL}
+        CREATE TABLE IF NOT EXISTS tb_image_blobs (
+            id UUID PRIMARY KEY REFERENCES tb_images (id) ON DELETE CASCADE,
+            image BYTEA NOT NULL
+        );
+        {INGEST_MANIFEST_DDL}
         """
     with conn.cursor() as cur:
-        cur.execute(create_table_query)
+        cur.execute(table_query)
         conn.commit()
         print("Table 'tb_images' created successfully (or already exists).")
 
 
+def batch_partition(conn, batch_name):
+    """Name of the tb_images partition holding batch_name, or None if the table is not partitioned by it."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass('tb_images')
+              AND pg_get_expr(c.relpartbound, c.oid) = format('FOR VALUES IN (%%L)', %s::text);
+        """, (batch_name,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def drop_batch(conn, batch_name):
+    """
+    Remove every image of one batch.
+
+    On a partitioned table the batch's partition is detached and dropped,
+    which costs the same whatever its size; blob payloads of the batch are
+    deleted first. Otherwise the rows are deleted (blobs cascade). Files in
+    IMAGE_STORE_DIR are left in place.
+    """
+    partition = batch_partition(conn, batch_name)
+    with conn.cursor() as cur:
+        if partition is not None:
+            table = psycopg2.extensions.quote_ident(partition, cur)
+            cur.execute(f"DELETE FROM tb_image_blobs b USING {table} p WHERE b.id = p.id;")
+            cur.execute(f"ALTER TABLE tb_images DETACH PARTITION {table};")
+            cur.execute(f"DROP TABLE {table};")
+        else:
+            cur.execute("DELETE FROM tb_images WHERE batch_name = %s;", (batch_name,))
+        conn.commit()
+        print(f"Batch '{batch_name}' dropped successfully.")
+
+
 def drop_table(conn):
     with conn.cursor() as cur:
-        cur.execute("DROP TABLE IF EXISTS tb_images;")
+        # The manifest describes rows of tb_images, so it goes with them.
+        cur.execute("DROP TABLE IF EXISTS tb_image_blobs, tb_images, tb_ingest_manifest;")
         conn.commit()
         print("Table 'tb_images' dropped successfully.")
 
+
+def create_manifest_table(conn):
+    """Create tb_ingest_manifest on its own, for databases set up before it existed."""
+    with conn.cursor() as cur:
+        cur.execute(INGEST_MANIFEST_DDL)
+    conn.commit()
+
+
+def save_manifest(conn, archive, url, plan):
+    """
+    Record a new ingestion plan for archive, replacing any earlier one, and commit it.
+
+    plan lists (member, positions) in archive order, one entry per batch
+    member, with the sampled row positions in the order they will be inserted.
+    """
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM tb_ingest_manifest WHERE archive = %s;", (archive,))
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO tb_ingest_manifest (archive, member, ordinal, url, positions) VALUES %s;",
+            [(archive, member, ordinal, url, list(positions)) for ordinal, (member, positions) in enumerate(plan)]
+        )
+    conn.commit()
+
+
+def load_manifest(conn, archive):
+    """Return the recorded plan for archive as [{member, url, positions, committed}] in archive order ([] if none)."""
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT member, url, positions, committed FROM tb_ingest_manifest WHERE archive = %s ORDER BY ordinal;",
+            (archive,)
+        )
+        return [
+            {"member": member, "url": url, "positions": list(positions), "committed": committed}
+            for member, url, positions, committed in cur.fetchall()
+        ]
+
+
+def advance_manifest(cur, archive, counts):
+    """
+    Move the committed offsets of archive's members forward by counts ({member: rows}).
+
+    Takes a cursor and does not commit: it is meant to run as the checkpoint
+    of insert_images_bulk, inside the transaction that stores those rows.
+    """
+    for member, rows in counts.items():
+        cur.execute(
+            "UPDATE tb_ingest_manifest SET committed = committed + %s, updated_at = now() "
+            "WHERE archive = %s AND member = %s;",
+            (rows, archive, member)
+        )
+
+
+def manifest_status(conn):
+    """Per-archive progress: [(archive, url, members, selected, committed, updated_at)] ordered by archive."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT archive, min(url), count(*), sum(cardinality(positions)), sum(committed), max(updated_at)
+            FROM tb_ingest_manifest
+            GROUP BY archive
+            ORDER BY archive;
+        """)
+        return cur.fetchall()
+
+
+def unfinished_archives(conn):
+    """(url, archive) of every archive whose recorded plan still has uncommitted rows."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT min(url), archive
+            FROM tb_ingest_manifest
+            GROUP BY archive
+            HAVING sum(committed) < sum(cardinality(positions))
+            ORDER BY archive;
+        """)
+        return cur.fetchall()
@@ -1,106 +1,764 @@
 import os
+import argparse
+import gzip
+import hashlib
+import json
+import re
 import tarfile
+import time
 import random
 import requests
 import pickle
+from collections import Counter
 from datetime import datetime
 from urllib.parse import urljoin
 from bs4 import BeautifulSoup
-from database import get_connection, insert_image_record
+from database import (get_connection, insert_images_bulk, existing_hashes, STORAGE_LAYOUTS, advance_manifest,
+                      create_manifest_table, load_manifest, manifest_status, save_manifest, unfinished_archives)
+from metrics import metrics, profiled
 
 from PIL import Image
 import io
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 from numpy import ndarray
 
+try:
+    from isal import igzip as fast_gzip
+except ImportError:
+    try:
+        from zlib_ng import gzip_ng as fast_gzip
+    except ImportError:
+        fast_gzip = None
+
 BASE_URL = "https://www.cs.toronto.edu/~kriz/"
 DOWNLOAD_DIR = "image_sets"
+IMAGE_FORMATS = ("PNG", "JPEG", "WEBP", "RAW")
+ENCODE_CHUNK_SIZE = 256
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+INDEX_CACHE_TTL = 24 * 3600
+# Pixel batches of CIFAR-10 (data_batch_N, test_batch) and CIFAR-100 (train, test).
+BATCH_MEMBER_PATTERN = re.compile(
+    r"^(?:cifar-10-batches-py/)?(?:data_batch_\d+|test_batch)$|^(?:cifar-100-python/)?(?:train|test)$"
+)
+# Pickle keys kept next to the cached pixel matrix; the first two hold bytes.
+BATCH_TEXT_KEYS = (b"batch_label", b"filenames")
+BATCH_LABEL_KEYS = (b"labels", b"fine_labels", b"coarse_labels")
+# Label-name members: batches.meta (CIFAR-10) and meta (CIFAR-100).
+META_MEMBER_PATTERN = re.compile(r"^(?:cifar-10-batches-py/)?batches\.meta$|^(?:cifar-100-python/)?meta$")
+# Where each label kind finds its per-row ids in a batch and its names in the meta member.
+LABEL_SOURCES = {
+    "label": ((b"labels", b"fine_labels"), (b"label_names", b"fine_label_names")),
+    "coarse_label": ((b"coarse_labels",), (b"coarse_label_names",)),
+}
+LABEL_NAMES_FILE = "label_names.json"
+# Published checksums of the CIFAR python archives.
+CIFAR_MD5 = {
+    "cifar-10-python.tar.gz": "c58f30108f718f92721af3b95e74349a",
+    "cifar-100-python.tar.gz": "eb9058c3a382ffc7106e4002c42a8d85",
+}
 
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
 
+def _dct_matrix(size):
+    """Orthonormal DCT-II matrix, so that D @ X @ D.T is the 2-D DCT of X."""
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+DCT_32 = _dct_matrix(32)
+
+
+def _write_json(path, value):
+    """Write value as JSON through a temp file and os.replace, so readers never see a partial file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def _read_cached_index(cache_path):
+    """The cached index page entry, or None when it is missing or unreadable."""
+    try:
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+        if cached.get("links") and "fetched_at" in cached:
+            return cached
+    except (OSError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def get_cifar_links(ttl=INDEX_CACHE_TTL):
+    """
+    Return the python.tar.gz hrefs listed on cifar.html.
+
+    The list is cached in DOWNLOAD_DIR/cifar_index.json. Within ttl seconds it
+    is used as is; after that the page is revalidated with its ETag and only
+    parsed again when it has changed. A damaged cache counts as a miss, and an
+    error response or a page without links raises instead of being cached.
+    """
+    cache_path = os.path.join(DOWNLOAD_DIR, "cifar_index.json")
+    cached = _read_cached_index(cache_path)
+    if cached and time.time() - cached["fetched_at"] < ttl:
+        return cached["links"]
+
+    headers = {"If-None-Match": cached["etag"]} if cached and cached.get("etag") else {}
+    page = requests.get(BASE_URL + "cifar.html", headers=headers)
+    if cached and page.status_code == 304:
+        links = cached["links"]
+    else:
+        page.raise_for_status()
+        soup = BeautifulSoup(page.content, "html.parser")
+        links = [lk["href"] for lk in soup.find_all("a", href=True) if "python.tar.gz" in lk["href"]]
+        if not links:
+            raise ValueError(f"No python.tar.gz archives listed on {BASE_URL}cifar.html")
+    etag = page.headers.get("ETag") or (cached or {}).get("etag")
+
+    _write_json(cache_path, {"fetched_at": time.time(), "etag": etag, "links": links})
+    return links
+
+
 def get_cifar_url():
-    page = requests.get(BASE_URL + "cifar.html")
-    soup = BeautifulSoup(page.content, "html.parser")
-    links = soup.find_all("a", href=True)
-    python_links = [lk for lk in links if "python.tar.gz" in lk["href"]]
+    selected = random.choice(get_cifar_links())
+    full_url = urljoin(BASE_URL, selected)
+    return full_url, selected
 
-    selected = random.choice(python_links)
-    full_url = urljoin(BASE_URL, selected["href"])
-    return full_url, selected["href"]
 
+def file_md5(path, chunk_size=DOWNLOAD_CHUNK_SIZE) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
 
-def download_image_set(url, local_filename):
+
+def _ranged_length(url):
+    """Return the archive size if the server supports byte ranges, else None."""
+    response = requests.head(url, allow_redirects=True)
+    if response.ok and response.headers.get("Accept-Ranges") == "bytes" and "Content-Length" in response.headers:
+        return int(response.headers["Content-Length"])
+    return None
+
+
+def _fetch_range(url, part_path, start=0, end=None, chunk_size=DOWNLOAD_CHUNK_SIZE):
+    """
+    Download bytes start..end (inclusive, end=None for the rest of the file) into part_path.
+
+    Whatever part_path already holds is kept and only the remainder is
+    requested, so an interrupted fetch resumes where it stopped.
+    """
+    done = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if end is not None and done > end - start + 1:
+        # Longer than its range: not a part of this layout, so start it over.
+        os.remove(part_path)
+        done = 0
+    if end is not None and start + done > end:
+        return
+    headers = {}
+    if start + done > 0 or end is not None:
+        headers["Range"] = f"bytes={start + done}-{'' if end is None else end}"
+
+    with requests.get(url, stream=True, headers=headers) as r:
+        if r.status_code == 416:
+            return
+        r.raise_for_status()
+        if r.status_code != 206 and (start > 0 or end is not None):
+            raise ValueError(f"Server ignored the range request for {url}")
+        # 200 (only accepted for a whole-file fetch) means any partial data is discarded.
+        with open(part_path, "ab" if r.status_code == 206 else "wb") as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+
+
+def download_image_set(url, local_filename, chunk_size=DOWNLOAD_CHUNK_SIZE, connections=1, expected_md5=None):
+    """
+    Download an archive into DOWNLOAD_DIR, resuming from a previous partial download.
+
+    Data is written to <name>.part (or one <name>.part.<start>-<end> per range
+    when connections > 1 and the server supports ranges) and only renamed to
+    the final name once complete and, when a checksum is known, MD5-verified.
+    Range parts are named by their byte range, so a resume with a different
+    connection count discards parts of the old layout instead of splicing them.
+    """
     local_path = os.path.join(DOWNLOAD_DIR, local_filename)
+    part_path = local_path + ".part"
+    expected_md5 = expected_md5 or CIFAR_MD5.get(local_filename)
+
     if os.path.exists(local_path):
-        print(f"Imageset already exists: {local_filename}")
-        return local_path
+        if expected_md5 is None or file_md5(local_path, chunk_size) == expected_md5:
+            print(f"Imageset already exists: {local_filename}")
+            return local_path
+        print(f"Existing imageset failed the checksum, downloading again: {local_filename}")
+        os.remove(local_path)
 
     print(f"Downloading imageset from {url}")
-    with requests.get(url, stream=True) as r:
-        r.raise_for_status()
-        with open(local_path, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                f.write(chunk)
+    with metrics.timer("download", url=url):
+        _download_parts(url, part_path, chunk_size, connections)
+    metrics.count("download_bytes", os.path.getsize(part_path))
+
+    if expected_md5 is not None:
+        with metrics.timer("checksum"):
+            actual_md5 = file_md5(part_path, chunk_size)
+        if actual_md5 != expected_md5:
+            os.remove(part_path)
+            raise ValueError(f"Checksum mismatch for {local_filename}: expected {expected_md5}, got {actual_md5}")
+    os.replace(part_path, local_path)
+    _remove_range_parts(part_path)
     return local_path
 
 
-def convert_to_jpeg_bytes(raw_bytes) -> bytes:
-    raw_array: ndarray = np.frombuffer(raw_bytes, dtype=np.uint8)
-    np_array = raw_array.reshape(3, 32, 32)
+def _range_parts(part_path):
+    """Range part files of part_path: <name>.part.<start>-<end>, plus <name>.part<i> from older versions."""
+    directory, name = os.path.split(part_path)
+    pattern = re.compile(re.escape(name) + r"(?:\.\d+-\d+|\d+)$")
+    return [os.path.join(directory, entry) for entry in os.listdir(directory or ".") if pattern.match(entry)]
+
+
+def _remove_range_parts(part_path, keep=()):
+    for path in _range_parts(part_path):
+        if path not in keep:
+            os.remove(path)
+
+
+def _download_parts(url, part_path, chunk_size, connections):
+    size = _ranged_length(url) if connections > 1 else None
+    if size:
+        step = -(-size // connections)
+        segments = [(start, min(start + step, size) - 1) for start in range(0, size, step)]
+        segments = [(start, end, f"{part_path}.{start}-{end}") for start, end in segments]
+        _remove_range_parts(part_path, keep={path for _, _, path in segments})
+        with ThreadPoolExecutor(max_workers=connections) as pool:
+            for future in [pool.submit(_fetch_range, url, path, start, end, chunk_size)
+                           for start, end, path in segments]:
+                future.result()
+        with open(part_path, "wb") as out:
+            for _, _, path in segments:
+                with open(path, "rb") as f:
+                    while chunk := f.read(chunk_size):
+                        out.write(chunk)
+        for _, _, path in segments:
+            os.remove(path)
+    else:
+        _fetch_range(url, part_path, chunk_size=chunk_size)
+
 
-    np_array = np.transpose(np_array, (1, 2, 0))
-    img = Image.fromarray(np_array)
-    # Save Image as JPEG in memory
+def to_hwc(pixels) -> ndarray:
+    """Reshape a (N, 3072) CIFAR pixel matrix to a contiguous (N, 32, 32, 3) array in one pass."""
+    planar = np.asarray(pixels, dtype=np.uint8).reshape(-1, 3, 32, 32)
+    return np.ascontiguousarray(planar.transpose(0, 2, 3, 1))
+
+
+def encode_image(hwc_image: ndarray, image_format="PNG", quality=90) -> bytes:
+    image_format = image_format.upper()
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unsupported image format: {image_format}")
+    if image_format == "RAW":
+        return hwc_image.tobytes()
+
+    img = Image.fromarray(hwc_image)
     buffer = io.BytesIO()
-    img.save(buffer, format="PNG")
+    options = {"quality": quality} if image_format in ("JPEG", "WEBP") else {}
+    img.save(buffer, format=image_format, **options)
     return buffer.getvalue()
 
 
-def extract_images(tar_path, max_images=1000):
-    images = []
+def encode_images(pixels, image_format="PNG", quality=90) -> list:
+    """Encode a whole CIFAR pixel matrix, feeding each image to the encoder as a view of one HWC array."""
+    return [encode_image(hwc_image, image_format, quality) for hwc_image in to_hwc(pixels)]
 
-    with tarfile.open(tar_path, "r:gz") as tar:
-        members = [m for m in tar.getmembers() if "data_batch" in m.name or "test_batch" in m.name or "train" in m.name]
-        for member in members:
-            file = tar.extractfile(member)
-            if not file:
+
+def convert_to_jpeg_bytes(raw_bytes, image_format="PNG", quality=90) -> bytes:
+    raw_array: ndarray = np.frombuffer(raw_bytes, dtype=np.uint8)
+    return encode_images(raw_array, image_format, quality)[0]
+
+
+def _encode_shared_chunk(shm_name, shape, start, stop, image_format, quality) -> list:
+    shm = shared_memory.SharedMemory(name=shm_name)
+    pixels = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+    try:
+        return encode_images(pixels[start:stop], image_format, quality)
+    finally:
+        del pixels
+        shm.close()
+
+
+def iter_encoded(pixels, image_format="PNG", quality=90, workers=1):
+    """
+    Yield encoded images in input order, ENCODE_CHUNK_SIZE rows at a time.
+
+    With workers > 1 the pixel matrix is placed in shared memory once and the
+    chunks are encoded by a process pool; workers receive only the segment
+    name and row bounds, and results are yielded in submission order so the
+    output stays deterministic.
+    """
+    pixels = np.ascontiguousarray(pixels, dtype=np.uint8)
+    bounds = [(start, min(start + ENCODE_CHUNK_SIZE, len(pixels)))
+              for start in range(0, len(pixels), ENCODE_CHUNK_SIZE)]
+    if workers <= 1 or len(bounds) == 0:
+        for start, stop in bounds:
+            with metrics.timer("encode", items=stop - start):
+                encoded = encode_images(pixels[start:stop], image_format, quality)
+            yield from encoded
+        return
+
+    shm = shared_memory.SharedMemory(create=True, size=pixels.nbytes)
+    try:
+        shared = np.ndarray(pixels.shape, dtype=np.uint8, buffer=shm.buf)
+        shared[:] = pixels
+        del shared
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(_encode_shared_chunk, shm.name, pixels.shape, start, stop, image_format, quality)
+                for start, stop in bounds
+            ]
+            for future, (start, stop) in zip(futures, bounds):
+                # Time spent waiting on the pool for this chunk.
+                with metrics.timer("encode", items=stop - start):
+                    encoded = future.result()
+                yield from encoded
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def batch_cache_dir(tar_path):
+    """Directory next to the archive that holds its batches as uncompressed .npy files."""
+    return tar_path[:-len(".tar.gz")] + ".batches" if tar_path.endswith(".tar.gz") else tar_path + ".batches"
+
+
+def _save_batch(cache_dir, name, data):
+    npy_path = os.path.join(cache_dir, f"{name}.npy")
+    with open(npy_path + ".tmp", "wb") as f:
+        np.save(f, np.ascontiguousarray(data[b"data"], dtype=np.uint8))
+    os.replace(npy_path + ".tmp", npy_path)
+    meta = {}
+    for key in BATCH_TEXT_KEYS + BATCH_LABEL_KEYS:
+        if key in data:
+            value = data[key]
+            meta[key.decode()] = value.decode() if isinstance(value, bytes) else [
+                v.decode() if isinstance(v, bytes) else int(v) for v in value]
+    _write_json(os.path.join(cache_dir, f"{name}.json"), meta)
+
+
+def _load_batch(cache_dir, name):
+    with metrics.timer("batch_cache_load"):
+        data = {b"data": np.load(os.path.join(cache_dir, f"{name}.npy"), mmap_mode="r")}
+        with open(os.path.join(cache_dir, f"{name}.json"), "r") as f:
+            meta = json.load(f)
+    for key, value in meta.items():
+        if key.encode() in BATCH_TEXT_KEYS:
+            value = value.encode() if isinstance(value, str) else [v.encode() for v in value]
+        data[key.encode()] = value
+    return data
+
+
+def iter_batch_members(tar_path, include_meta=False):
+    """
+    Yield (member, file) for each pixel batch in a single pass over the archive.
+
+    Members are matched by their exact CIFAR names and handled as they are
+    reached, so the archive is decompressed once and never seeked back. gzip
+    is decoded by isal or zlib-ng when one of them is installed. With
+    include_meta the label-name member is yielded too, wherever it sits.
+    """
+    gzip_module = fast_gzip if fast_gzip is not None else gzip
+    with gzip_module.open(tar_path, "rb") as stream, tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile() or not (BATCH_MEMBER_PATTERN.match(member.name) or
+                                           include_meta and META_MEMBER_PATTERN.match(member.name)):
                 continue
-            data = pickle.load(file, encoding="bytes")
+            file = tar.extractfile(member)
+            if file:
+                yield member, file
 
-            for i in range(len(data[b"data"])):
-                # image_bytes = data[b"data"][i].tobytes()
-                image_bytes = convert_to_jpeg_bytes(data[b"data"][i])
-                title = data[b"filenames"][i].decode() if b"filenames" in data else f"image_{i}.png"
-                batch_label = data[b"batch_label"].decode() if b"batch_label" in data else f"batch_{i}"
-                images.append((title, batch_label, image_bytes))
 
-    random.shuffle(images)
-    print(f"Extracted {len(images)} images, selecting up to {max_images}")
-    return images[:max_images]
+def read_label_names(meta):
+    """Map each label kind to its list of class names, from an unpickled meta member."""
+    label_names = {}
+    for kind, (_, name_keys) in LABEL_SOURCES.items():
+        for key in name_keys:
+            if key in meta:
+                label_names[kind] = [name.decode() if isinstance(name, bytes) else name for name in meta[key]]
+                break
+    return label_names
 
 
-def insert_images_to_db(images, image_set_url):
-    conn = get_connection()
+def iter_batches(tar_path, use_cache=True, label_names=None):
+    """Yield each CIFAR batch as the dict stored in its pickle (see iter_named_batches)."""
+    for _, data in iter_named_batches(tar_path, use_cache, label_names):
+        yield data
+
+
+def iter_named_batches(tar_path, use_cache=True, label_names=None):
+    """
+    Yield (member name, batch dict) for each CIFAR batch in archive order.
+
+    The first pass over an archive also writes every batch to batch_cache_dir
+    as an .npy pixel matrix plus a JSON sidecar; later passes memory-map those
+    files and never touch gzip or pickle. If a label_names dict is passed it
+    is filled from the archive's meta member (see read_label_names); the meta
+    member can come after the batches, so it is only complete once the
+    generator is exhausted.
+    """
+    cache_dir = batch_cache_dir(tar_path)
+    index_path = os.path.join(cache_dir, "index.json")
+    label_names_path = os.path.join(cache_dir, LABEL_NAMES_FILE)
+    # Caches written before labels were stored have no label_names.json; they are rebuilt once.
+    if use_cache and os.path.exists(index_path) and os.path.exists(label_names_path):
+        with open(index_path, "r") as f:
+            names = json.load(f)
+        for name in names:
+            yield name, _load_batch(cache_dir, name)
+        if label_names is not None:
+            with open(label_names_path, "r") as f:
+                label_names.update(json.load(f))
+        return
+
+    if use_cache:
+        os.makedirs(cache_dir, exist_ok=True)
+    names = []
+    found_labels = {}
+    for member, file in iter_batch_members(tar_path, include_meta=True):
+        # Read first so gzip/tar time and unpickling time are measured apart.
+        with metrics.timer("decompress", items=member.size):
+            raw = file.read()
+        with metrics.timer("unpickle"):
+            data = pickle.loads(raw, encoding="bytes")
+        del raw
+        if META_MEMBER_PATTERN.match(member.name):
+            found_labels.update(read_label_names(data))
+            if label_names is not None:
+                label_names.update(found_labels)
+            continue
+        name = os.path.basename(member.name)
+        if use_cache:
+            with metrics.timer("batch_cache_save"):
+                _save_batch(cache_dir, name, data)
+            names.append(name)
+        yield name, data
+
+    if use_cache:
+        # Always written (empty without a meta member), so its absence marks an old cache.
+        _write_json(label_names_path, found_labels)
+        # Written last, so an interrupted first pass is simply redone.
+        _write_json(index_path, names)
+
+
+def perceptual_hash(pixels) -> ndarray:
+    """
+    64-bit DCT perceptual hash of every row of a (N, 3072) CIFAR pixel matrix, as int64.
+
+    Each image is reduced to luma, transformed with a 32x32 DCT, and the 8x8
+    lowest frequencies are compared against their median (DC excluded), one
+    bit each. Near-duplicates differ in only a few bits, so Hamming distance
+    between hashes approximates visual distance.
+    """
+    planar = np.asarray(pixels, dtype=np.uint8).reshape(-1, 3, 32, 32).astype(np.float32)
+    luma = planar[:, 0] * 0.299 + planar[:, 1] * 0.587 + planar[:, 2] * 0.114
+    low = (DCT_32 @ luma @ DCT_32.T)[:, :8, :8].reshape(len(planar), 64)
+    bits = low > np.median(low[:, 1:], axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64).view(np.int64)
+
+
+def content_hash(raw_pixels) -> bytes:
+    """BLAKE2b-128 digest of the raw 3072 pixel bytes, used as the dedup key in tb_images."""
+    return hashlib.blake2b(np.ascontiguousarray(raw_pixels, dtype=np.uint8), digest_size=16).digest()
+
+
+def sampled_row(data, i, row_hash=None):
+    """The dict sample_images keeps for row i of a batch: metadata, label ids and a copy of the pixels."""
+    return {
+        'title': data[b"filenames"][i].decode() if b"filenames" in data else f"image_{i}.png",
+        'batch_name': data[b"batch_label"].decode() if b"batch_label" in data else f"batch_{i}",
+        'content_hash': row_hash if row_hash is not None else content_hash(data[b"data"][i]),
+        'pixels': np.array(data[b"data"][i], dtype=np.uint8),
+        **{kind: int(data[key][i]) for kind, (keys, _) in LABEL_SOURCES.items() for key in keys if key in data}
+    }
+
+
+def sample_images(batches, max_images=1000, seed=None, exclude_hashes=None):
+    """
+    Reservoir-sample up to max_images raw rows across all batches (Algorithm R).
+
+    Only the selected rows are kept (as copies), so each batch can be released
+    as soon as it has been scanned. exclude_hashes, if given, is called once per
+    batch with the content hashes of all its rows and returns those to skip.
+    Returns (selected, total_seen) where selected is a shuffled list of dicts
+    with title, batch_name, content_hash and the raw pixels, plus label and
+    coarse_label ids when the batch carries them (see sampled_row). Each also
+    has a source of (batch number, row number) so the selection can be
+    recorded and found again.
+    """
+    rng = np.random.default_rng(seed)
+    reservoir = []
+    seen = 0
+
+    for batch_number, data in enumerate(batches):
+        pixels = data[b"data"]
+        hashes = None
+        candidates = np.arange(len(pixels))
+        if exclude_hashes is not None:
+            with metrics.timer("hash", items=len(pixels)):
+                hashes = [content_hash(raw_pixels) for raw_pixels in pixels]
+            stored = exclude_hashes(hashes)
+            if stored:
+                candidates = np.array([i for i, h in enumerate(hashes) if h not in stored], dtype=np.int64)
+        count = len(candidates)
+
+        def row(i):
+            return {**sampled_row(data, i, hashes[i] if hashes is not None else None),
+                    'source': (batch_number, int(i))}
+
+        fill = min(max(max_images - len(reservoir), 0), count)
+        reservoir.extend(row(candidates[k]) for k in range(fill))
+        if fill < count:
+            # Slot draws for every remaining row at once; only hits touch Python.
+            positions = np.arange(seen + fill + 1, seen + count + 1)
+            slots = (rng.random(count - fill) * positions).astype(np.int64)
+            for k in np.flatnonzero(slots < max_images):
+                reservoir[slots[k]] = row(candidates[fill + k])
+        seen += count
+
+    order = rng.permutation(len(reservoir))
+    return [reservoir[i] for i in order], seen
+
+
+def apply_label_names(images, label_names):
+    """Add label_name / coarse_label_name to sampled images from the names read by iter_batches."""
+    for image in images:
+        for kind, names in label_names.items():
+            if image.get(kind) is not None and image[kind] < len(names):
+                image[f"{kind}_name"] = names[image[kind]]
+    return images
+
+
+def sample_archive(tar_path, max_images=1000, seed=None, exclude_hashes=None):
+    """
+    Sample an archive and return (plan, selected, label_names).
+
+    Runs sample_images over the archive's batches, then plan_selection, so
+    selected is grouped by batch member in plan order. ingest_archive records
+    the plan in the manifest before encoding; extract_images does not.
+    """
+    label_names = {}
+    names = []
 
-    for title, batch_label, image_data in images:
-        image_record = {
+    def named_batches():
+        for name, data in iter_named_batches(tar_path, label_names=label_names):
+            names.append(name)
+            yield data
+
+    sampled, total = sample_images(named_batches(), max_images=max_images, seed=seed, exclude_hashes=exclude_hashes)
+    print(f"Scanned {total} new images, selected {len(sampled)} (up to {max_images})")
+    metrics.count("images_scanned", total)
+    plan, selected = plan_selection(sampled, names)
+    return plan, selected, label_names
+
+
+def extract_images(tar_path, max_images=1000, seed=None, image_format="PNG", quality=90, workers=1,
+                   exclude_hashes=None):
+    """Sample an archive and yield the selected images encoded, in the order ingest_archive inserts them."""
+    _, selected, label_names = sample_archive(tar_path, max_images, seed, exclude_hashes)
+    yield from encode_selected(selected, label_names, image_format, quality, workers)
+
+
+def encode_selected(selected, label_names, image_format="PNG", quality=90, workers=1):
+    """Name the labels of sampled images, hash and encode their pixels, and yield them ready to insert."""
+    apply_label_names(selected, label_names)
+    if not selected:
+        return
+    pixels = np.stack([image.pop('pixels') for image in selected])
+    with metrics.timer("phash", items=len(pixels)):
+        phashes = perceptual_hash(pixels).tolist()
+    encoded = iter_encoded(pixels, image_format, quality, workers)
+    for image, image_bytes, phash in zip(selected, encoded, phashes):
+        yield {**image, 'image': image_bytes, 'phash': phash}
+
+
+def insert_images_to_db(images, image_set_url, batch_size=1000, conn=None, storage="inline", checkpoint=None):
+    own_conn = conn is None
+    if own_conn:
+        conn = get_connection()
+    downloaded_at = datetime.utcnow()
+
+    image_records = (
+        {
+            **image,
             'url': image_set_url,
-            'title': title,
-            'downloaded_at': datetime.utcnow(),
-            'batch_name': batch_label,
-            'image': image_data
+            'downloaded_at': downloaded_at
         }
-        insert_image_record(conn, image_record)
+        for image in images
+    )
+    try:
+        insert_images_bulk(conn, image_records, batch_size=batch_size, storage=storage, checkpoint=checkpoint)
+    finally:
+        if own_conn:
+            conn.close()
     print(f"Inserted the batch of images successfully.")
 
 
-def download_and_store_images():
-    image_set_url, filename = get_cifar_url()
-    tar_path = download_image_set(image_set_url, filename)
-    extracted_images = extract_images(tar_path, max_images=1000)
-    insert_images_to_db(extracted_images, image_set_url)
+def plan_selection(selected, names):
+    """
+    Turn a sample_images selection into a manifest plan and its insertion order.
+
+    Returns (plan, ordered): plan lists (member, positions) for every scanned
+    member, and ordered is the selection grouped by member, in plan order,
+    with each image's source replaced by its member name.
+    """
+    by_batch = [[] for _ in names]
+    for image in selected:
+        batch_number, position = image.pop('source')
+        by_batch[batch_number].append((position, {**image, 'member': names[batch_number]}))
+    plan = [(name, [position for position, _ in rows]) for name, rows in zip(names, by_batch)]
+    return plan, [image for rows in by_batch for _, image in rows]
+
+
+def resume_selection(tar_path, entries, label_names=None):
+    """Rebuild the not yet committed images of a recorded plan, member by member, from the archive."""
+    remaining = {entry["member"]: entry["positions"][entry["committed"]:] for entry in entries}
+    found = {}
+    for name, data in iter_named_batches(tar_path, label_names=label_names):
+        if remaining.get(name):
+            found[name] = [{**sampled_row(data, position), 'member': name} for position in remaining[name]]
+    missing = [name for name, positions in remaining.items() if positions and name not in found]
+    if missing:
+        raise ValueError(f"{tar_path} has no batch member {', '.join(missing)} recorded in the manifest")
+    return [image for entry in entries for image in found.get(entry["member"], [])]
+
+
+def ingest_archive(conn, image_set_url, filename, max_images=1000, seed=None, image_format="PNG", quality=90,
+                   workers=1, storage="inline", connections=1, chunk_size=DOWNLOAD_CHUNK_SIZE, resume=False,
+                   batch_size=1000):
+    """
+    Store a random sample of one archive, recording it in tb_ingest_manifest as it goes.
+
+    The sample is written to the manifest (member and row positions) before
+    any image is inserted, and every insert batch moves the members'
+    committed offsets forward in the same transaction as its rows. With
+    resume=True an archive whose recorded plan is complete is skipped
+    outright, and one that was interrupted continues with exactly the rows
+    that are not committed yet, so each image is inserted once. Without
+    resume, or when the archive has no plan yet, a new sample replaces the
+    old plan. Returns the number of images handed to the database.
+    """
+    entries = load_manifest(conn, filename) if resume else []
+    if entries and all(entry["committed"] >= len(entry["positions"]) for entry in entries):
+        print(f"{filename}: already ingested, skipping.")
+        return 0
+    tar_path = download_image_set(image_set_url, filename, chunk_size=chunk_size, connections=connections)
+    if entries:
+        label_names = {}
+        selected = resume_selection(tar_path, entries, label_names)
+        print(f"{filename}: resuming with {len(selected)} images not yet committed")
+    else:
+        plan, selected, label_names = sample_archive(tar_path, max_images, seed,
+                                                     lambda hashes: existing_hashes(conn, hashes))
+        save_manifest(conn, filename, image_set_url, plan)
+
+    def checkpoint(cur, records):
+        advance_manifest(cur, filename, Counter(record['member'] for record in records))
+
+    images = encode_selected(selected, label_names, image_format, quality, workers)
+    insert_images_to_db(images, image_set_url, batch_size=batch_size, conn=conn, storage=storage,
+                        checkpoint=checkpoint)
+    return len(selected)
+
+
+def download_and_store_images(max_images=1000, seed=None, image_format="PNG", quality=90, workers=1,
+                              storage="inline", connections=1, chunk_size=DOWNLOAD_CHUNK_SIZE, resume=False,
+                              all_archives=False):
+    """
+    Ingest one random archive from cifar.html, or every listed one with all_archives=True.
+
+    With resume=True and no all_archives, only the archives the manifest
+    shows as interrupted are finished (and the index page is not fetched);
+    with both, finished archives are skipped and the rest resumed or started.
+    """
+    conn = get_connection()
+    try:
+        create_manifest_table(conn)
+        if all_archives:
+            archives = [(urljoin(BASE_URL, href), href) for href in get_cifar_links()]
+        elif resume:
+            archives = unfinished_archives(conn)
+            if not archives:
+                print("Nothing to resume: every recorded archive is complete.")
+        else:
+            archives = [get_cifar_url()]
+        for image_set_url, filename in archives:
+            ingest_archive(conn, image_set_url, filename, max_images=max_images, seed=seed,
+                           image_format=image_format, quality=quality, workers=workers, storage=storage,
+                           connections=connections, chunk_size=chunk_size, resume=resume)
+    finally:
+        conn.close()
+
+
+def print_manifest_status(rows):
+    if not rows:
+        print("No ingestion recorded yet.")
+    for archive, url, members, selected, committed, updated_at in rows:
+        state = "done" if committed >= selected else "interrupted"
+        print(f"{archive:<28}{members:>4} members  {committed:>7}/{selected:<7} committed  {state:<12}"
+              f"{updated_at:%Y-%m-%d %H:%M:%S}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Download a CIFAR image set and store a random sample in PostgreSQL.")
+    parser.add_argument("--max-images", type=int, default=1000, help="number of images to store")
+    parser.add_argument("--seed", type=int, default=None, help="seed for the random sample")
+    parser.add_argument("--format", dest="image_format", choices=IMAGE_FORMATS, default="PNG",
+                        type=str.upper, help="stored image format")
+    parser.add_argument("--quality", type=int, default=90, help="JPEG/WEBP quality")
+    parser.add_argument("--workers", type=int, default=1, help="encoder processes (1 = encode serially)")
+    parser.add_argument("--storage", choices=STORAGE_LAYOUTS, default="inline",
+                        help="where image payloads are stored (tb_images, tb_image_blobs or files)")
+    parser.add_argument("--connections", type=int, default=1, help="parallel ranged connections for the download")
+    parser.add_argument("--chunk-size", type=int, default=DOWNLOAD_CHUNK_SIZE, help="download chunk size in bytes")
+    parser.add_argument("--metrics-log", metavar="PATH", default=None,
+                        help="append a JSON line per timed stage call to PATH ('-' for stderr)")
+    parser.add_argument("--metrics-file", metavar="PATH", default=None,
+                        help="write the stage totals in Prometheus text format to PATH at the end")
+    parser.add_argument("--profile", metavar="PATH", default=None, help="run under cProfile and dump stats to PATH")
+    parser.add_argument("--all-archives", action="store_true", help="ingest every archive listed on cifar.html")
+    parser.add_argument("--resume", action="store_true",
+                        help="finish interrupted ingests from tb_ingest_manifest and skip finished archives")
+    parser.add_argument("--status", action="store_true", help="print the ingestion manifest and exit")
+    return parser.parse_args(argv)
+
+
+def print_stage_report(summary):
+    for stage, totals in sorted(summary["stages"].items(), key=lambda item: -item[1]["seconds"]):
+        print(f"{stage:<18}{totals['calls']:>8} calls  {totals['seconds']:>9.3f}s  "
+              f"max {totals['max_seconds']:>8.3f}s  {totals['items']:>10} items")
+    for counter, value in sorted(summary["counters"].items()):
+        print(f"{counter:<18}{value:>8}")
 
 
 if __name__ == "__main__":
-    download_and_store_images()
+    args = parse_args()
+    if args.status:
+        connection = get_connection()
+        try:
+            create_manifest_table(connection)
+            print_manifest_status(manifest_status(connection))
+        finally:
+            connection.close()
+        raise SystemExit(0)
+    metrics.configure(json_log=args.metrics_log)
+    try:
+        with profiled(args.profile):
+            download_and_store_images(max_images=args.max_images, seed=args.seed, image_format=args.image_format,
+                                      quality=args.quality, workers=args.workers, storage=args.storage,
+                                      connections=args.connections, chunk_size=args.chunk_size,
+                                      resume=args.resume, all_archives=args.all_archives)
+    finally:
+        print_stage_report(metrics.log_summary())
+        if args.metrics_file:
+            metrics.write_prometheus(args.metrics_file)
+        metrics.configure(json_log=None)
@@ -0,0 +1,155 @@
+import argparse
+import io
+import json
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from database import get_connection, read_payload_file
+
+EXPORT_DIR = "dataset"
+INDEX_FILE = "index.json"
+SHARD_SIZE = 10000
+IMAGE_SHAPE = (32, 32, 3)
+RAW_IMAGE_BYTES = 32 * 32 * 3
+
+EXPORT_QUERY = """
+    SELECT t.id, t.title, t.batch_name, COALESCE(t.image, b.image) AS image, t.image_path
+    FROM tb_images t
+    LEFT JOIN tb_image_blobs b ON b.id = t.id
+    WHERE %(batch_name)s::text IS NULL OR t.batch_name = %(batch_name)s
+    ORDER BY t.seq;
+"""
+
+
+def decode_payload(payload):
+    """Decode a stored payload (PNG, JPEG, WEBP or RAW HWC bytes) to a (32, 32, 3) uint8 array."""
+    if len(payload) == RAW_IMAGE_BYTES and bytes(payload[:4]) not in (b"\x89PNG", b"RIFF"):
+        return np.frombuffer(payload, dtype=np.uint8).reshape(IMAGE_SHAPE)
+    with Image.open(io.BytesIO(payload)) as image:
+        pixels = np.asarray(image.convert("RGB"))
+    if pixels.shape != IMAGE_SHAPE:
+        raise ValueError(f"Expected a {IMAGE_SHAPE} image, got {pixels.shape}")
+    return pixels
+
+
+def _write_shard(out_dir, shard_index, payloads):
+    """Decode one shard and write it as shard_NNNNN.npy; returns the file name. Runs in a worker."""
+    pixels = np.empty((len(payloads),) + IMAGE_SHAPE, dtype=np.uint8)
+    for row, (payload, image_path) in enumerate(payloads):
+        pixels[row] = decode_payload(payload if payload is not None else read_payload_file(image_path))
+    name = f"shard_{shard_index:05d}.npy"
+    tmp_path = os.path.join(out_dir, f"{name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, pixels)
+    os.replace(tmp_path, os.path.join(out_dir, name))
+    return name
+
+
+def _iter_export_rows(conn, batch_name=None, itersize=2000):
+    with conn.cursor(name=f"export_dataset_{uuid.uuid4().hex}") as cur:
+        cur.itersize = itersize
+        cur.execute(EXPORT_QUERY, {"batch_name": batch_name})
+        yield from cur
+
+
+def export_dataset(conn, out_dir=EXPORT_DIR, shard_size=SHARD_SIZE, batch_name=None, workers=1):
+    """
+    Export tb_images to fixed-shape uint8 .npy shards plus an index.json.
+
+    Rows stream through a server-side cursor in seq order; every shard_size
+    rows are handed to a worker that decodes them and writes one
+    (N, 32, 32, 3) shard, so shards are decoded and written in parallel while
+    the next ones are read. At most 2 * workers shards are in flight. The
+    index lists every shard with its ids, titles and batch names in row order.
+    Returns the index.
+    """
+    if shard_size < 1:
+        raise ValueError("shard_size must be at least 1")
+    os.makedirs(out_dir, exist_ok=True)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else ThreadPoolExecutor(max_workers=1)
+    shards = []
+    pending = []
+
+    def submit(payloads, metadata):
+        pending.append((executor.submit(_write_shard, out_dir, len(shards) + len(pending), payloads), metadata))
+        while len(pending) > 2 * max(workers, 1) or (pending and pending[0][0].done()):
+            finish(*pending.pop(0))
+
+    def finish(future, metadata):
+        ids, titles, batch_names = metadata
+        shards.append({"file": future.result(), "count": len(ids), "ids": ids, "titles": titles,
+                       "batch_names": batch_names})
+
+    try:
+        payloads, ids, titles, batch_names = [], [], [], []
+        for image_id, title, image_batch, image, image_path in _iter_export_rows(conn, batch_name):
+            payloads.append((bytes(image) if image is not None else None, image_path))
+            ids.append(str(image_id))
+            titles.append(title)
+            batch_names.append(image_batch)
+            if len(payloads) == shard_size:
+                submit(payloads, (ids, titles, batch_names))
+                payloads, ids, titles, batch_names = [], [], [], []
+        if payloads:
+            submit(payloads, (ids, titles, batch_names))
+        while pending:
+            finish(*pending.pop(0))
+    finally:
+        executor.shutdown()
+
+    index = {
+        "shape": list(IMAGE_SHAPE),
+        "dtype": "uint8",
+        "count": sum(shard["count"] for shard in shards),
+        "shards": shards,
+    }
+    tmp_path = os.path.join(out_dir, f"{INDEX_FILE}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(out_dir, INDEX_FILE))
+    print(f"Exported {index['count']} images to {len(shards)} shards in {out_dir}.")
+    return index
+
+
+def load_index(out_dir=EXPORT_DIR):
+    with open(os.path.join(out_dir, INDEX_FILE)) as f:
+        return json.load(f)
+
+
+def iter_dataset(out_dir=EXPORT_DIR, batch_size=256, with_ids=False):
+    """
+    Yield (N, 32, 32, 3) uint8 batches from an exported dataset.
+
+    Each shard is memory-mapped and batches are slices of the mapping, so
+    nothing is copied until the consumer touches the pixels. Batches do not
+    span shards: the last batch of each shard may be smaller than batch_size.
+    With with_ids=True yields (ids, batch) pairs.
+    """
+    index = load_index(out_dir)
+    for shard in index["shards"]:
+        pixels = np.load(os.path.join(out_dir, shard["file"]), mmap_mode="r")
+        for start in range(0, len(pixels), batch_size):
+            batch = pixels[start:start + batch_size]
+            yield (shard["ids"][start:start + batch_size], batch) if with_ids else batch
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export tb_images to memory-mappable .npy shards.")
+    parser.add_argument("--out", default=EXPORT_DIR, help="output directory")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE, help="images per shard")
+    parser.add_argument("--batch", dest="batch_name", default=None, help="export only this batch_name")
+    parser.add_argument("--workers", type=int, default=1, help="processes decoding and writing shards")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    connection = get_connection()
+    try:
+        export_dataset(connection, args.out, args.shard_size, args.batch_name, args.workers)
+    finally:
+        connection.close()
@@ -1,26 +1,45 @@
+import argparse
 from typing import Iterator
-from database import get_connection, select_image
+from database import close_pool, pooled_connection, select_image
+from image_cache import ImageCache, CACHE_PATH
 from image_structure import ImageStructure
 from pathlib import Path
 
 
-def get_random_image() -> Iterator[ImageStructure]:
-    conn = get_connection()
+def get_random_image(cache: ImageCache = None) -> Iterator[ImageStructure]:
     try:
-        output_file = Path("random_image.png")
-        for image in select_image(conn):
-            print(f"ID: {image.id}, Title: {image.title}, Batch Name: {image.batch_name}, URL: {image.url}")
-            with open(output_file, "wb") as f:
-                f.write(image.image)
+        with pooled_connection() as conn:
+            output_file = Path("random_image.png")
+            # With a cache only metadata is selected; the payload comes from the cache when it is there.
+            images = select_image(conn, lazy=True) if cache is not None else select_image(conn)
+            for image in images:
+                print(f"ID: {image.id}, Title: {image.title}, Batch Name: {image.batch_name}, URL: {image.url}")
+                payload = cache.get_or_load(image.id, image.load_image) if cache is not None else image.image
+                with open(output_file, "wb") as f:
+                    f.write(payload)
 
         print(f"Random image is fetched from database and stored at {output_file.resolve()}")
 
     except Exception as e:
         print(f"Error fetching random image: {e}")
         return iter([])
-    finally:
-        conn.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch a random image from PostgreSQL into random_image.png.")
+    parser.add_argument("--cache", nargs="?", const=CACHE_PATH, default=None,
+                        help=f"serve payloads through a local read cache (default file: {CACHE_PATH})")
+    parser.add_argument("--cache-size-mb", type=int, default=256, help="cache size limit")
+    return parser.parse_args(argv)
 
 
 if __name__ == '__main__':
-    get_random_image()
+    args = parse_args()
+    cache = ImageCache(args.cache, max_bytes=args.cache_size_mb * 1024 * 1024) if args.cache else None
+    try:
+        get_random_image(cache)
+    finally:
+        close_pool()
+        if cache is not None:
+            print(f"Cache: {cache.stats()}")
+            cache.close()
@@ -0,0 +1,204 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+CACHE_PATH = "image_cache.pack"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+# Each record is: id length, payload length, id (UTF-8), payload.
+RECORD_HEADER = struct.Struct("!HI")
+
+
+class ImageCache:
+    """
+    Local read-through cache of image payloads keyed by image id.
+
+    Payloads are appended to one packed file and located through an in-memory
+    offset index that is rebuilt by scanning the file on open. Reads are
+    memoryview slices of a read-only mmap of that file, so a hit copies
+    nothing. Once the live payloads exceed max_bytes the least recently used
+    entries are dropped from the index, and the file is compacted when dead
+    space outgrows the live data.
+
+    Several processes can share one pack file. Appends and compaction take an
+    exclusive flock on <path>.lock. Under that lock each process first picks
+    up records appended by the others, or reloads the file if another process
+    compacted it, and then writes at the real end of the file.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index = OrderedDict()  # image_id -> (offset, length), least recently used first
+        self._live_bytes = 0
+        self._end = 0
+        self._map = None
+        self._file = None
+        self._lock = threading.RLock()
+        self._lock_file = open(f"{path}.lock", "a+b")
+        with self._file_lock():
+            self._evict()
+
+    @contextmanager
+    def _file_lock(self):
+        """Hold the cross-process write lock, with this instance synced to the file on disk."""
+        with self._lock:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self._sync()
+                yield
+            finally:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _sync(self):
+        open(self.path, "ab").close()
+        if self._file is None or os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino:
+            # First open, or another process compacted the file: index it from the start.
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path, "r+b")
+            self._index = OrderedDict()
+            self._live_bytes = 0
+            self._end = 0
+            self._map = None
+        self._load_index()
+
+    def _remap(self):
+        size = os.fstat(self._file.fileno()).st_size
+        # Replaced maps are not closed explicitly: views handed out by get() keep them alive.
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+    def _load_index(self):
+        """Index the records from self._end to the end of the file (all of them on first open)."""
+        if os.fstat(self._file.fileno()).st_size == self._end:
+            return
+        self._remap()
+        size = len(self._map) if self._map is not None else 0
+        offset = self._end
+        while offset + RECORD_HEADER.size <= size:
+            id_length, length = RECORD_HEADER.unpack_from(self._map, offset)
+            start = offset + RECORD_HEADER.size + id_length
+            if start + length > size:
+                break
+            image_id = bytes(self._map[offset + RECORD_HEADER.size:start]).decode("utf-8")
+            self._add(image_id, start, length)
+            offset = start + length
+        if offset < size:
+            # Drop a torn record left behind by an interrupted append (appends hold the lock, so none is running).
+            self._file.truncate(offset)
+            self._remap()
+        self._end = offset
+
+    def _add(self, image_id, offset, length):
+        previous = self._index.pop(image_id, None)
+        if previous is not None:
+            self._live_bytes -= previous[1]
+        self._index[image_id] = (offset, length)
+        self._live_bytes += length
+
+    def _evict(self):
+        while self._live_bytes > self.max_bytes and self._index:
+            _, (_, length) = self._index.popitem(last=False)
+            self._live_bytes -= length
+            self.evictions += 1
+        if self._end > 2 * max(self._live_bytes, 1) and self._end > self.max_bytes:
+            self._compact()
+
+    def compact(self):
+        """Rewrite the pack file with only the live entries, keeping their LRU order."""
+        with self._file_lock():
+            self._compact()
+
+    def _compact(self):
+        self._remap()
+        tmp_path = f"{self.path}.tmp"
+        entries = []
+        offset = 0
+        with open(tmp_path, "wb") as out:
+            for image_id, (start, length) in self._index.items():
+                key = image_id.encode("utf-8")
+                out.write(RECORD_HEADER.pack(len(key), length) + key)
+                out.write(self._map[start:start + length])
+                offset += RECORD_HEADER.size + len(key)
+                entries.append((image_id, offset, length))
+                offset += length
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "r+b")
+        self._index = OrderedDict((image_id, (start, length)) for image_id, start, length in entries)
+        self._end = offset
+        self._remap()
+
+    def get(self, image_id):
+        """Return a zero-copy memoryview of the cached payload, or None on a miss."""
+        with self._lock:
+            entry = self._index.get(image_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._index.move_to_end(image_id)
+            self.hits += 1
+            offset, length = entry
+            if self._map is None or offset + length > len(self._map):
+                self._remap()
+            return memoryview(self._map)[offset:offset + length]
+
+    def put(self, image_id, payload):
+        payload = bytes(payload)
+        if len(payload) > self.max_bytes:
+            return
+        with self._file_lock():
+            if image_id in self._index:
+                self._index.move_to_end(image_id)
+                return
+            key = image_id.encode("utf-8")
+            self._end = self._file.seek(0, os.SEEK_END)
+            self._file.write(RECORD_HEADER.pack(len(key), len(payload)) + key)
+            self._file.write(payload)
+            self._file.flush()
+            start = self._end + RECORD_HEADER.size + len(key)
+            self._end = start + len(payload)
+            self._add(image_id, start, len(payload))
+            self._evict()
+
+    def get_or_load(self, image_id, loader):
+        """Serve image_id from the cache, or call loader() once and cache what it returns."""
+        cached = self.get(image_id)
+        if cached is not None:
+            return cached
+        payload = loader()
+        if payload is not None:
+            self.put(image_id, payload)
+        return payload
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._index),
+                "live_bytes": self._live_bytes,
+                "file_bytes": self._end,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+    def __contains__(self, image_id):
+        return image_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._lock_file.close()
+            self._map = None
@@ -1,11 +1,119 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import Callable, Optional, Union
 
-@dataclass
-class ImageStructure:
+import numpy as np
+
+Payload = Union[bytes, memoryview]
+
+
+class _LazyPayload:
+    __slots__ = ()
+
+    def load_image(self) -> Optional[Payload]:
+        """Return the payload, fetching it through the loader on first use when it was selected lazily."""
+        if self.image is None and self.loader is not None:
+            # object.__setattr__ so that frozen records can cache the payload too.
+            object.__setattr__(self, "image", self.loader())
+            object.__setattr__(self, "loader", None)
+        return self.image
+
+
+@dataclass(slots=True)
+class ImageStructure(_LazyPayload):
+    id: str
+    title: str
+    batch_name: str
+    url: str
+    downloaded_at: datetime
+    image: Optional[Payload] = None
+    label_name: Optional[str] = None
+    loader: Optional[Callable[[], Payload]] = field(default=None, repr=False, compare=False)
+
+
+@dataclass(slots=True, frozen=True)
+class FrozenImageStructure(_LazyPayload):
+    """Immutable, hashable ImageStructure; only the lazily loaded payload is filled in after creation."""
     id: str
     title: str
     batch_name: str
     url: str
     downloaded_at: datetime
-    image: bytes
+    image: Optional[Payload] = field(default=None, compare=False)
+    label_name: Optional[str] = None
+    loader: Optional[Callable[[], Payload]] = field(default=None, repr=False, compare=False)
+
+
+class ImageBatch:
+    """
+    Columnar container for many images.
+
+    Metadata is kept in NumPy arrays (one per column, timestamps as
+    datetime64[us]) and all payloads are packed into one buffer addressed by
+    an offsets array, so a batch of N images costs a handful of objects
+    instead of N records. payload(i) is a zero-copy memoryview into the buffer
+    (empty for rows without a payload).
+    """
+
+    __slots__ = ("ids", "titles", "batch_names", "urls", "downloaded_at", "offsets", "buffer")
+
+    def __init__(self, ids, titles, batch_names, urls, downloaded_at, offsets, buffer):
+        self.ids = ids
+        self.titles = titles
+        self.batch_names = batch_names
+        self.urls = urls
+        self.downloaded_at = downloaded_at
+        self.offsets = offsets
+        self.buffer = buffer
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build a batch from (id, title, batch_name, url, downloaded_at, image, ...) rows; payloads are copied once."""
+        columns = ([], [], [], [], [])
+        offsets = [0]
+        buffer = bytearray()
+        for row in rows:
+            for column, value in zip(columns, row):
+                column.append(value)
+            if row[5] is not None:
+                buffer += row[5]
+            offsets.append(len(buffer))
+        ids, titles, batch_names, urls, downloaded_at = columns
+        return cls(
+            ids=np.array([str(image_id) for image_id in ids], dtype=str),
+            titles=np.array(titles, dtype=str),
+            batch_names=np.array(batch_names, dtype=str),
+            urls=np.array(urls, dtype=str),
+            downloaded_at=np.array(downloaded_at, dtype="datetime64[us]"),
+            offsets=np.array(offsets, dtype=np.int64),
+            buffer=buffer,
+        )
+
+    @classmethod
+    def from_images(cls, images):
+        return cls.from_rows((image.id, image.title, image.batch_name, image.url, image.downloaded_at,
+                              image.load_image()) for image in images)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def payload(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return memoryview(self.buffer)[start:end]
+
+    def __getitem__(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError("ImageBatch index out of range")
+        index %= len(self)
+        timestamp = self.downloaded_at[index]
+        return FrozenImageStructure(
+            id=str(self.ids[index]),
+            title=str(self.titles[index]),
+            batch_name=str(self.batch_names[index]),
+            url=str(self.urls[index]),
+            downloaded_at=None if np.isnat(timestamp) else timestamp.astype(datetime),
+            image=self.payload(index),
+        )
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
@@ -0,0 +1,141 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+METRIC_PREFIX = "cifar"
+
+
+class Metrics:
+    """
+    Process-wide stage timers and counters.
+
+    timer(stage) accumulates calls, seconds and items per stage; count(name)
+    adds to a plain counter. Both are thread-safe and cheap enough to leave on
+    permanently. When a JSON log is configured every timed call is also
+    written as one JSON line; summary(), write_json() and write_prometheus()
+    export the totals.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+        self._log = None
+        self._owns_log = False
+
+    def configure(self, json_log=None):
+        """Send a JSON line per timed call to json_log: a path, "-" for stderr, or None to stop."""
+        with self._lock:
+            if self._owns_log:
+                self._log.close()
+            if json_log is None:
+                self._log, self._owns_log = None, False
+            elif json_log == "-":
+                self._log, self._owns_log = sys.stderr, False
+            else:
+                self._log, self._owns_log = open(json_log, "a", buffering=1), True
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._counters.clear()
+
+    def _emit(self, record):
+        if self._log is not None:
+            self._log.write(json.dumps(record) + "\n")
+
+    @contextmanager
+    def timer(self, stage, items=0, **fields):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started, items, **fields)
+
+    def observe(self, stage, seconds, items=0, **fields):
+        with self._lock:
+            totals = self._stages.setdefault(stage, {"calls": 0, "seconds": 0.0, "items": 0, "max_seconds": 0.0})
+            totals["calls"] += 1
+            totals["seconds"] += seconds
+            totals["items"] += items
+            totals["max_seconds"] = max(totals["max_seconds"], seconds)
+            self._emit({"ts": time.time(), "event": "stage", "stage": stage, "seconds": round(seconds, 6),
+                        "items": items, **fields})
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self):
+        with self._lock:
+            return {
+                "stages": {stage: dict(totals) for stage, totals in self._stages.items()},
+                "counters": dict(self._counters),
+            }
+
+    def log_summary(self):
+        summary = self.summary()
+        with self._lock:
+            self._emit({"ts": time.time(), "event": "summary", **summary})
+        return summary
+
+    def render_prometheus(self):
+        """Totals in the Prometheus text exposition format."""
+        summary = self.summary()
+        lines = []
+        for metric, key, kind, help_text in (
+            ("stage_seconds_total", "seconds", "counter", "Time spent in each stage."),
+            ("stage_calls_total", "calls", "counter", "Timed calls per stage."),
+            ("stage_items_total", "items", "counter", "Items processed per stage."),
+            ("stage_max_seconds", "max_seconds", "gauge", "Slowest single call per stage."),
+        ):
+            name = f"{METRIC_PREFIX}_{metric}"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for stage, totals in sorted(summary["stages"].items()):
+                lines.append(f'{name}{{stage="{stage}"}} {totals[key]}')
+        for counter, value in sorted(summary["counters"].items()):
+            name = f"{METRIC_PREFIX}_{counter}_total"
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write the totals for the node_exporter textfile collector (atomically, as it expects)."""
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+    def write_json(self, path):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+metrics = Metrics()
+timer = metrics.timer
+count = metrics.count
+
+
+@contextmanager
+def profiled(path=None):
+    """
+    Run the block under cProfile and dump the stats to path (open with
+    pstats or snakeviz). A no-op when path is None, so callers can always wrap.
+    """
+    if path is None:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+        print(f"Profile written to {path}")
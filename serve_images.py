@@ -0,0 +1,163 @@
+import argparse
+import asyncio
+import re
+import uuid
+
+from aiohttp import web
+
+from database import create_async_pool, select_images_sql, image_from_row
+from metrics import metrics
+
+SELECT_BY_ID_SQL = """
+    SELECT t.id, t.title, t.batch_name, t.url, t.downloaded_at, COALESCE(t.image, b.image) AS image, t.image_path,
+           t.label_name
+    FROM tb_images t
+    LEFT JOIN tb_image_blobs b ON b.id = t.id
+    WHERE t.id = $1;
+"""
+# Rows never change once stored, so an image can be cached for as long as clients like.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MAX_SAMPLE_SIZE = 1000
+POOL = web.AppKey("pool", object)
+
+
+def to_numbered_params(sql, names):
+    """Rewrite psycopg2 %(name)s placeholders as asyncpg $1, $2, ... in the order of names."""
+    for position, name in enumerate(names, start=1):
+        sql = sql.replace(f"%({name})s", f"${position}")
+    return sql
+
+
+SAMPLE_PARAMS = ("n", "probes", "batch_name")
+SAMPLE_SQL = to_numbered_params(select_images_sql(lazy=False), SAMPLE_PARAMS)
+SAMPLE_METADATA_SQL = to_numbered_params(select_images_sql(lazy=True), SAMPLE_PARAMS)
+
+
+def content_type(payload):
+    if payload[:8] == b"\x89PNG\r\n\x1a\n":
+        return "image/png"
+    if payload[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    if payload[:4] == b"RIFF" and payload[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def etag_for(image_id):
+    return f'"{image_id}"'
+
+
+def not_modified(request, etag):
+    if_none_match = request.headers.get("If-None-Match", "")
+    return etag in re.split(r"\s*,\s*", if_none_match) or if_none_match.strip() == "*"
+
+
+def image_response(image, cache_control):
+    payload = bytes(image.image)
+    return web.Response(body=payload, content_type=content_type(payload), headers={
+        "ETag": etag_for(image.id),
+        "Cache-Control": cache_control,
+        "Content-Location": f"/images/{image.id}",
+    })
+
+
+async def to_image(row, lazy=False):
+    if not lazy and row[5] is None and row[6]:
+        # File-layout payloads are read off the event loop.
+        return await asyncio.to_thread(image_from_row, row)
+    return image_from_row(row, lazy=lazy)
+
+
+async def sample(pool, n, batch_name, lazy):
+    with metrics.timer("serve_sample_query", items=n):
+        rows = await pool.fetch(SAMPLE_METADATA_SQL if lazy else SAMPLE_SQL, n, max(2 * n, n + 32), batch_name)
+    return [await to_image(row, lazy) for row in rows]
+
+
+async def random_image(request):
+    """
+    GET /images/random[?batch=...][&n=...]
+
+    Without n the body is one random image. With n it is a JSON list of up to
+    n distinct random images (metadata and a link to /images/{id}), so the
+    payloads themselves are fetched through the cacheable per-id endpoint.
+    """
+    pool = request.app[POOL]
+    batch_name = request.query.get("batch")
+    if "n" in request.query:
+        try:
+            n = int(request.query["n"])
+        except ValueError:
+            raise web.HTTPBadRequest(text="n must be an integer")
+        if not 1 <= n <= MAX_SAMPLE_SIZE:
+            raise web.HTTPBadRequest(text=f"n must be between 1 and {MAX_SAMPLE_SIZE}")
+        images = await sample(pool, n, batch_name, lazy=True)
+        return web.json_response([{
+            "id": image.id,
+            "title": image.title,
+            "batch_name": image.batch_name,
+            "url": image.url,
+            "label_name": image.label_name,
+            "downloaded_at": image.downloaded_at.isoformat() if image.downloaded_at else None,
+            "href": f"/images/{image.id}",
+        } for image in images], headers={"Cache-Control": "no-store"})
+
+    images = await sample(pool, 1, batch_name, lazy=False)
+    if not images:
+        raise web.HTTPNotFound(text="No images stored")
+    # The choice is random per request, so only the per-id resource may be cached.
+    return image_response(images[0], "no-store")
+
+
+async def image_by_id(request):
+    """GET /images/{id}: answered with 304 straight from If-None-Match, without touching the database."""
+    image_id = request.match_info["id"]
+    etag = etag_for(image_id)
+    if not_modified(request, etag):
+        metrics.count("serve_not_modified")
+        return web.Response(status=304, headers={"ETag": etag, "Cache-Control": IMMUTABLE_CACHE_CONTROL})
+    try:
+        key = uuid.UUID(image_id)
+    except ValueError:
+        raise web.HTTPNotFound(text=f"Image {image_id} not found")
+    with metrics.timer("serve_by_id_query"):
+        row = await request.app[POOL].fetchrow(SELECT_BY_ID_SQL, key)
+    if row is None:
+        raise web.HTTPNotFound(text=f"Image {image_id} not found")
+    return image_response(await to_image(row), IMMUTABLE_CACHE_CONTROL)
+
+
+async def metrics_endpoint(request):
+    """GET /metrics: stage timers and counters of this process in Prometheus text format."""
+    return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8",
+                        headers={"Cache-Control": "no-store"})
+
+
+def create_app(pool=None, pool_size=10):
+    """Build the application; without a pool one is created from db_config.json on startup."""
+    app = web.Application()
+    app.router.add_get("/images/random", random_image)
+    app.router.add_get("/images/{id}", image_by_id)
+    app.router.add_get("/metrics", metrics_endpoint)
+
+    async def open_pool(app):
+        app[POOL] = pool if pool is not None else await create_async_pool(max_size=pool_size)
+        yield
+        if pool is None:
+            await app[POOL].close()
+
+    app.cleanup_ctx.append(open_pool)
+    return app
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve images from PostgreSQL over HTTP.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--pool-size", type=int, default=10, help="maximum database connections")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    web.run_app(create_app(pool_size=args.pool_size), host=args.host, port=args.port)
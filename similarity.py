@@ -0,0 +1,157 @@
+import argparse
+import os
+import uuid
+
+import numpy as np
+
+from database import get_connection
+from download_images import perceptual_hash
+from metrics import metrics
+
+INDEX_PATH = "phash_index"
+# Hashes compared per step of a search, bounding the (queries x chunk) distance matrix.
+SEARCH_CHUNK = 1 << 20
+# Bits set in every byte value, for NumPy < 2.0 where np.bitwise_count does not exist.
+BYTE_POPCOUNT = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def popcount64(values):
+    """Bits set in each element of a uint64 array, as uint8."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    values = np.ascontiguousarray(values)
+    return BYTE_POPCOUNT[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+
+def hamming_distances(queries, hashes):
+    """(Q, N) matrix of bit differences between each query hash and each stored hash."""
+    queries = np.asarray(queries, dtype=np.int64).view(np.uint64)
+    hashes = np.asarray(hashes, dtype=np.int64).view(np.uint64)
+    return popcount64(queries[:, None] ^ hashes[None, :])
+
+
+def build_index(conn, path=INDEX_PATH, itersize=100_000):
+    """
+    Dump every stored phash to <path>.npy (int64) and the matching ids to <path>.ids.npy.
+
+    Rows stream through a server-side cursor in seq order and only the two
+    small columns are read, never a payload. Rows without a phash (stored
+    before hashes were computed) are left out. Returns the number of hashes.
+    """
+    hashes, ids = [], []
+    with metrics.timer("phash_index_build"), conn.cursor(name=f"phash_index_{uuid.uuid4().hex}") as cur:
+        cur.itersize = itersize
+        cur.execute("SELECT id, phash FROM tb_images WHERE phash IS NOT NULL ORDER BY seq;")
+        for image_id, phash in cur:
+            ids.append(str(image_id))
+            hashes.append(phash)
+    for suffix, array in ((".npy", np.array(hashes, dtype=np.int64)), (".ids.npy", np.array(ids, dtype="U36"))):
+        tmp_path = f"{path}{suffix}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
+        os.replace(tmp_path, f"{path}{suffix}")
+    print(f"Indexed {len(hashes)} perceptual hashes into {path}.npy")
+    return len(hashes)
+
+
+def _top_k(distances, k):
+    """
+    Column indexes of the k smallest distances in each row.
+
+    Distances only take the values 0..64, so a 65-bin histogram gives the
+    k-th smallest distance directly; that beats a partition of the whole row.
+    Ties at the cut-off keep the lowest positions.
+    """
+    if distances.shape[1] <= k:
+        return np.broadcast_to(np.arange(distances.shape[1]), distances.shape)
+    nearest = np.empty((len(distances), k), dtype=np.int64)
+    for row, row_distances in enumerate(distances):
+        cutoff = np.searchsorted(np.cumsum(np.bincount(row_distances, minlength=65)), k)
+        closer = np.flatnonzero(row_distances < cutoff)
+        tied = np.flatnonzero(row_distances == cutoff)[:k - len(closer)]
+        nearest[row] = np.concatenate([closer, tied])
+    return nearest
+
+
+class PhashIndex:
+    """
+    Hamming-distance k-NN over the perceptual hashes written by build_index.
+
+    The hash matrix is memory-mapped, so opening the index is instant and the
+    pages are shared between processes. Searches are batched: every query is
+    compared against every stored hash with one XOR and popcount per chunk,
+    8 bytes per image, which scans a million images in milliseconds.
+    """
+
+    def __init__(self, path=INDEX_PATH):
+        self.hashes = np.load(f"{path}.npy", mmap_mode="r")
+        self.ids = np.load(f"{path}.ids.npy", mmap_mode="r")
+        self._positions = None
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def search(self, queries, k=10, max_distance=None):
+        """
+        Return, for each query hash, a list of (id, distance) for its k nearest stored images.
+
+        Results are sorted by distance; max_distance drops anything further away.
+        """
+        queries = np.atleast_1d(np.asarray(queries, dtype=np.int64))
+        best_distances = np.empty((len(queries), 0), dtype=np.uint8)
+        best_positions = np.empty((len(queries), 0), dtype=np.int64)
+        if k > 0:
+            with metrics.timer("phash_search", items=len(queries)):
+                for start in range(0, len(self.hashes), SEARCH_CHUNK):
+                    distances = hamming_distances(queries, self.hashes[start:start + SEARCH_CHUNK])
+                    positions = _top_k(distances, k)
+                    best_distances = np.concatenate(
+                        [best_distances, np.take_along_axis(distances, positions, axis=1)], axis=1)
+                    best_positions = np.concatenate([best_positions, positions + start], axis=1)
+                    keep = _top_k(best_distances, k)
+                    best_distances = np.take_along_axis(best_distances, keep, axis=1)
+                    best_positions = np.take_along_axis(best_positions, keep, axis=1)
+        order = np.argsort(best_distances, axis=1, kind="stable")
+        best_distances = np.take_along_axis(best_distances, order, axis=1)
+        best_positions = np.take_along_axis(best_positions, order, axis=1)
+        return [
+            [(str(self.ids[position]), int(distance)) for position, distance in zip(positions, distances)
+             if max_distance is None or distance <= max_distance]
+            for positions, distances in zip(best_positions, best_distances)
+        ]
+
+    def search_pixels(self, pixels, k=10, max_distance=None):
+        """Search with raw CIFAR pixel rows ((N, 3072) or one 3072-byte row) instead of hashes."""
+        return self.search(perceptual_hash(pixels), k, max_distance)
+
+    def similar_to(self, image_id, k=10, max_distance=None):
+        """Neighbours of an image that is already in the index (the image itself comes first, at distance 0)."""
+        if self._positions is None:
+            self._positions = {str(image_id): position for position, image_id in enumerate(self.ids)}
+        position = self._positions.get(str(image_id))
+        if position is None:
+            raise KeyError(f"Image {image_id} is not in the index")
+        return self.search(self.hashes[position], k, max_distance)[0]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query the perceptual-hash similarity index.")
+    parser.add_argument("--index", default=INDEX_PATH, help="index path prefix")
+    parser.add_argument("--build", action="store_true", help="rebuild the index from tb_images")
+    parser.add_argument("--similar-to", metavar="IMAGE_ID", help="list the nearest images to this id")
+    parser.add_argument("-k", type=int, default=10, help="number of neighbours")
+    parser.add_argument("--max-distance", type=int, default=None, help="largest Hamming distance to report")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.build:
+        connection = get_connection()
+        try:
+            build_index(connection, args.index)
+        finally:
+            connection.close()
+    if args.similar_to:
+        for neighbour_id, distance in PhashIndex(args.index).similar_to(args.similar_to, args.k, args.max_distance):
+            print(f"{distance:>3}  {neighbour_id}")
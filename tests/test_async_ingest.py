@@ -0,0 +1,138 @@
+import asyncio
+import io
+import pickle
+import tarfile
+import threading
+from contextlib import asynccontextmanager
+
+import numpy as np
+import pytest
+
+import async_ingest
+import database
+import download_images
+
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+        self.staged = []
+
+    async def execute(self, sql):
+        self.pool.statements.append(sql)
+        if "INSERT INTO tb_images" in sql:
+            inserted = len(self.staged)
+            self.pool.inserted.extend(self.staged)
+            self.staged = []
+            return f"INSERT 0 {inserted}"
+        return "CREATE TABLE"
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.pool.copies.append((table, len(records), columns))
+        self.staged = list(records)
+
+    async def fetch(self, sql, hashes):
+        self.pool.lookups.append(len(hashes))
+        return [(h,) for h in hashes if h in self.pool.stored]
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+
+class FakePool:
+    def __init__(self, stored=()):
+        self.stored = set(stored)
+        self.statements = []
+        self.copies = []
+        self.lookups = []
+        self.inserted = []
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield FakeConnection(self)
+
+
+def make_tar(tmp_path, num_images=7):
+    data = {
+        b"data": np.random.default_rng(0).integers(0, 255, size=(num_images, 3072), dtype=np.uint8),
+        b"filenames": [f"img_{i}.png".encode() for i in range(num_images)],
+        b"batch_label": b"training batch 1 of 5"
+    }
+    payload = pickle.dumps(data)
+    tar_path = tmp_path / "a.tar.gz"
+    with tarfile.open(tar_path, "w:gz") as tar:
+        info = tarfile.TarInfo(name="cifar-10-batches-py/data_batch_1")
+        info.size = len(payload)
+        tar.addfile(info, io.BytesIO(payload))
+    return str(tar_path), data
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    tar_path, data = make_tar(tmp_path)
+    monkeypatch.setattr(async_ingest, "download_image_set", lambda url, filename, **kwargs: tar_path)
+    return data
+
+
+def test_run_pipeline_streams_chunks_into_db(archive, capsys):
+    pool = FakePool()
+    report = asyncio.run(async_ingest.run_pipeline(
+        [("http://example.com/a.tar.gz", "a.tar.gz")], max_images=5, seed=1, chunk_size=2, pool=pool))
+    assert report["inserted"] == 5
+    assert [copy[1] for copy in pool.copies] == [2, 2, 1]
+    assert all(copy[0] == "tb_images_staging" for copy in pool.copies)
+    assert pool.copies[0][2] == list(async_ingest.IMAGE_COLUMNS)
+    assert pool.lookups == [7]
+    row = pool.inserted[0]
+    assert row[3] == "http://example.com/a.tar.gz"
+    assert row[5].startswith(b"\x89PNG")
+    assert [stage["stage"] for stage in report["stages"]] == ["download", "decode", "encode", "write"]
+    assert [stage["items"] for stage in report["stages"]] == [1, 5, 5, 5]
+    assert "images/sec end to end" in capsys.readouterr().out
+
+
+def test_run_pipeline_skips_stored_hashes(archive):
+    stored = {download_images.content_hash(archive[b"data"][i]) for i in range(3)}
+    pool = FakePool(stored)
+    report = asyncio.run(async_ingest.run_pipeline(
+        [("http://example.com/a.tar.gz", "a.tar.gz")], max_images=10, pool=pool))
+    assert report["inserted"] == 4
+    assert {row[1] for row in pool.inserted} == {f"img_{i}.png" for i in range(3, 7)}
+
+
+def test_file_layout_payloads_are_written_off_the_event_loop(archive, monkeypatch):
+    writers = []
+    def fake_write(payload, store_dir=database.IMAGE_STORE_DIR):
+        writers.append(threading.current_thread())
+        return f"{store_dir}/fake.png"
+    monkeypatch.setattr(database, "write_payload_file", fake_write)
+    pool = FakePool()
+    asyncio.run(async_ingest.run_pipeline(
+        [("http://example.com/a.tar.gz", "a.tar.gz")], max_images=3, storage="file", pool=pool))
+    assert len(writers) == 3
+    assert threading.main_thread() not in writers
+    assert all(row[5] is None and row[7].endswith("fake.png") for row in pool.inserted)
+
+
+def test_run_pipeline_matches_serial_sample(archive):
+    pool = FakePool()
+    asyncio.run(async_ingest.run_pipeline(
+        [("http://example.com/a.tar.gz", "a.tar.gz")], max_images=4, seed=9, chunk_size=3, pool=pool))
+    selected, _ = download_images.sample_images([archive], max_images=4, seed=9)
+    assert [row[1] for row in pool.inserted] == [image["title"] for image in selected]
+
+
+def test_run_pipeline_stage_failure_propagates(monkeypatch):
+    def broken_download(url, filename, **kwargs):
+        raise ValueError("Checksum mismatch")
+    monkeypatch.setattr(async_ingest, "download_image_set", broken_download)
+    with pytest.raises(ExceptionGroup) as excinfo:
+        asyncio.run(async_ingest.run_pipeline([("http://example.com/a.tar.gz", "a.tar.gz")], pool=FakePool()))
+    assert excinfo.group_contains(ValueError)
+
+
+def test_create_pool_requires_asyncpg(monkeypatch):
+    monkeypatch.setattr(database, "asyncpg", None)
+    with pytest.raises(RuntimeError, match="asyncpg"):
+        asyncio.run(async_ingest.run_pipeline([("http://example.com/a.tar.gz", "a.tar.gz")]))
@@ -14,7 +14,7 @@ class TestCreateImagesTable(unittest.TestCase):
         create_table.create_images_table()
 
         mock_get_connection.assert_called_once()
-        mock_create_table.assert_called_once_with(mock_conn)
+        mock_create_table.assert_called_once_with(mock_conn, partitioned=False)
         mock_conn.close.assert_called_once()
 
     @patch('create_table.create_table', side_effect=Exception("DB Error"))
@@ -28,11 +28,22 @@ class TestCreateImagesTable(unittest.TestCase):
             output = fake_out.getvalue()
 
         mock_get_connection.assert_called_once()
-        mock_create_table.assert_called_once_with(mock_conn)
+        mock_create_table.assert_called_once_with(mock_conn, partitioned=False)
         mock_conn.close.assert_called_once()
 
         self.assertIn("Error creating table: DB Error", output)
 
+    @patch('create_table.drop_batch')
+    @patch('create_table.get_connection')
+    def test_drop_image_batch(self, mock_get_connection, mock_drop_batch):
+        mock_conn = MagicMock()
+        mock_get_connection.return_value = mock_conn
+
+        create_table.drop_image_batch("data_batch_1")
+
+        mock_drop_batch.assert_called_once_with(mock_conn, "data_batch_1")
+        mock_conn.close.assert_called_once()
+
 
 if __name__ == '__main__':
     unittest.main()
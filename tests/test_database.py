@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock, mock_open
 import psycopg2
@@ -8,6 +10,10 @@ from image_structure import ImageStructure
 
 
 class TestDatabase(unittest.TestCase):
+    def setUp(self):
+        database.clear_db_config_cache()
+        self.addCleanup(database.clear_db_config_cache)
+
     @patch("builtins.open", new_callable=mock_open, read_data='{"host": "localhost", "user": "test"}')
     def test_load_db_config(self, mock_file):
         config = database.load_db_config("dummy_path.json")
@@ -25,6 +31,24 @@ class TestDatabase(unittest.TestCase):
         mock_connect.assert_called_once_with(host="localhost")
         self.assertEqual(result, conn)
 
+    @patch("database.load_db_config")
+    @patch("psycopg2.connect")
+    def test_get_connection_caches_config(self, mock_connect, mock_load_db_config):
+        mock_load_db_config.return_value = {"host": "localhost"}
+        database.get_connection()
+        database.get_connection()
+        mock_load_db_config.assert_called_once_with("db_config.json")
+        self.assertEqual(mock_connect.call_count, 2)
+
+    @patch.dict("os.environ", {"PGHOST": "db.internal", "PGPORT": "6543"})
+    @patch("database.load_db_config")
+    def test_get_db_config_env_overrides(self, mock_load_db_config):
+        mock_load_db_config.return_value = {"host": "localhost", "port": 5433, "user": "test"}
+        config = database.get_db_config()
+        self.assertEqual(config, {"host": "db.internal", "port": "6543", "user": "test"})
+        config["user"] = "changed"
+        self.assertEqual(database.get_db_config()["user"], "test")
+
     @patch("uuid.uuid4")
     def test_insert_image_record(self, mock_uuid):
         mock_uuid.return_value = uuid.UUID("12345678123456781234567812345678")
@@ -36,26 +60,145 @@ class TestDatabase(unittest.TestCase):
             "batch_name": "Batch1",
             "url": "http://example.com/image.jpg",
             "downloaded_at": datetime(2024, 1, 1, 12, 0, 0),
-            "image": b"binarydata"
+            "image": b"binarydata",
+            "content_hash": b"hash"
         }
         database.insert_image_record(conn, image_record)
         cur.execute.assert_called_once()
         args, kwargs = cur.execute.call_args
         self.assertIn("INSERT INTO tb_images", args[0])
-        self.assertEqual(args[1][0], str(mock_uuid.return_value))
+        self.assertIn("ON CONFLICT DO NOTHING", args[0])
+        self.assertEqual(args[1][0], mock_uuid.return_value)
         self.assertEqual(args[1][1], image_record["title"])
         self.assertEqual(args[1][2], image_record["batch_name"])
         self.assertEqual(args[1][3], image_record["url"])
         self.assertEqual(args[1][4], image_record["downloaded_at"])
         self.assertIsInstance(args[1][5], psycopg2.Binary)
+        self.assertIsInstance(args[1][6], psycopg2.Binary)
+        conn.commit.assert_called_once()
+
+    def test_existing_hashes(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        cur.fetchall.return_value = [(memoryview(b"h1"),)]
+        result = database.existing_hashes(conn, [b"h1", b"h2"])
+        self.assertEqual(result, {b"h1"})
+        query, params = cur.execute.call_args[0]
+        self.assertIn("content_hash = ANY(%s)", query)
+        self.assertEqual(len(params[0]), 2)
+
+    def test_existing_hashes_empty(self):
+        conn = MagicMock()
+        self.assertEqual(database.existing_hashes(conn, []), set())
+        conn.cursor.assert_not_called()
+
+    def _bulk_records(self, count):
+        return [
+            {
+                "title": f"img_{i}.png",
+                "batch_name": "Batch1",
+                "url": "http://example.com/set.tar.gz",
+                "downloaded_at": datetime(2024, 1, 1, 12, 0, 0),
+                "image": b"binarydata",
+                "content_hash": bytes([i])
+            }
+            for i in range(count)
+        ]
+
+    def test_build_copy_buffer(self):
+        row = ("id1", "title", datetime(2000, 1, 1, 0, 0, 1), b"\x00\x01")
+        payload = database.build_copy_buffer([row]).getvalue()
+        self.assertTrue(payload.startswith(database.COPY_BINARY_SIGNATURE))
+        self.assertTrue(payload.endswith(b"\xff\xff"))
+        self.assertIn(b"\x00\x04\x00\x00\x00\x03id1", payload)
+        self.assertIn(b"\x00\x00\x00\x08\x00\x00\x00\x00\x00\x0f\x42\x40", payload)
+        self.assertIn(b"\x00\x00\x00\x02\x00\x01", payload)
+
+    def test_insert_images_bulk_copy_commits_per_batch(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        cur.rowcount = 2
+        conn.cursor.return_value.__enter__.return_value = cur
+        with patch("builtins.print") as mock_print:
+            inserted = database.insert_images_bulk(conn, iter(self._bulk_records(5)), batch_size=2)
+        self.assertEqual(inserted, 6)
+        self.assertEqual(cur.copy_expert.call_count, 3)
+        self.assertIn("COPY tb_images_staging", cur.copy_expert.call_args[0][0])
+        self.assertIn("FORMAT binary", cur.copy_expert.call_args[0][0])
+        merge = cur.execute.call_args[0][0]
+        self.assertIn("INSERT INTO tb_images", merge)
+        self.assertIn("ON CONFLICT DO NOTHING", merge)
+        self.assertEqual(conn.commit.call_count, 3)
+        self.assertIn("rows/sec", mock_print.call_args[0][0])
+
+    def test_insert_images_bulk_reports_skipped_duplicates(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        cur.rowcount = 1
+        conn.cursor.return_value.__enter__.return_value = cur
+        with patch("builtins.print") as mock_print:
+            inserted = database.insert_images_bulk(conn, self._bulk_records(3))
+        self.assertEqual(inserted, 1)
+        self.assertIn("2 duplicates skipped", mock_print.call_args[0][0])
+
+    @patch("psycopg2.extras.execute_values")
+    def test_insert_images_bulk_execute_values_fallback(self, mock_execute_values):
+        conn = MagicMock()
+        cur = MagicMock()
+        cur.rowcount = 3
+        conn.cursor.return_value.__enter__.return_value = cur
+        with patch("builtins.print"):
+            inserted = database.insert_images_bulk(conn, self._bulk_records(3), batch_size=10, use_copy=False)
+        self.assertEqual(inserted, 3)
+        mock_execute_values.assert_called_once()
+        args, kwargs = mock_execute_values.call_args
+        self.assertIn("INSERT INTO tb_images_staging", args[1])
+        self.assertIn("ON CONFLICT DO NOTHING", cur.execute.call_args[0][0])
+        self.assertEqual(len(args[2]), 3)
+        self.assertIsInstance(args[2][0][5], psycopg2.Binary)
+        cur.copy_expert.assert_not_called()
         conn.commit.assert_called_once()
 
+    def test_insert_images_bulk_blob_layout(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        cur.rowcount = 2
+        conn.cursor.return_value.__enter__.return_value = cur
+        with patch("builtins.print"):
+            database.insert_images_bulk(conn, self._bulk_records(2), storage="blob")
+        merge = cur.execute.call_args[0][0]
+        self.assertIn("INSERT INTO tb_image_blobs", merge)
+        self.assertIn("RETURNING id", merge)
+        self.assertIn("SELECT s.id, s.title, s.batch_name, s.url, s.downloaded_at, NULL,", merge)
+
+    def test_insert_images_bulk_file_layout(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        cur.rowcount = 1
+        conn.cursor.return_value.__enter__.return_value = cur
+        with tempfile.TemporaryDirectory() as store_dir, patch("database.build_copy_buffer") as mock_buffer:
+            with patch("builtins.print"):
+                database.insert_images_bulk(conn, self._bulk_records(1), storage="file", store_dir=store_dir)
+            row = mock_buffer.call_args[0][0][0]
+            self.assertIsNone(row[5])
+            self.assertEqual(database.read_payload_file(row[7]), b"binarydata")
+        self.assertNotIn("tb_image_blobs", cur.execute.call_args[0][0])
+
+    def test_insert_images_bulk_rejects_unknown_storage(self):
+        with self.assertRaises(ValueError):
+            database.insert_images_bulk(MagicMock(), [], storage="s3")
+
+    def test_insert_images_bulk_rejects_bad_batch_size(self):
+        with self.assertRaises(ValueError):
+            database.insert_images_bulk(MagicMock(), [], batch_size=0)
+
     def test_select_image(self):
         conn = MagicMock()
         cur = MagicMock()
         conn.cursor.return_value.__enter__.return_value = cur
-        # Simulate DB row: id, title, batch_name, url, downloaded_at, image
-        row = ("id123", "title1", "batchA", "http://url", datetime(2024, 1, 1, 12, 0, 0), b"imgdata")
+        # Simulate DB row: id, title, batch_name, url, downloaded_at, image, image_path
+        row = ("id123", "title1", "batchA", "http://url", datetime(2024, 1, 1, 12, 0, 0), b"imgdata", None)
         cur.fetchone.return_value = row
         gen = database.select_image(conn)
         result = next(gen)
@@ -67,6 +210,58 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(result.downloaded_at, row[4])
         self.assertEqual(result.image, row[5])
 
+    def test_select_image_probes_seq_index(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        cur.fetchone.return_value = None
+        list(database.select_image(conn))
+        query = cur.execute.call_args[0][0]
+        self.assertNotIn("ORDER BY RANDOM()", query)
+        self.assertIn("WHERE t.seq >=", query)
+        self.assertIn("ORDER BY t.seq", query)
+        self.assertIn("LEFT JOIN tb_image_blobs", query)
+
+    def test_select_image_lazy_skips_payload(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        cur.fetchone.side_effect = [
+            ("id1", "t", "b", "http://url", datetime(2024, 1, 1), None, None),
+            (b"blobdata", None),
+        ]
+        image = next(database.select_image(conn, lazy=True))
+        query = cur.execute.call_args[0][0]
+        self.assertIn("NULL::bytea AS image", query)
+        self.assertNotIn("tb_image_blobs", query)
+        self.assertIsNone(image.image)
+        self.assertEqual(image.load_image(), b"blobdata")
+        self.assertIn("tb_image_blobs", cur.execute.call_args[0][0])
+        self.assertEqual(cur.execute.call_args[0][1], ("id1",))
+        self.assertEqual(image.load_image(), b"blobdata")
+        self.assertEqual(cur.execute.call_count, 2)
+
+    def test_select_image_reads_file_payload(self):
+        with tempfile.TemporaryDirectory() as store_dir:
+            path = database.write_payload_file(b"filedata", store_dir)
+            conn = MagicMock()
+            cur = MagicMock()
+            conn.cursor.return_value.__enter__.return_value = cur
+            cur.fetchone.return_value = ("id1", "t", "b", "http://url", datetime(2024, 1, 1), None, path)
+            self.assertEqual(next(database.select_image(conn)).image, b"filedata")
+            lazy = next(database.select_image(conn, lazy=True))
+            self.assertEqual(lazy.load_image(), b"filedata")
+
+    def test_write_payload_file_is_content_addressed(self):
+        with tempfile.TemporaryDirectory() as store_dir:
+            first = database.write_payload_file(b"payload", store_dir)
+            second = database.write_payload_file(b"payload", store_dir)
+            other = database.write_payload_file(b"other", store_dir)
+            self.assertEqual(first, second)
+            self.assertNotEqual(first, other)
+            self.assertTrue(first.startswith(os.path.abspath(store_dir)))
+            self.assertEqual(database.read_payload_file(first), b"payload")
+
     def test_select_image_none(self):
         conn = MagicMock()
         cur = MagicMock()
@@ -76,6 +271,109 @@ class TestDatabase(unittest.TestCase):
         with self.assertRaises(StopIteration):
             next(gen)
 
+    def test_select_images_streams_through_named_cursor(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        rows = [
+            ("id1", "t1", "batchA", "http://url", datetime(2024, 1, 1), b"img1", None),
+            ("id2", "t2", "batchA", "http://url", datetime(2024, 1, 1), b"img2", None),
+        ]
+        cur.__iter__.return_value = iter(rows)
+        result = list(database.select_images(conn, 2, batch_name="batchA", itersize=100))
+        self.assertEqual([image.id for image in result], ["id1", "id2"])
+        self.assertIsInstance(result[0], ImageStructure)
+        self.assertTrue(conn.cursor.call_args[1]["name"].startswith("select_images_"))
+        self.assertEqual(cur.itersize, 100)
+        query, params = cur.execute.call_args[0]
+        self.assertNotIn("ORDER BY RANDOM() LIMIT 1", query)
+        self.assertEqual(params["n"], 2)
+        self.assertEqual(params["batch_name"], "batchA")
+        self.assertGreaterEqual(params["probes"], 2)
+
+    def test_select_images_seed_sets_session_seed(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        cur.__iter__.return_value = iter([])
+        list(database.select_images(conn, 5, seed=42))
+        first_call = cur.execute.call_args_list[0][0]
+        self.assertIn("setseed", first_call[0])
+        self.assertTrue(-1 <= first_call[1][0] <= 1)
+        cur.execute.reset_mock()
+        cur.__iter__.return_value = iter([])
+        list(database.select_images(conn, 5, seed=42))
+        self.assertEqual(cur.execute.call_args_list[0][0], first_call)
+
+    def test_select_images_frozen(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        cur.__iter__.return_value = iter([("id1", "t1", "batchA", "http://url", datetime(2024, 1, 1), b"img1", None)])
+        result = list(database.select_images(conn, 1, frozen=True))
+        self.assertIsInstance(result[0], database.FrozenImageStructure)
+
+    def test_select_image_batch_packs_payloads(self):
+        with tempfile.TemporaryDirectory() as store_dir:
+            path = database.write_payload_file(b"filedata", store_dir)
+            conn = MagicMock()
+            cur = MagicMock()
+            conn.cursor.return_value.__enter__.return_value = cur
+            cur.__iter__.return_value = iter([
+                ("id1", "t1", "batchA", "http://url", datetime(2024, 1, 1), memoryview(b"img1"), None),
+                ("id2", "t2", "batchA", "http://url", datetime(2024, 1, 1), None, path),
+            ])
+            batch = database.select_image_batch(conn, 2, batch_name="batchA")
+        self.assertEqual(batch.ids.tolist(), ["id1", "id2"])
+        self.assertEqual(batch.buffer, b"img1filedata")
+        self.assertEqual(bytes(batch.payload(1)), b"filedata")
+        self.assertIn("COALESCE(t.image, b.image)", cur.execute.call_args[0][0])
+
+    def test_select_images_zero(self):
+        conn = MagicMock()
+        self.assertEqual(list(database.select_images(conn, 0)), [])
+        conn.cursor.assert_not_called()
+
+    def test_select_stratified_groups_by_class(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        cur.fetchall.return_value = [
+            ("id1", "t1", "batchA", "http://url", datetime(2024, 1, 1), None, None, "apple", "fruit"),
+            ("id2", "t2", "batchA", "http://url", datetime(2024, 1, 1), None, None, "pear", "fruit"),
+            ("id3", "t3", "batchA", "http://url", datetime(2024, 1, 1), None, None, "bear", "mammal"),
+        ]
+        samples = database.select_stratified(conn, 2, labels=["fruit", "mammal"], by="coarse_label_name",
+                                             lazy=True)
+        self.assertEqual({label: [image.id for image in images] for label, images in samples.items()},
+                         {"fruit": ["id1", "id2"], "mammal": ["id3"]})
+        self.assertEqual(samples["fruit"][1].label_name, "pear")
+        query, params = cur.execute.call_args[0]
+        self.assertIn("WITH RECURSIVE classes", query)
+        self.assertIn("t.coarse_label_name > c.class", query)
+        self.assertNotIn("COALESCE(t.image, b.image)", query)
+        self.assertEqual(params["k"], 2)
+        self.assertEqual(params["labels"], ["fruit", "mammal"])
+        self.assertGreaterEqual(params["probes"], 2)
+
+    def test_select_stratified_rejects_unknown_column(self):
+        with self.assertRaises(ValueError):
+            database.select_stratified(MagicMock(), 5, by="title; DROP TABLE tb_images")
+
+    def test_select_stratified_zero(self):
+        conn = MagicMock()
+        self.assertEqual(database.select_stratified(conn, 0), {})
+        conn.cursor.assert_not_called()
+
+    def test_image_row_carries_labels(self):
+        row = database.image_row({
+            "title": "t", "batch_name": "b", "url": "http://url", "downloaded_at": datetime(2024, 1, 1),
+            "image": b"img", "content_hash": b"h",
+            "label": 3, "label_name": "cat", "coarse_label": None, "coarse_label_name": None,
+        })
+        labels = dict(zip(database.IMAGE_COLUMNS, row))
+        self.assertEqual((labels["label"], labels["label_name"]), (3, "cat"))
+
     def test_create_table(self):
         conn = MagicMock()
         cur = MagicMock()
@@ -84,19 +382,227 @@ class TestDatabase(unittest.TestCase):
             database.create_table(conn)
             cur.execute.assert_called_once()
             self.assertIn("CREATE TABLE IF NOT EXISTS tb_images", cur.execute.call_args[0][0])
+            self.assertIn("seq BIGSERIAL", cur.execute.call_args[0][0])
+            self.assertIn("CREATE UNIQUE INDEX IF NOT EXISTS tb_images_seq_idx", cur.execute.call_args[0][0])
+            self.assertIn("CREATE UNIQUE INDEX IF NOT EXISTS tb_images_content_hash_idx", cur.execute.call_args[0][0])
+            self.assertIn("CREATE TABLE IF NOT EXISTS tb_image_blobs", cur.execute.call_args[0][0])
             conn.commit.assert_called_once()
             mock_print.assert_called_with("Table 'tb_images' created successfully (or already exists).")
 
+    def test_create_table_indexes_and_uuid_ids(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        with patch("builtins.print"):
+            database.create_table(conn)
+        query = cur.execute.call_args[0][0]
+        self.assertIn("id UUID NOT NULL", query)
+        self.assertIn("ALTER COLUMN id TYPE UUID USING id::uuid", query)
+        self.assertIn("tb_images_batch_name_idx ON tb_images (batch_name)", query)
+        self.assertIn("USING BRIN (downloaded_at)", query)
+        self.assertIn("tb_images_label_name_seq_idx ON tb_images (label_name, seq)", query)
+        self.assertIn("ADD COLUMN IF NOT EXISTS coarse_label_name TEXT", query)
+        self.assertNotIn("PARTITION BY", query)
+
+    def test_create_table_partitioned(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        with patch("builtins.print"):
+            database.create_table(conn, partitioned=True)
+        query = cur.execute.call_args[0][0]
+        self.assertIn("PARTITION BY LIST (batch_name)", query)
+        self.assertIn("PRIMARY KEY (id, batch_name)", query)
+        self.assertIn("ON tb_images (content_hash, batch_name)", query)
+        self.assertIn("ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS phash BIGINT;", query)
+        for column in ("label SMALLINT", "label_name TEXT", "coarse_label SMALLINT", "coarse_label_name TEXT"):
+            self.assertIn(f"ALTER TABLE tb_images ADD COLUMN IF NOT EXISTS {column};", query)
+        self.assertNotIn("REFERENCES tb_images", query)
+
+    def test_insert_images_bulk_creates_partitions_before_merge(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        cur.rowcount = 1
+        conn.cursor.return_value.__enter__.return_value = cur
+        with patch("builtins.print"):
+            database.insert_images_bulk(conn, self._bulk_records(1))
+        statements = [call[0][0] for call in cur.execute.call_args_list]
+        self.assertEqual(statements[-2], database.CREATE_PARTITIONS_SQL)
+        self.assertIn("INSERT INTO tb_images", statements[-1])
+
+    def test_build_copy_buffer_encodes_bigint(self):
+        payload = database.build_copy_buffer([(-2,)]).getvalue()
+        self.assertIn(b"\x00\x00\x00\x08\xff\xff\xff\xff\xff\xff\xff\xfe", payload)
+
+    def test_build_copy_buffer_encodes_uuid(self):
+        image_id = uuid.UUID("12345678123456781234567812345678")
+        payload = database.build_copy_buffer([(image_id,)]).getvalue()
+        self.assertIn(b"\x00\x00\x00\x10" + image_id.bytes, payload)
+
+    def test_drop_batch_detaches_partition(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        cur.fetchone.return_value = ("tb_images_data_batch_1_0a1b2c3d",)
+        with patch("builtins.print"), patch("psycopg2.extensions.quote_ident", side_effect=lambda name, _: f'"{name}"'):
+            database.drop_batch(conn, "data_batch_1")
+        statements = [call[0][0] for call in cur.execute.call_args_list]
+        self.assertEqual(cur.execute.call_args_list[0][0][1], ("data_batch_1",))
+        self.assertIn('DELETE FROM tb_image_blobs b USING "tb_images_data_batch_1_0a1b2c3d"', statements[1])
+        self.assertEqual(statements[2], 'ALTER TABLE tb_images DETACH PARTITION "tb_images_data_batch_1_0a1b2c3d";')
+        self.assertEqual(statements[3], 'DROP TABLE "tb_images_data_batch_1_0a1b2c3d";')
+        conn.commit.assert_called_once()
+
+    def test_drop_batch_deletes_rows_without_partitions(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        cur.fetchone.return_value = None
+        with patch("builtins.print") as mock_print:
+            database.drop_batch(conn, "data_batch_1")
+        cur.execute.assert_called_with("DELETE FROM tb_images WHERE batch_name = %s;", ("data_batch_1",))
+        conn.commit.assert_called_once()
+        mock_print.assert_called_with("Batch 'data_batch_1' dropped successfully.")
+
+    def test_insert_images_bulk_checkpoint_runs_before_each_commit(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        cur.rowcount = 1
+        conn.cursor.return_value.__enter__.return_value = cur
+        events = []
+        conn.commit.side_effect = lambda: events.append("commit")
+        records = [{"title": f"t{i}", "batch_name": "b", "url": "u", "downloaded_at": None, "image": b"x",
+                    "content_hash": bytes([i]), "member": "data_batch_1"} for i in range(3)]
+        with patch("builtins.print"):
+            database.insert_images_bulk(conn, records, batch_size=2,
+                                        checkpoint=lambda cur, batch: events.append([r["title"] for r in batch]))
+        self.assertEqual(events, [["t0", "t1"], "commit", ["t2"], "commit"])
+
+    @patch("psycopg2.extras.execute_values")
+    def test_save_manifest_replaces_plan_and_commits(self, mock_execute_values):
+        conn = MagicMock()
+        cur = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        database.save_manifest(conn, "a.tar.gz", "http://a", [("data_batch_1", [4, 0]), ("data_batch_2", [])])
+        self.assertIn("DELETE FROM tb_ingest_manifest", cur.execute.call_args[0][0])
+        self.assertEqual(mock_execute_values.call_args[0][2], [
+            ("a.tar.gz", "data_batch_1", 0, "http://a", [4, 0]),
+            ("a.tar.gz", "data_batch_2", 1, "http://a", []),
+        ])
+        conn.commit.assert_called_once()
+
+    def test_load_manifest_orders_members(self):
+        conn = MagicMock()
+        cur = MagicMock()
+        conn.cursor.return_value.__enter__.return_value = cur
+        cur.fetchall.return_value = [("data_batch_1", "http://a", [4, 0], 1)]
+        self.assertEqual(database.load_manifest(conn, "a.tar.gz"),
+                         [{"member": "data_batch_1", "url": "http://a", "positions": [4, 0], "committed": 1}])
+        self.assertIn("ORDER BY ordinal", cur.execute.call_args[0][0])
+
+    def test_advance_manifest_updates_without_committing(self):
+        cur = MagicMock()
+        database.advance_manifest(cur, "a.tar.gz", {"data_batch_1": 3, "data_batch_2": 1})
+        self.assertEqual([call[0][1] for call in cur.execute.call_args_list],
+                         [(3, "a.tar.gz", "data_batch_1"), (1, "a.tar.gz", "data_batch_2")])
+        self.assertIn("committed = committed + %s", cur.execute.call_args[0][0])
+        cur.connection.commit.assert_not_called()
+
+    def test_create_table_creates_manifest(self):
+        for partitioned in (False, True):
+            conn = MagicMock()
+            cur = MagicMock()
+            conn.cursor.return_value.__enter__.return_value = cur
+            with patch("builtins.print"):
+                database.create_table(conn, partitioned=partitioned)
+            self.assertIn("CREATE TABLE IF NOT EXISTS tb_ingest_manifest", cur.execute.call_args[0][0])
+
     def test_drop_table(self):
         conn = MagicMock()
         cur = MagicMock()
         conn.cursor.return_value.__enter__.return_value = cur
         with patch("builtins.print") as mock_print:
             database.drop_table(conn)
-            cur.execute.assert_called_once_with("DROP TABLE IF EXISTS tb_images;")
+            cur.execute.assert_called_once_with("DROP TABLE IF EXISTS tb_image_blobs, tb_images, tb_ingest_manifest;")
             conn.commit.assert_called_once()
             mock_print.assert_called_with("Table 'tb_images' dropped successfully.")
 
 
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        database.close_pool()
+        database.clear_db_config_cache()
+        self.addCleanup(database.close_pool)
+        self.addCleanup(database.clear_db_config_cache)
+        patcher = patch("database.load_db_config", return_value={"host": "localhost"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        pool_patcher = patch("psycopg2.pool.ThreadedConnectionPool")
+        self.mock_pool_cls = pool_patcher.start()
+        self.addCleanup(pool_patcher.stop)
+        self.mock_pool = self.mock_pool_cls.return_value
+        self.conn = MagicMock()
+        self.conn.closed = 0
+        self.conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        self.mock_pool.getconn.return_value = self.conn
+
+    def test_pool_created_once_with_config(self):
+        pool = database.get_pool(1, 3)
+        self.assertIs(database.get_pool(), pool)
+        self.mock_pool_cls.assert_called_once_with(1, 3, host="localhost")
+
+    def test_pooled_connection_returns_connection_and_records_stats(self):
+        database.get_pool(1, 2)
+        with database.pooled_connection() as conn:
+            self.assertIs(conn, self.conn)
+            self.assertEqual(database.pool_stats()["in_use"], 1)
+        self.mock_pool.putconn.assert_called_once_with(self.conn, close=False)
+        stats = database.pool_stats()
+        self.assertEqual(stats["in_use"], 0)
+        self.assertEqual(stats["checkouts"], 1)
+        self.assertEqual(stats["max_size"], 2)
+        self.assertIn("checkout_seconds_avg", stats)
+
+    def test_pooled_connection_rolls_back_open_transaction(self):
+        self.conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+        with self.assertRaises(RuntimeError):
+            with database.pooled_connection():
+                raise RuntimeError("boom")
+        self.conn.rollback.assert_called_once()
+        self.mock_pool.putconn.assert_called_once_with(self.conn, close=False)
+
+    def test_pooled_connection_discards_connection_when_rollback_fails(self):
+        database.get_pool(1, 1)
+        self.conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        self.conn.rollback.side_effect = psycopg2.OperationalError("server closed the connection unexpectedly")
+        with database.pooled_connection():
+            pass
+        self.mock_pool.putconn.assert_called_once_with(self.conn, close=True)
+        self.assertEqual(database.pool_stats()["in_use"], 0)
+        # The slot was released, so the single-connection pool is usable again.
+        self.conn.rollback.side_effect = None
+        with database.pooled_connection(timeout=0.01) as conn:
+            self.assertIs(conn, self.conn)
+
+    def test_pooled_connection_releases_slot_when_putconn_fails(self):
+        database.get_pool(1, 1)
+        self.mock_pool.putconn.side_effect = psycopg2.pool.PoolError("trying to put unkeyed connection")
+        with self.assertRaises(psycopg2.pool.PoolError):
+            with database.pooled_connection():
+                pass
+        self.assertEqual(database.pool_stats()["in_use"], 0)
+        self.mock_pool.putconn.side_effect = None
+        with database.pooled_connection(timeout=0.01):
+            pass
+
+    def test_pooled_connection_times_out_when_exhausted(self):
+        database.get_pool(1, 1)
+        with database.pooled_connection():
+            with self.assertRaises(psycopg2.pool.PoolError):
+                with database.pooled_connection(timeout=0.01):
+                    pass
+        self.assertEqual(database.pool_stats()["timeouts"], 1)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,10 +1,17 @@
 import io
+import os
+import gzip
+import hashlib
+import http.server
 import tarfile
+import threading
 import pickle
 import pytest
 import numpy as np
+from datetime import datetime
 from unittest import mock
 import download_images
+from metrics import Metrics
 
 
 @pytest.fixture
@@ -19,31 +26,217 @@ def fake_cifar_html():
     """
 
 
-def test_get_cifar_url_selects_python_tar_gz(fake_cifar_html):
+def test_get_cifar_url_selects_python_tar_gz(fake_cifar_html, tmp_path, monkeypatch):
+    monkeypatch.setattr(download_images, "DOWNLOAD_DIR", str(tmp_path))
     with mock.patch("requests.get") as mock_get:
         mock_get.return_value.content = fake_cifar_html.encode()
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.headers = {}
         url, href = download_images.get_cifar_url()
         assert url.startswith(download_images.BASE_URL)
         assert href.endswith("python.tar.gz")
 
 
-def test_download_image_set_downloads_and_saves(tmp_path):
-    url = "http://example.com/file.tar.gz"
-    filename = "file.tar.gz"
-    local_path = tmp_path / filename
+def test_get_cifar_links_cached_within_ttl(fake_cifar_html, tmp_path, monkeypatch):
+    monkeypatch.setattr(download_images, "DOWNLOAD_DIR", str(tmp_path))
+    with mock.patch("requests.get") as mock_get:
+        mock_get.return_value.content = fake_cifar_html.encode()
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.headers = {"ETag": '"abc"'}
+        first = download_images.get_cifar_links()
+        second = download_images.get_cifar_links()
+    assert first == second == ["cifar-10-python.tar.gz", "cifar-100-python.tar.gz"]
+    mock_get.assert_called_once()
+
+
+def test_get_cifar_links_revalidates_with_etag(fake_cifar_html, tmp_path, monkeypatch):
+    monkeypatch.setattr(download_images, "DOWNLOAD_DIR", str(tmp_path))
+    with mock.patch("requests.get") as mock_get:
+        mock_get.return_value.content = fake_cifar_html.encode()
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.headers = {"ETag": '"abc"'}
+        download_images.get_cifar_links()
+        mock_get.return_value.content = b"<html></html>"
+        mock_get.return_value.status_code = 304
+        mock_get.return_value.headers = {}
+        links = download_images.get_cifar_links(ttl=0)
+    assert links == ["cifar-10-python.tar.gz", "cifar-100-python.tar.gz"]
+    assert mock_get.call_args[1]["headers"] == {"If-None-Match": '"abc"'}
+
+
+def test_get_cifar_links_treats_truncated_cache_as_miss(fake_cifar_html, tmp_path, monkeypatch):
+    monkeypatch.setattr(download_images, "DOWNLOAD_DIR", str(tmp_path))
+    (tmp_path / "cifar_index.json").write_text('{"fetched_at": 1.0, "etag": ')
+    with mock.patch("requests.get") as mock_get:
+        mock_get.return_value.content = fake_cifar_html.encode()
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.headers = {}
+        assert download_images.get_cifar_links() == ["cifar-10-python.tar.gz", "cifar-100-python.tar.gz"]
+    assert mock_get.call_args[1]["headers"] == {}
+    assert sorted(os.listdir(tmp_path)) == ["cifar_index.json"]
+
+
+def test_get_cifar_links_does_not_cache_failures(fake_cifar_html, tmp_path, monkeypatch):
+    monkeypatch.setattr(download_images, "DOWNLOAD_DIR", str(tmp_path))
+    with mock.patch("requests.get") as mock_get:
+        mock_get.return_value.status_code = 503
+        mock_get.return_value.headers = {}
+        mock_get.return_value.raise_for_status.side_effect = download_images.requests.HTTPError("503")
+        with pytest.raises(download_images.requests.HTTPError):
+            download_images.get_cifar_links()
+        mock_get.return_value.status_code = 200
+        mock_get.return_value.raise_for_status.side_effect = None
+        mock_get.return_value.content = b"<html>maintenance</html>"
+        with pytest.raises(ValueError):
+            download_images.get_cifar_links()
+        assert not os.path.exists(tmp_path / "cifar_index.json")
+        mock_get.return_value.content = fake_cifar_html.encode()
+        assert len(download_images.get_cifar_links()) == 2
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    payload = b""
+    requests_seen = []
+    supports_ranges = True
+    # Answer a range starting at 0 with the whole file (200), like a server that only honours some ranges.
+    ignore_ranges_from_zero = False
+
+    def log_message(self, *args):
+        pass
+
+    def _send_headers(self, status, start, end):
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start + 1))
+        if self.supports_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(self.payload)}")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self._send_headers(200, 0, len(self.payload) - 1)
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        self.requests_seen.append(range_header)
+        start, end = 0, len(self.payload) - 1
+        ignored = self.ignore_ranges_from_zero and range_header and range_header.startswith("bytes=0-")
+        if range_header and self.supports_ranges and not ignored:
+            first, last = range_header.split("=")[1].split("-")
+            start, end = int(first), int(last) if last else end
+            if start >= len(self.payload):
+                self.send_response(416)
+                self.end_headers()
+                return
+            self._send_headers(206, start, end)
+        else:
+            self._send_headers(200, start, end)
+        self.wfile.write(self.payload[start:end + 1])
+
+
+@pytest.fixture
+def archive_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(download_images, "DOWNLOAD_DIR", str(tmp_path))
+    # Non-periodic, so bytes spliced at a wrong offset never match by accident.
+    RangeHandler.payload = np.random.default_rng(0).bytes(51200)
+    RangeHandler.requests_seen = []
+    RangeHandler.supports_ranges = True
+    RangeHandler.ignore_ranges_from_zero = False
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/archive.tar.gz", RangeHandler
+    server.shutdown()
+    server.server_close()
+
+
+def test_download_image_set_downloads_and_verifies(archive_server, tmp_path):
+    url, handler = archive_server
+    md5 = hashlib.md5(handler.payload).hexdigest()
+    result = download_images.download_image_set(url, "archive.tar.gz", chunk_size=1000, expected_md5=md5)
+    assert result == str(tmp_path / "archive.tar.gz")
+    assert (tmp_path / "archive.tar.gz").read_bytes() == handler.payload
+    assert not (tmp_path / "archive.tar.gz.part").exists()
+    assert handler.requests_seen == [None]
+
+    result = download_images.download_image_set(url, "archive.tar.gz", expected_md5=md5)
+    assert result.endswith("archive.tar.gz")
+    assert handler.requests_seen == [None]
+
+
+def test_download_image_set_resumes_partial_file(archive_server, tmp_path):
+    url, handler = archive_server
+    (tmp_path / "archive.tar.gz.part").write_bytes(handler.payload[:12345])
+    download_images.download_image_set(url, "archive.tar.gz", expected_md5=hashlib.md5(handler.payload).hexdigest())
+    assert handler.requests_seen == ["bytes=12345-"]
+    assert (tmp_path / "archive.tar.gz").read_bytes() == handler.payload
+
+
+def test_download_image_set_restarts_when_ranges_unsupported(archive_server, tmp_path):
+    url, handler = archive_server
+    handler.supports_ranges = False
+    (tmp_path / "archive.tar.gz.part").write_bytes(b"stale")
+    download_images.download_image_set(url, "archive.tar.gz", connections=4)
+    assert (tmp_path / "archive.tar.gz").read_bytes() == handler.payload
+
 
-    with mock.patch("os.path.exists", return_value=False), \
-         mock.patch("builtins.open", mock.mock_open()) as m_open, \
-         mock.patch("requests.get") as m_get:
-        m_get.return_value.__enter__.return_value.iter_content = lambda chunk_size: [b"abc", b"def"]
-        m_get.return_value.__enter__.return_value.raise_for_status = lambda: None
-        result = download_images.download_image_set(url, filename)
-        assert result.endswith(filename)
-        assert m_open.called
+def test_download_image_set_parallel_ranges(archive_server, tmp_path):
+    url, handler = archive_server
+    size = len(handler.payload)
+    step = -(-size // 3)
+    download_images.download_image_set(url, "archive.tar.gz", connections=3,
+                                       expected_md5=hashlib.md5(handler.payload).hexdigest())
+    assert (tmp_path / "archive.tar.gz").read_bytes() == handler.payload
+    assert sorted(handler.requests_seen) == sorted(
+        [f"bytes=0-{step - 1}", f"bytes={step}-{2 * step - 1}", f"bytes={2 * step}-{size - 1}"])
+    assert list(tmp_path.glob("*.part*")) == []
 
-    with mock.patch("os.path.exists", return_value=True):
-        result = download_images.download_image_set(url, filename)
-        assert result.endswith(filename)
+
+def test_download_image_set_resume_with_other_connection_count(archive_server, tmp_path):
+    url, handler = archive_server
+    size = len(handler.payload)
+    step = -(-size // 4)
+    # Half-filled parts of an interrupted 4-connection download, and one from the old index naming.
+    for start in range(0, size, step):
+        end = min(start + step, size) - 1
+        (tmp_path / f"archive.tar.gz.part.{start}-{end}").write_bytes(handler.payload[start:start + step // 2])
+    (tmp_path / "archive.tar.gz.part1").write_bytes(b"x" * 100)
+    download_images.download_image_set(url, "archive.tar.gz", connections=2)
+    assert (tmp_path / "archive.tar.gz").read_bytes() == handler.payload
+    assert list(tmp_path.glob("*.part*")) == []
+
+
+def test_download_image_set_resumes_matching_range_parts(archive_server, tmp_path):
+    url, handler = archive_server
+    size = len(handler.payload)
+    step = -(-size // 2)
+    (tmp_path / f"archive.tar.gz.part.0-{step - 1}").write_bytes(handler.payload[:1000])
+    download_images.download_image_set(url, "archive.tar.gz", connections=2)
+    assert (tmp_path / "archive.tar.gz").read_bytes() == handler.payload
+    assert sorted(handler.requests_seen) == sorted([f"bytes=1000-{step - 1}", f"bytes={step}-{size - 1}"])
+
+
+def test_download_image_set_rejects_whole_file_for_a_range(archive_server, tmp_path):
+    url, handler = archive_server
+    handler.ignore_ranges_from_zero = True
+    with pytest.raises(ValueError, match="ignored the range"):
+        download_images.download_image_set(url, "archive.tar.gz", connections=2)
+    assert not (tmp_path / "archive.tar.gz").exists()
+
+
+def test_download_image_set_rejects_bad_checksum(archive_server, tmp_path):
+    url, _ = archive_server
+    with pytest.raises(ValueError, match="Checksum mismatch"):
+        download_images.download_image_set(url, "archive.tar.gz", expected_md5="0" * 32)
+    assert not (tmp_path / "archive.tar.gz").exists()
+    assert not (tmp_path / "archive.tar.gz.part").exists()
+
+
+def test_download_image_set_replaces_corrupt_existing_file(archive_server, tmp_path):
+    url, handler = archive_server
+    (tmp_path / "archive.tar.gz").write_bytes(b"truncated")
+    download_images.download_image_set(url, "archive.tar.gz", expected_md5=hashlib.md5(handler.payload).hexdigest())
+    assert (tmp_path / "archive.tar.gz").read_bytes() == handler.payload
 
 
 def test_convert_to_jpeg_bytes_returns_bytes():
@@ -53,6 +246,51 @@ def test_convert_to_jpeg_bytes_returns_bytes():
     assert result[:8] == b'\x89PNG\r\n\x1a\n'
 
 
+def test_to_hwc_matches_per_row_transpose():
+    pixels = np.random.randint(0, 255, size=(4, 3*32*32), dtype=np.uint8)
+    hwc = download_images.to_hwc(pixels)
+    assert hwc.shape == (4, 32, 32, 3)
+    assert hwc.flags["C_CONTIGUOUS"]
+    for i in range(4):
+        assert np.array_equal(hwc[i], pixels[i].reshape(3, 32, 32).transpose(1, 2, 0))
+
+
+@pytest.mark.parametrize("image_format, magic", [
+    ("PNG", b"\x89PNG"),
+    ("JPEG", b"\xff\xd8\xff"),
+    ("WEBP", b"RIFF"),
+])
+def test_encode_images_formats(image_format, magic):
+    pixels = np.random.randint(0, 255, size=(3, 3*32*32), dtype=np.uint8)
+    encoded = download_images.encode_images(pixels, image_format=image_format, quality=75)
+    assert len(encoded) == 3
+    assert all(image.startswith(magic) for image in encoded)
+
+
+def test_encode_images_raw_is_hwc_bytes():
+    pixels = np.random.randint(0, 255, size=(2, 3*32*32), dtype=np.uint8)
+    encoded = download_images.encode_images(pixels, image_format="raw")
+    assert encoded[1] == pixels[1].reshape(3, 32, 32).transpose(1, 2, 0).tobytes()
+
+
+def test_encode_images_rejects_unknown_format():
+    with pytest.raises(ValueError):
+        download_images.encode_images(np.zeros((1, 3072), dtype=np.uint8), image_format="BMP")
+
+
+def test_iter_encoded_parallel_matches_serial(monkeypatch):
+    monkeypatch.setattr(download_images, "ENCODE_CHUNK_SIZE", 4)
+    pixels = np.random.randint(0, 255, size=(10, 3*32*32), dtype=np.uint8)
+    serial = list(download_images.iter_encoded(pixels, workers=1))
+    parallel = list(download_images.iter_encoded(pixels, workers=2))
+    assert len(serial) == 10
+    assert parallel == serial
+
+
+def test_iter_encoded_empty():
+    assert list(download_images.iter_encoded(np.zeros((0, 3072), dtype=np.uint8), workers=2)) == []
+
+
 def make_fake_tarfile(tmp_path, batch_name="data_batch_1", num_images=2):
     data = {
         b"data": np.random.randint(0, 255, size=(num_images, 3*32*32), dtype=np.uint8),
@@ -74,42 +312,418 @@ def make_fake_tarfile(tmp_path, batch_name="data_batch_1", num_images=2):
 
 def test_extract_images_reads_and_returns_images(tmp_path):
     tar_path = make_fake_tarfile(tmp_path)
-    images = download_images.extract_images(str(tar_path), max_images=2)
+    images = list(download_images.extract_images(str(tar_path), max_images=2))
     assert len(images) == 2
-    for title, batch, img_bytes in images:
-        assert title.endswith(".png")
-        assert isinstance(batch, str)
-        assert isinstance(img_bytes, bytes)
+    for image in images:
+        assert image["title"].endswith(".png")
+        assert isinstance(image["batch_name"], str)
+        assert isinstance(image["image"], bytes)
+        assert len(image["content_hash"]) == 16
+        assert isinstance(image["phash"], int)
+        assert "pixels" not in image
+
+
+def test_extract_images_only_encodes_selected(tmp_path, monkeypatch):
+    tar_path = make_fake_tarfile(tmp_path, num_images=20)
+    encoded = []
+    def fake_encode(pixels, image_format="PNG", quality=90):
+        encoded.append(len(pixels))
+        return [b"img"] * len(pixels)
+    monkeypatch.setattr(download_images, "encode_images", fake_encode)
+    images = download_images.extract_images(str(tar_path), max_images=5)
+    assert encoded == []
+    assert len(list(images)) == 5
+    assert encoded == [5]
+
+
+def test_iter_batches_caches_npy_for_warm_start(tmp_path, monkeypatch):
+    tar_path = str(make_fake_tarfile(tmp_path, num_images=3))
+    cold = list(download_images.iter_batches(tar_path))
+    cache_dir = download_images.batch_cache_dir(tar_path)
+    assert sorted(os.listdir(cache_dir)) == ["data_batch_1.json", "data_batch_1.npy", "index.json",
+                                             download_images.LABEL_NAMES_FILE]
+
+    monkeypatch.setattr(download_images.tarfile, "open", mock.Mock(side_effect=AssertionError("archive reopened")))
+    warm = list(download_images.iter_batches(tar_path))
+    assert len(warm) == 1
+    assert isinstance(warm[0][b"data"], np.memmap)
+    assert np.array_equal(warm[0][b"data"], cold[0][b"data"])
+    assert warm[0][b"filenames"] == cold[0][b"filenames"]
+    assert warm[0][b"batch_label"] == cold[0][b"batch_label"]
+
+
+def test_iter_batches_interrupted_pass_is_redone(tmp_path):
+    tar_path = str(make_fake_tarfile(tmp_path, num_images=3))
+    batches = download_images.iter_batches(tar_path)
+    next(batches)
+    batches.close()
+    cache_dir = download_images.batch_cache_dir(tar_path)
+    assert not os.path.exists(os.path.join(cache_dir, "index.json"))
+    assert len(list(download_images.iter_batches(tar_path))) == 1
+    assert os.path.exists(os.path.join(cache_dir, "index.json"))
+
+
+def test_iter_batches_without_cache(tmp_path):
+    tar_path = str(make_fake_tarfile(tmp_path, num_images=3))
+    assert len(list(download_images.iter_batches(tar_path, use_cache=False))) == 1
+    assert not os.path.exists(download_images.batch_cache_dir(tar_path))
+
+
+def make_mixed_tarfile(tmp_path):
+    tar_path = tmp_path / "mixed.tar.gz"
+    def add(tar, name, payload):
+        info = tarfile.TarInfo(name=name)
+        info.size = len(payload)
+        tar.addfile(info, io.BytesIO(payload))
+    batch = pickle.dumps({b"data": np.zeros((2, 3072), dtype=np.uint8), b"batch_label": b"b"})
+    with tarfile.open(tar_path, "w:gz") as tar:
+        add(tar, "cifar-10-batches-py/readme.html", b"<html></html>")
+        add(tar, "cifar-10-batches-py/batches.meta", pickle.dumps({b"label_names": []}))
+        add(tar, "cifar-10-batches-py/data_batch_1", batch)
+        add(tar, "cifar-10-batches-py/training_notes", b"not a batch")
+        add(tar, "cifar-10-batches-py/test_batch", batch)
+        add(tar, "cifar-100-python/train", batch)
+        add(tar, "cifar-100-python/train.txt", b"not a batch")
+    return str(tar_path)
+
+
+def test_iter_batch_members_matches_exact_names_in_one_pass(tmp_path, monkeypatch):
+    tar_path = make_mixed_tarfile(tmp_path)
+    monkeypatch.setattr(tarfile.TarFile, "getmembers", mock.Mock(side_effect=AssertionError("full scan")))
+    names = [member.name for member, _ in download_images.iter_batch_members(tar_path)]
+    assert names == ["cifar-10-batches-py/data_batch_1", "cifar-10-batches-py/test_batch", "cifar-100-python/train"]
+
+
+def test_iter_batches_times_decompress_and_unpickle_apart(tmp_path, monkeypatch):
+    registry = Metrics()
+    monkeypatch.setattr(download_images, "metrics", registry)
+    tar_path = make_mixed_tarfile(tmp_path)
+    assert len(list(download_images.iter_batches(tar_path))) == 3
+    stages = registry.summary()["stages"]
+    # Three batches plus the batches.meta member with the label names.
+    assert stages["decompress"]["calls"] == 4
+    assert stages["unpickle"]["calls"] == 4
+    assert stages["batch_cache_save"]["calls"] == 3
+    list(download_images.iter_batches(tar_path))
+    assert registry.summary()["stages"]["batch_cache_load"]["calls"] == 3
+
+
+def test_iter_batch_members_uses_fast_gzip_backend(tmp_path, monkeypatch):
+    tar_path = make_mixed_tarfile(tmp_path)
+    opened = []
+    class FakeBackend:
+        @staticmethod
+        def open(path, mode):
+            opened.append(path)
+            return gzip.open(path, mode)
+    monkeypatch.setattr(download_images, "fast_gzip", FakeBackend)
+    assert len(list(download_images.iter_batch_members(tar_path))) == 3
+    assert opened == [tar_path]
+
+
+def make_batches(sizes):
+    batches, start = [], 0
+    for size in sizes:
+        pixels = np.arange(start, start + size, dtype=np.uint32)[:, None].repeat(4, axis=1).view(np.uint8)
+        batches.append({
+            b"data": pixels,
+            b"filenames": [f"img_{start + i}.png".encode() for i in range(size)],
+            b"batch_label": b"batch"
+        })
+        start += size
+    return batches
+
+
+def test_sample_images_is_bounded_distinct_and_seeded():
+    selected, total = download_images.sample_images(make_batches([30, 50, 20]), max_images=10, seed=7)
+    assert total == 100
+    assert len(selected) == 10
+    titles = [image["title"] for image in selected]
+    assert len(set(titles)) == 10
+    again, _ = download_images.sample_images(make_batches([30, 50, 20]), max_images=10, seed=7)
+    assert [image["title"] for image in again] == titles
+    for image in selected:
+        assert image["title"] == f"img_{image['pixels'].view(np.uint32)[0]}.png"
+        assert image["content_hash"] == download_images.content_hash(image["pixels"])
+
+
+def test_sample_images_keeps_everything_when_small():
+    selected, total = download_images.sample_images(make_batches([3, 2]), max_images=10, seed=1)
+    assert total == 5
+    assert sorted(image["title"] for image in selected) == [f"img_{i}.png" for i in range(5)]
+
+
+def test_sample_images_skips_stored_hashes():
+    batches = make_batches([6, 4])
+    stored = {download_images.content_hash(batches[0][b"data"][i]) for i in (0, 2, 4)}
+    queried = []
+    def exclude(hashes):
+        queried.append(len(hashes))
+        return stored & set(hashes)
+    selected, total = download_images.sample_images(batches, max_images=10, seed=3, exclude_hashes=exclude)
+    assert queried == [6, 4]
+    assert total == 7
+    assert sorted(image["title"] for image in selected) == [f"img_{i}.png" for i in (1, 3, 5, 6, 7, 8, 9)]
+
+
+def test_sample_images_is_roughly_uniform():
+    hits = np.zeros(40)
+    for seed in range(500):
+        selected, _ = download_images.sample_images(make_batches([10, 30]), max_images=4, seed=seed)
+        for image in selected:
+            hits[image["pixels"].view(np.uint32)[0]] += 1
+    # Each row is expected 50 times; early and late rows must not be favoured.
+    assert hits.min() > 25 and hits.max() < 80
 
 
 def test_insert_images_to_db_calls_insert(monkeypatch):
-    fake_conn = object()
+    fake_conn = mock.MagicMock()
     called = []
-    def fake_insert(conn, record):
-        called.append((conn, record))
+    def fake_insert(conn, records, batch_size, storage, checkpoint=None):
+        called.append((conn, list(records), batch_size, storage))
     monkeypatch.setattr(download_images, "get_connection", lambda: fake_conn)
-    monkeypatch.setattr(download_images, "insert_image_record", fake_insert)
-    images = [("title1", "batch1", b"img1"), ("title2", "batch2", b"img2")]
+    monkeypatch.setattr(download_images, "insert_images_bulk", fake_insert)
+    images = [
+        {"title": "title1", "batch_name": "batch1", "image": b"img1", "content_hash": b"h1"},
+        {"title": "title2", "batch_name": "batch2", "image": b"img2", "content_hash": b"h2"},
+    ]
     url = "http://example.com"
-    download_images.insert_images_to_db(images, url)
-    assert len(called) == 2
-    for conn, record in called:
-        assert conn is fake_conn
+    download_images.insert_images_to_db(images, url, batch_size=500, storage="blob")
+    assert len(called) == 1
+    conn, records, batch_size, storage = called[0]
+    assert conn is fake_conn
+    assert batch_size == 500
+    assert storage == "blob"
+    assert len(records) == 2
+    for record in records:
         assert record["url"] == url
         assert "title" in record
         assert "batch_name" in record
         assert isinstance(record["image"], bytes)
+        assert "downloaded_at" in record
+    assert [record["content_hash"] for record in records] == [b"h1", b"h2"]
+    fake_conn.close.assert_called_once()
+
 
+def test_insert_images_to_db_keeps_caller_connection(monkeypatch):
+    conn = mock.MagicMock()
+    monkeypatch.setattr(download_images, "get_connection", mock.MagicMock())
+    monkeypatch.setattr(download_images, "insert_images_bulk", lambda conn, records, batch_size, storage, checkpoint=None: list(records))
+    download_images.insert_images_to_db([], "http://example.com", conn=conn)
+    download_images.get_connection.assert_not_called()
+    conn.close.assert_not_called()
 
-def test_download_and_store_images_integration(monkeypatch, tmp_path):
-    # Patch all sub-functions to simulate workflow
+
+def test_download_and_store_images_integration(monkeypatch):
+    fake_conn = mock.MagicMock()
+    monkeypatch.setattr(download_images, "get_connection", lambda: fake_conn)
+    monkeypatch.setattr(download_images, "create_manifest_table", mock.MagicMock())
     monkeypatch.setattr(download_images, "get_cifar_url", lambda: ("http://example.com/fake.tar.gz", "fake.tar.gz"))
-    monkeypatch.setattr(download_images, "download_image_set", lambda url, fn: str(make_fake_tarfile(tmp_path)))
-    monkeypatch.setattr(download_images, "extract_images", lambda tar, max_images=1000: [("t", "b", b"img")])
     called = []
-    monkeypatch.setattr(download_images, "insert_images_to_db", lambda imgs, url: called.append((imgs, url)))
+    monkeypatch.setattr(download_images, "ingest_archive",
+                        lambda conn, url, filename, **kwargs: called.append((conn, url, filename, kwargs["resume"])))
     download_images.download_and_store_images()
-    assert called
-    imgs, url = called[0]
-    assert url == "http://example.com/fake.tar.gz"
-    assert imgs == [("t", "b", b"img")]
+    assert called == [(fake_conn, "http://example.com/fake.tar.gz", "fake.tar.gz", False)]
+    download_images.create_manifest_table.assert_called_once_with(fake_conn)
+    fake_conn.close.assert_called_once()
+
+
+def test_download_and_store_images_resume_only_reopens_unfinished(monkeypatch):
+    fake_conn = mock.MagicMock()
+    monkeypatch.setattr(download_images, "get_connection", lambda: fake_conn)
+    monkeypatch.setattr(download_images, "create_manifest_table", mock.MagicMock())
+    monkeypatch.setattr(download_images, "get_cifar_url", mock.Mock(side_effect=AssertionError("index fetched")))
+    monkeypatch.setattr(download_images, "unfinished_archives",
+                        lambda conn: [("http://example.com/b.tar.gz", "b.tar.gz")])
+    called = []
+    monkeypatch.setattr(download_images, "ingest_archive",
+                        lambda conn, url, filename, **kwargs: called.append((filename, kwargs["resume"])))
+    download_images.download_and_store_images(resume=True)
+    assert called == [("b.tar.gz", True)]
+
+
+class FakeManifest:
+    """In-memory tb_ingest_manifest whose offsets only move when the fake insert commits a batch."""
+
+    def __init__(self):
+        self.archives = {}
+
+    def save(self, conn, archive, url, plan):
+        self.archives[archive] = [{"member": member, "url": url, "positions": list(positions), "committed": 0}
+                                  for member, positions in plan]
+
+    def load(self, conn, archive):
+        return [dict(entry) for entry in self.archives.get(archive, [])]
+
+    def advance(self, cur, archive, counts):
+        for entry in self.archives[archive]:
+            entry["committed"] += counts.get(entry["member"], 0)
+
+
+def make_two_batch_tarfile(tmp_path, num_images=10):
+    tar_path = tmp_path / "two.tar.gz"
+    with tarfile.open(tar_path, "w:gz") as tar:
+        for number in (1, 2):
+            payload = pickle.dumps({
+                b"data": np.random.randint(0, 255, size=(num_images, 3072), dtype=np.uint8),
+                b"filenames": [f"b{number}_{i}.png".encode() for i in range(num_images)],
+                b"batch_label": f"batch {number}".encode(),
+                b"labels": [i % 10 for i in range(num_images)],
+            })
+            info = tarfile.TarInfo(name=f"cifar-10-batches-py/data_batch_{number}")
+            info.size = len(payload)
+            tar.addfile(info, io.BytesIO(payload))
+    return str(tar_path)
+
+
+def test_ingest_archive_resumes_exactly_once_after_a_crash(tmp_path, monkeypatch):
+    tar_path = make_two_batch_tarfile(tmp_path)
+    manifest = FakeManifest()
+    monkeypatch.setattr(download_images, "save_manifest", manifest.save)
+    monkeypatch.setattr(download_images, "load_manifest", manifest.load)
+    monkeypatch.setattr(download_images, "advance_manifest", manifest.advance)
+    monkeypatch.setattr(download_images, "existing_hashes", lambda conn, hashes: set())
+    downloads = []
+    monkeypatch.setattr(download_images, "download_image_set",
+                        lambda url, filename, **kwargs: downloads.append(filename) or tar_path)
+    stored = []
+    crash_after = [1]
+
+    def fake_insert(conn, records, batch_size=1000, storage="inline", checkpoint=None):
+        records = list(records)
+        for start in range(0, len(records), batch_size):
+            if crash_after[0] == 0:
+                raise RuntimeError("connection lost")
+            crash_after[0] -= 1
+            batch = records[start:start + batch_size]
+            stored.extend(batch)
+            checkpoint(None, batch)
+
+    monkeypatch.setattr(download_images, "insert_images_bulk", fake_insert)
+    ingest = lambda: download_images.ingest_archive(mock.MagicMock(), "http://example.com/two.tar.gz", "two.tar.gz",
+                                                    max_images=12, seed=5, batch_size=5, resume=True)
+    with pytest.raises(RuntimeError):
+        ingest()
+    assert len(stored) == 5
+    assert sum(entry["committed"] for entry in manifest.archives["two.tar.gz"]) == 5
+
+    crash_after[0] = -1
+    assert ingest() == 7
+    titles = [record["title"] for record in stored]
+    assert len(titles) == 12 and len(set(titles)) == 12
+    planned = {f"b{entry['member'][-1]}_{position}.png"
+               for entry in manifest.archives["two.tar.gz"] for position in entry["positions"]}
+    assert set(titles) == planned
+    assert all(record["label"] == int(record["title"].split("_")[1][:-4]) % 10 for record in stored)
+    assert all(entry["committed"] == len(entry["positions"]) for entry in manifest.archives["two.tar.gz"])
+
+    assert ingest() == 0
+    assert downloads == ["two.tar.gz", "two.tar.gz"]
+
+
+def test_extract_images_matches_the_ingest_path(tmp_path, monkeypatch):
+    tar_path = make_two_batch_tarfile(tmp_path)
+    manifest = FakeManifest()
+    monkeypatch.setattr(download_images, "save_manifest", manifest.save)
+    monkeypatch.setattr(download_images, "advance_manifest", manifest.advance)
+    monkeypatch.setattr(download_images, "existing_hashes", lambda conn, hashes: set())
+    monkeypatch.setattr(download_images, "download_image_set", lambda url, filename, **kwargs: tar_path)
+    stored = []
+    monkeypatch.setattr(download_images, "insert_images_bulk",
+                        lambda conn, records, batch_size=1000, storage="inline", checkpoint=None: stored.extend(records))
+    download_images.ingest_archive(mock.MagicMock(), "http://example.com/two.tar.gz", "two.tar.gz",
+                                   max_images=12, seed=5)
+    extracted = list(download_images.extract_images(tar_path, max_images=12, seed=5))
+    assert [image["title"] for image in extracted] == [record["title"] for record in stored]
+
+
+def test_plan_selection_groups_by_member_in_archive_order():
+    selected = [{"title": "c", "source": (1, 4)}, {"title": "a", "source": (0, 2)}, {"title": "b", "source": (1, 0)}]
+    plan, ordered = download_images.plan_selection(selected, ["data_batch_1", "data_batch_2", "data_batch_3"])
+    assert plan == [("data_batch_1", [2]), ("data_batch_2", [4, 0]), ("data_batch_3", [])]
+    assert [(image["title"], image["member"]) for image in ordered] == [
+        ("a", "data_batch_1"), ("c", "data_batch_2"), ("b", "data_batch_2")]
+    assert all("source" not in image for image in ordered)
+
+
+def test_parse_args_defaults_and_workers():
+    args = download_images.parse_args([])
+    assert args.workers == 1
+    assert args.max_images == 1000
+    args = download_images.parse_args(["--workers", "4", "--format", "jpeg", "--seed", "3"])
+    assert args.workers == 4
+    assert args.image_format == "JPEG"
+    assert args.seed == 3
+    assert args.storage == "inline"
+    assert download_images.parse_args(["--storage", "file"]).storage == "file"
+    assert not args.resume and not args.status and not args.all_archives
+    args = download_images.parse_args(["--resume", "--all-archives"])
+    assert args.resume and args.all_archives
+    assert download_images.parse_args(["--status"]).status
+
+
+def test_print_manifest_status(capsys):
+    download_images.print_manifest_status([
+        ("cifar-10-python.tar.gz", "http://x", 6, 1000, 1000, datetime(2024, 1, 1)),
+        ("cifar-100-python.tar.gz", "http://y", 2, 1000, 400, datetime(2024, 1, 2)),
+    ])
+    lines = capsys.readouterr().out.splitlines()
+    assert "1000/1000" in lines[0] and "done" in lines[0]
+    assert "400/1000" in lines[1] and "interrupted" in lines[1]
+
+
+def make_cifar100_tarfile(tmp_path, num_images=4):
+    tar_path = tmp_path / "cifar-100-python.tar.gz"
+    def add(tar, name, payload):
+        info = tarfile.TarInfo(name=name)
+        info.size = len(payload)
+        tar.addfile(info, io.BytesIO(payload))
+    batch = pickle.dumps({
+        b"data": np.random.randint(0, 255, size=(num_images, 3072), dtype=np.uint8),
+        b"filenames": [f"img_{i}.png".encode() for i in range(num_images)],
+        b"batch_label": b"training batch 1 of 1",
+        b"fine_labels": [i % 3 for i in range(num_images)],
+        b"coarse_labels": [i % 2 for i in range(num_images)],
+    })
+    meta = pickle.dumps({
+        b"fine_label_names": [b"apple", b"bear", b"cloud"],
+        b"coarse_label_names": [b"fruit", b"other"],
+    })
+    with tarfile.open(tar_path, "w:gz") as tar:
+        # The meta member comes after the batch, as it can in real archives.
+        add(tar, "cifar-100-python/train", batch)
+        add(tar, "cifar-100-python/meta", meta)
+    return str(tar_path)
+
+
+def test_read_label_names_cifar10_meta():
+    meta = {b"label_names": [b"airplane", b"automobile"], b"num_cases_per_batch": 10000}
+    assert download_images.read_label_names(meta) == {"label": ["airplane", "automobile"]}
+
+
+def test_extract_images_attaches_fine_and_coarse_labels(tmp_path):
+    tar_path = make_cifar100_tarfile(tmp_path)
+    for use in ("cold", "cached"):
+        images = sorted(download_images.extract_images(tar_path, max_images=4), key=lambda image: image["title"])
+        assert [image["label"] for image in images] == [0, 1, 2, 0], use
+        assert [image["label_name"] for image in images] == ["apple", "bear", "cloud", "apple"], use
+        assert [image["coarse_label_name"] for image in images] == ["fruit", "other", "fruit", "other"], use
+        assert all(isinstance(image["label"], int) for image in images)
+    cache_dir = download_images.batch_cache_dir(tar_path)
+    assert download_images.LABEL_NAMES_FILE in os.listdir(cache_dir)
+
+
+def test_cache_without_label_names_is_rebuilt(tmp_path):
+    tar_path = make_cifar100_tarfile(tmp_path)
+    list(download_images.extract_images(tar_path, max_images=4))
+    # A batch cache written before labels were stored has no label_names.json.
+    os.remove(os.path.join(download_images.batch_cache_dir(tar_path), download_images.LABEL_NAMES_FILE))
+    images = list(download_images.extract_images(tar_path, max_images=4))
+    assert {image["label_name"] for image in images} == {"apple", "bear", "cloud"}
+    assert download_images.LABEL_NAMES_FILE in os.listdir(download_images.batch_cache_dir(tar_path))
+
+
+def test_apply_label_names_leaves_unlabelled_images_alone():
+    images = [{"title": "a", "label": 1}, {"title": "b"}]
+    download_images.apply_label_names(images, {"label": ["cat", "dog"]})
+    assert images == [{"title": "a", "label": 1, "label_name": "dog"}, {"title": "b"}]
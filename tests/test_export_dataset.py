@@ -0,0 +1,85 @@
+import io
+import json
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import database
+import export_dataset
+
+
+def make_pixels(count):
+    return np.arange(count * 32 * 32 * 3, dtype=np.uint64).astype(np.uint8).reshape(count, 32, 32, 3)
+
+
+def png(pixels):
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def fake_connection(rows):
+    conn = MagicMock()
+    cur = MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cur
+    cur.__iter__.return_value = iter(rows)
+    return conn, cur
+
+
+def make_rows(pixels, tmp_path):
+    rows = []
+    for i, image in enumerate(pixels):
+        if i % 3 == 0:
+            rows.append((f"id{i}", f"{i}.png", "data_batch_1", memoryview(png(image)), None))
+        elif i % 3 == 1:
+            rows.append((f"id{i}", f"{i}.png", "data_batch_1", image.tobytes(), None))
+        else:
+            path = database.write_payload_file(png(image), str(tmp_path / "store"))
+            rows.append((f"id{i}", f"{i}.png", "test_batch", None, path))
+    return rows
+
+
+def test_decode_payload_formats():
+    pixels = make_pixels(1)[0]
+    assert np.array_equal(export_dataset.decode_payload(png(pixels)), pixels)
+    assert np.array_equal(export_dataset.decode_payload(pixels.tobytes()), pixels)
+    with pytest.raises(ValueError):
+        export_dataset.decode_payload(png(np.zeros((8, 8, 3), dtype=np.uint8)))
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_export_round_trip(tmp_path, workers):
+    pixels = make_pixels(7)
+    conn, cur = fake_connection(make_rows(pixels, tmp_path))
+    out_dir = str(tmp_path / "dataset")
+    index = export_dataset.export_dataset(conn, out_dir, shard_size=3, batch_name="data_batch_1", workers=workers)
+
+    assert cur.execute.call_args[0][1] == {"batch_name": "data_batch_1"}
+    assert conn.cursor.call_args[1]["name"].startswith("export_dataset_")
+    assert index["count"] == 7
+    assert [shard["file"] for shard in index["shards"]] == ["shard_00000.npy", "shard_00001.npy", "shard_00002.npy"]
+    assert [shard["count"] for shard in index["shards"]] == [3, 3, 1]
+    with open(tmp_path / "dataset" / "index.json") as f:
+        assert json.load(f) == index
+
+    batches = list(export_dataset.iter_dataset(out_dir, batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 1, 2, 1, 1]
+    assert all(isinstance(batch, np.memmap) for batch in batches)
+    assert np.array_equal(np.concatenate(batches), pixels)
+
+    ids = [image_id for ids, _ in export_dataset.iter_dataset(out_dir, batch_size=2, with_ids=True) for image_id in ids]
+    assert ids == [f"id{i}" for i in range(7)]
+
+
+def test_export_empty_table(tmp_path):
+    conn, _ = fake_connection([])
+    index = export_dataset.export_dataset(conn, str(tmp_path), shard_size=3)
+    assert index["count"] == 0
+    assert list(export_dataset.iter_dataset(str(tmp_path))) == []
+
+
+def test_export_rejects_bad_shard_size(tmp_path):
+    with pytest.raises(ValueError):
+        export_dataset.export_dataset(MagicMock(), str(tmp_path), shard_size=0)
@@ -1,4 +1,5 @@
 import unittest
+from contextlib import contextmanager
 from unittest.mock import patch, MagicMock, mock_open
 from pathlib import Path
 from get_random_image_from_db import get_random_image
@@ -6,14 +7,26 @@ from image_structure import ImageStructure
 from datetime import datetime
 
 
+def fake_pool(conn, checkouts):
+    @contextmanager
+    def pooled_connection():
+        checkouts.append(conn)
+        try:
+            yield conn
+        finally:
+            checkouts.append("returned")
+    return pooled_connection
+
+
 class TestGetRandomImage(unittest.TestCase):
-    @patch("get_random_image_from_db.get_connection")
+    @patch("get_random_image_from_db.pooled_connection")
     @patch("get_random_image_from_db.select_image")
     @patch("builtins.open", new_callable=mock_open)
     @patch("get_random_image_from_db.Path")
-    def test_get_random_image_success(self, mock_path, mock_open_file, mock_select_image, mock_get_connection):
+    def test_get_random_image_success(self, mock_path, mock_open_file, mock_select_image, mock_pooled_connection):
         mock_conn = MagicMock()
-        mock_get_connection.return_value = mock_conn
+        checkouts = []
+        mock_pooled_connection.side_effect = fake_pool(mock_conn, checkouts)
         mock_path.return_value = Path("random_image.png")
 
         image = ImageStructure(
@@ -29,24 +42,25 @@ class TestGetRandomImage(unittest.TestCase):
         with patch("builtins.print") as mock_print:
             get_random_image()
 
-        mock_get_connection.assert_called_once()
+        self.assertEqual(checkouts, [mock_conn, "returned"])
         mock_select_image.assert_called_once_with(mock_conn)
         mock_open_file.assert_called_once_with(Path("random_image.png"), "wb")
         mock_open_file().write.assert_called_once_with(b"fakeimagedata")
-        mock_conn.close.assert_called_once()
+        mock_conn.close.assert_not_called()
 
         printed = [str(call) for call in mock_print.call_args_list]
         assert any("Random image is fetched from database" in line for line in printed)
         assert any("ID: 1, Title: Test Image" in line for line in printed)
 
-    @patch("get_random_image_from_db.get_connection")
+    @patch("get_random_image_from_db.pooled_connection")
     @patch("get_random_image_from_db.select_image")
     @patch("builtins.open", new_callable=mock_open)
     @patch("get_random_image_from_db.Path")
-    def test_get_random_image_no_images(self, mock_path, mock_open_file, mock_select_image, mock_get_connection):
+    def test_get_random_image_no_images(self, mock_path, mock_open_file, mock_select_image, mock_pooled_connection):
         # Setup
         mock_conn = MagicMock()
-        mock_get_connection.return_value = mock_conn
+        checkouts = []
+        mock_pooled_connection.side_effect = fake_pool(mock_conn, checkouts)
         mock_path.return_value = Path("random_image.png")
         mock_select_image.return_value = []
 
@@ -54,28 +68,54 @@ class TestGetRandomImage(unittest.TestCase):
             get_random_image()
 
         mock_open_file.assert_not_called()
-        mock_conn.close.assert_called_once()
+        self.assertEqual(checkouts, [mock_conn, "returned"])
+        mock_conn.close.assert_not_called()
 
-    @patch("get_random_image_from_db.get_connection")
+    @patch("get_random_image_from_db.pooled_connection")
     @patch("get_random_image_from_db.select_image")
     @patch("builtins.open", new_callable=mock_open)
     @patch("get_random_image_from_db.Path")
-    def test_get_random_image_exception(self, mock_path, mock_open_file, mock_select_image, mock_get_connection):
+    def test_get_random_image_exception(self, mock_path, mock_open_file, mock_select_image, mock_pooled_connection):
         mock_conn = MagicMock()
-        mock_get_connection.return_value = mock_conn
+        checkouts = []
+        mock_pooled_connection.side_effect = fake_pool(mock_conn, checkouts)
         mock_path.return_value = Path("random_image.png")
         mock_select_image.side_effect = Exception("DB error")
 
         with patch("builtins.print") as mock_print:
             result = list(get_random_image())
 
-        mock_get_connection.assert_called_once()
+        self.assertEqual(checkouts, [mock_conn, "returned"])
         mock_select_image.assert_called_once_with(mock_conn)
         mock_open_file.assert_not_called()
         self.assertEqual(result, [])
-        mock_conn.close.assert_called_once()
+        mock_conn.close.assert_not_called()
         self.assertTrue(any("Error fetching random image" in str(call) for call in mock_print.call_args_list))
 
+    @patch("get_random_image_from_db.pooled_connection")
+    @patch("get_random_image_from_db.select_image")
+    @patch("builtins.open", new_callable=mock_open)
+    @patch("get_random_image_from_db.Path")
+    def test_get_random_image_serves_payload_from_cache(self, mock_path, mock_open_file, mock_select_image, mock_pooled_connection):
+        mock_conn = MagicMock()
+        checkouts = []
+        mock_pooled_connection.side_effect = fake_pool(mock_conn, checkouts)
+        mock_path.return_value = Path("random_image.png")
+        loader = MagicMock(return_value=b"fromdb")
+        image = ImageStructure(id="1", title="Test Image", batch_name="Batch1", url="http://example.com",
+                               downloaded_at=datetime.now(), loader=loader)
+        mock_select_image.return_value = [image]
+        cache = MagicMock()
+        cache.get_or_load.return_value = memoryview(b"cached")
+
+        with patch("builtins.print"):
+            get_random_image(cache)
+
+        mock_select_image.assert_called_once_with(mock_conn, lazy=True)
+        cache.get_or_load.assert_called_once_with("1", image.load_image)
+        mock_open_file().write.assert_called_once_with(memoryview(b"cached"))
+        loader.assert_not_called()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,143 @@
+import multiprocessing
+import os
+import tempfile
+import unittest
+from image_cache import ImageCache, RECORD_HEADER
+
+
+def fill_cache(path, worker):
+    cache = ImageCache(path, max_bytes=1 << 20)
+    for i in range(50):
+        cache.put(f"w{worker}-{i}", bytes([worker]) * (i + 1))
+    cache.close()
+
+
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        self.path = os.path.join(self.tmp_dir.name, "cache.pack")
+
+    def open_cache(self, max_bytes=1024):
+        cache = ImageCache(self.path, max_bytes=max_bytes)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_put_and_get_returns_memoryview(self):
+        cache = self.open_cache()
+        cache.put("id1", b"payload-1")
+        cache.put("id2", b"payload-2")
+        view = cache.get("id1")
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(bytes(view), b"payload-1")
+        self.assertEqual(bytes(cache.get("id2")), b"payload-2")
+        self.assertIsNone(cache.get("missing"))
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["entries"], 2)
+
+    def test_index_is_rebuilt_on_reopen(self):
+        cache = self.open_cache()
+        cache.put("id1", b"a" * 10)
+        cache.put("id2", b"b" * 20)
+        cache.close()
+        reopened = self.open_cache()
+        self.assertEqual(len(reopened), 2)
+        self.assertEqual(bytes(reopened.get("id2")), b"b" * 20)
+
+    def test_torn_tail_is_discarded(self):
+        cache = self.open_cache()
+        cache.put("id1", b"complete")
+        cache.close()
+        with open(self.path, "ab") as f:
+            f.write(RECORD_HEADER.pack(3, 100) + b"id2" + b"partial")
+        reopened = self.open_cache()
+        self.assertEqual(len(reopened), 1)
+        self.assertIsNone(reopened.get("id2"))
+        reopened.put("id3", b"after")
+        self.assertEqual(bytes(reopened.get("id3")), b"after")
+        self.assertEqual(bytes(reopened.get("id1")), b"complete")
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = self.open_cache(max_bytes=30)
+        cache.put("id1", b"1" * 10)
+        cache.put("id2", b"2" * 10)
+        cache.put("id3", b"3" * 10)
+        cache.get("id1")
+        cache.put("id4", b"4" * 10)
+        self.assertIn("id1", cache)
+        self.assertNotIn("id2", cache)
+        self.assertEqual(cache.stats()["evictions"], 1)
+        self.assertLessEqual(cache.stats()["live_bytes"], 30)
+
+    def test_file_is_compacted_when_mostly_dead(self):
+        cache = self.open_cache(max_bytes=40)
+        for i in range(20):
+            cache.put(f"id{i}", bytes([i]) * 10)
+        self.assertLessEqual(os.path.getsize(self.path), 2 * 40 + 4 * (RECORD_HEADER.size + 4))
+        for i in range(16, 20):
+            self.assertEqual(bytes(cache.get(f"id{i}")), bytes([i]) * 10)
+
+    def test_instances_sharing_a_file_do_not_overwrite_each_other(self):
+        a = self.open_cache(max_bytes=1 << 20)
+        b = self.open_cache(max_bytes=1 << 20)
+        a.put("id-aaaa", b"A" * 100)
+        b.put("id-b", b"B" * 10)
+        self.assertEqual(bytes(a.get("id-aaaa")), b"A" * 100)
+        self.assertEqual(bytes(b.get("id-b")), b"B" * 10)
+        # Each instance picks up the other's records on its next write.
+        a.put("id-c", b"C")
+        self.assertEqual(bytes(a.get("id-b")), b"B" * 10)
+
+    def test_compaction_by_another_instance_is_picked_up(self):
+        a = self.open_cache(max_bytes=1 << 20)
+        b = self.open_cache(max_bytes=1 << 20)
+        a.put("id1", b"1" * 10)
+        b.put("id2", b"2" * 10)
+        b.compact()
+        a.put("id3", b"3" * 10)
+        self.assertEqual(bytes(a.get("id2")), b"2" * 10)
+        self.assertEqual(bytes(a.get("id3")), b"3" * 10)
+        self.assertEqual(len(self.open_cache(max_bytes=1 << 20)), 3)
+
+    def test_concurrent_processes_append_whole_records(self):
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=fill_cache, args=(self.path, worker)) for worker in range(1, 5)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+            self.assertEqual(worker.exitcode, 0)
+        cache = self.open_cache(max_bytes=1 << 20)
+        self.assertEqual(len(cache), 200)
+        for worker in range(1, 5):
+            for i in range(50):
+                self.assertEqual(bytes(cache.get(f"w{worker}-{i}")), bytes([worker]) * (i + 1))
+
+    def test_views_survive_compaction(self):
+        cache = self.open_cache(max_bytes=20)
+        cache.put("keep", b"k" * 10)
+        view = cache.get("keep")
+        for i in range(10):
+            cache.put(f"id{i}", b"x" * 10)
+        self.assertEqual(bytes(view), b"k" * 10)
+
+    def test_get_or_load_only_loads_on_miss(self):
+        cache = self.open_cache()
+        calls = []
+        def loader():
+            calls.append(1)
+            return b"from-db"
+        self.assertEqual(cache.get_or_load("id1", loader), b"from-db")
+        self.assertEqual(bytes(cache.get_or_load("id1", loader)), b"from-db")
+        self.assertEqual(len(calls), 1)
+
+    def test_oversized_payload_is_not_cached(self):
+        cache = self.open_cache(max_bytes=4)
+        cache.put("big", b"too large")
+        self.assertNotIn("big", cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import dataclasses
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from image_structure import FrozenImageStructure, ImageBatch, ImageStructure
+
+
+def make_rows():
+    return [
+        ("id1", "a.png", "data_batch_1", "http://url", datetime(2024, 1, 1, 12), b"first", None),
+        ("id2", "b.png", "test_batch", "http://url", datetime(2024, 1, 2, 12), memoryview(b"second!"), None),
+        ("id3", "c.png", "test_batch", "http://url", None, None, None),
+    ]
+
+
+def test_records_have_no_instance_dict():
+    image = ImageStructure(id="1", title="t", batch_name="b", url="u", downloaded_at=datetime(2024, 1, 1))
+    assert not hasattr(image, "__dict__")
+    with pytest.raises(AttributeError):
+        image.extra = 1
+
+
+def test_frozen_record_is_immutable_and_hashable():
+    image = FrozenImageStructure(id="1", title="t", batch_name="b", url="u", downloaded_at=datetime(2024, 1, 1),
+                                 image=b"x")
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        image.title = "other"
+    same = FrozenImageStructure(id="1", title="t", batch_name="b", url="u", downloaded_at=datetime(2024, 1, 1))
+    assert image == same
+    assert len({image, same}) == 1
+
+
+def test_frozen_record_loads_lazily_once():
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return memoryview(b"payload")
+
+    image = FrozenImageStructure(id="1", title="t", batch_name="b", url="u", downloaded_at=None, loader=loader)
+    assert image.image is None
+    assert bytes(image.load_image()) == b"payload"
+    assert bytes(image.load_image()) == b"payload"
+    assert calls == [1]
+    assert image.loader is None
+
+
+def test_image_batch_is_columnar():
+    batch = ImageBatch.from_rows(make_rows())
+    assert len(batch) == 3
+    assert batch.ids.tolist() == ["id1", "id2", "id3"]
+    assert batch.downloaded_at.dtype == np.dtype("datetime64[us]")
+    assert batch.offsets.tolist() == [0, 5, 12, 12]
+    assert batch.buffer == b"firstsecond!"
+    view = batch.payload(1)
+    assert isinstance(view, memoryview)
+    assert view.obj is batch.buffer
+    assert bytes(view) == b"second!"
+
+
+def test_image_batch_items():
+    batch = ImageBatch.from_rows(make_rows())
+    first, second, third = batch
+    assert isinstance(first, FrozenImageStructure)
+    assert first.id == "id1"
+    assert first.downloaded_at == datetime(2024, 1, 1, 12)
+    assert bytes(second.image) == b"second!"
+    assert third.downloaded_at is None
+    assert bytes(third.image) == b""
+    assert batch[-1].id == "id3"
+    with pytest.raises(IndexError):
+        batch[3]
+
+
+def test_image_batch_from_images_loads_payloads():
+    images = [ImageStructure(id="1", title="t", batch_name="b", url="u", downloaded_at=datetime(2024, 1, 1),
+                             loader=lambda: b"lazy")]
+    batch = ImageBatch.from_images(images)
+    assert bytes(batch.payload(0)) == b"lazy"
+
+
+def test_empty_image_batch():
+    batch = ImageBatch.from_rows([])
+    assert len(batch) == 0
+    assert list(batch) == []
@@ -0,0 +1,93 @@
+import json
+import pstats
+import threading
+
+import pytest
+
+from metrics import Metrics, profiled
+
+
+@pytest.fixture
+def registry():
+    registry = Metrics()
+    yield registry
+    registry.configure(json_log=None)
+
+
+def test_timer_accumulates_calls_seconds_and_items(registry):
+    with registry.timer("encode", items=256):
+        pass
+    with registry.timer("encode", items=44):
+        pass
+    registry.count("images_inserted", 3)
+    registry.count("images_inserted")
+    summary = registry.summary()
+    encode = summary["stages"]["encode"]
+    assert encode["calls"] == 2
+    assert encode["items"] == 300
+    assert 0 <= encode["max_seconds"] <= encode["seconds"]
+    assert summary["counters"] == {"images_inserted": 4}
+
+
+def test_timer_records_failed_calls(registry):
+    with pytest.raises(RuntimeError):
+        with registry.timer("download"):
+            raise RuntimeError("boom")
+    assert registry.summary()["stages"]["download"]["calls"] == 1
+
+
+def test_timer_is_thread_safe(registry):
+    def work():
+        for _ in range(1000):
+            registry.observe("db_write", 0.001, items=1)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert registry.summary()["stages"]["db_write"]["items"] == 4000
+
+
+def test_json_log_lines(registry, tmp_path):
+    log_path = tmp_path / "metrics.jsonl"
+    registry.configure(json_log=str(log_path))
+    with registry.timer("unpickle", member="data_batch_1"):
+        pass
+    registry.log_summary()
+    registry.configure(json_log=None)
+    stage, summary = [json.loads(line) for line in log_path.read_text().splitlines()]
+    assert stage["event"] == "stage"
+    assert stage["stage"] == "unpickle"
+    assert stage["member"] == "data_batch_1"
+    assert summary["event"] == "summary"
+    assert summary["stages"]["unpickle"]["calls"] == 1
+
+
+def test_prometheus_text(registry, tmp_path):
+    registry.observe("encode", 1.5, items=10)
+    registry.count("duplicates_skipped", 2)
+    text = registry.render_prometheus()
+    assert '# TYPE cifar_stage_seconds_total counter' in text
+    assert 'cifar_stage_seconds_total{stage="encode"} 1.5' in text
+    assert 'cifar_stage_items_total{stage="encode"} 10' in text
+    assert 'cifar_duplicates_skipped_total 2' in text
+    path = tmp_path / "ingest.prom"
+    registry.write_prometheus(str(path))
+    assert path.read_text() == text
+    assert [p.name for p in tmp_path.iterdir()] == ["ingest.prom"]
+
+
+def test_reset(registry):
+    registry.observe("encode", 1.0)
+    registry.reset()
+    assert registry.summary() == {"stages": {}, "counters": {}}
+
+
+def test_profiled_dumps_stats(tmp_path, capsys):
+    path = tmp_path / "run.prof"
+    with profiled(str(path)):
+        sum(range(1000))
+    assert pstats.Stats(str(path)).total_calls > 0
+    with profiled(None):
+        pass
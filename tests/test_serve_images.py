@@ -0,0 +1,145 @@
+import asyncio
+import io
+import json
+from datetime import datetime
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from PIL import Image
+
+import serve_images
+
+
+def png_bytes():
+    buffer = io.BytesIO()
+    Image.new("RGB", (2, 2)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+PNG = png_bytes()
+IMAGE_ID = "12345678-1234-5678-1234-567812345678"
+
+
+def make_row(image_id, image=PNG, image_path=None):
+    return (image_id, f"image_{image_id}.png", "data_batch_1", "http://example.com",
+            datetime(2024, 1, 1), image, image_path)
+
+
+class FakePool:
+    def __init__(self, rows):
+        self.rows = {row[0]: row for row in rows}
+        self.queries = []
+
+    async def fetch(self, sql, n, probes, batch_name):
+        self.queries.append((sql, (n, probes, batch_name)))
+        rows = [row for row in self.rows.values() if batch_name is None or row[2] == batch_name][:n]
+        if "NULL::bytea" in sql:
+            rows = [row[:5] + (None,) + row[6:] for row in rows]
+        return rows
+
+    async def fetchrow(self, sql, image_id):
+        self.queries.append((sql, (image_id,)))
+        return self.rows.get(str(image_id))
+
+
+def request(pool, method, path, **kwargs):
+    async def go():
+        async with TestClient(TestServer(serve_images.create_app(pool))) as client:
+            response = await client.request(method, path, **kwargs)
+            body = await response.read()
+            return response.status, response.headers, body
+    return asyncio.run(go())
+
+
+def test_numbered_params_follow_given_order():
+    sql = "SELECT %(b)s, %(a)s, %(b)s"
+    assert serve_images.to_numbered_params(sql, ("a", "b")) == "SELECT $2, $1, $2"
+    assert "%(" not in serve_images.SAMPLE_SQL
+    assert "$3::text IS NULL" in serve_images.SAMPLE_SQL
+
+
+def test_image_by_id_is_cacheable():
+    pool = FakePool([make_row(IMAGE_ID)])
+    status, headers, body = request(pool, "GET", f"/images/{IMAGE_ID}")
+    assert status == 200
+    assert body == PNG
+    assert headers["Content-Type"] == "image/png"
+    assert headers["ETag"] == f'"{IMAGE_ID}"'
+    assert "immutable" in headers["Cache-Control"]
+
+
+def test_image_by_id_revalidation_skips_database():
+    pool = FakePool([make_row("1")])
+    status, headers, body = request(pool, "GET", "/images/1", headers={"If-None-Match": 'W/"x", "1"'})
+    assert status == 304
+    assert body == b""
+    assert headers["ETag"] == '"1"'
+    assert pool.queries == []
+
+
+def test_image_by_id_missing():
+    status, _, _ = request(FakePool([]), "GET", f"/images/{IMAGE_ID}")
+    assert status == 404
+
+
+def test_image_by_id_rejects_malformed_id():
+    pool = FakePool([])
+    status, _, _ = request(pool, "GET", "/images/nope")
+    assert status == 404
+    assert pool.queries == []
+
+
+def test_image_by_id_reads_file_layout(tmp_path):
+    path = tmp_path / "payload"
+    path.write_bytes(PNG)
+    pool = FakePool([make_row(IMAGE_ID, image=None, image_path=str(path))])
+    status, _, body = request(pool, "GET", f"/images/{IMAGE_ID}")
+    assert status == 200
+    assert body == PNG
+
+
+def test_random_image_is_not_cached():
+    pool = FakePool([make_row("1"), make_row("2")])
+    status, headers, body = request(pool, "GET", "/images/random")
+    assert status == 200
+    assert body == PNG
+    assert headers["Cache-Control"] == "no-store"
+    assert headers["Content-Location"] == "/images/1"
+    assert pool.queries[0] == (serve_images.SAMPLE_SQL, (1, 33, None))
+
+
+def test_random_image_empty_table():
+    status, _, _ = request(FakePool([]), "GET", "/images/random")
+    assert status == 404
+
+
+def test_random_sample_lists_metadata():
+    pool = FakePool([make_row("1"), make_row("2"), make_row("3")])
+    status, headers, body = request(pool, "GET", "/images/random?n=2&batch=data_batch_1")
+    assert status == 200
+    assert headers["Cache-Control"] == "no-store"
+    assert pool.queries[0] == (serve_images.SAMPLE_METADATA_SQL, (2, 34, "data_batch_1"))
+    listed = json.loads(body)
+    assert [item["href"] for item in listed] == ["/images/1", "/images/2"]
+    assert listed[0]["downloaded_at"] == "2024-01-01T00:00:00"
+
+
+@pytest.mark.parametrize("n", ["0", "abc", "5000"])
+def test_random_sample_rejects_bad_n(n):
+    status, _, _ = request(FakePool([make_row("1")]), "GET", f"/images/random?n={n}")
+    assert status == 400
+
+
+def test_content_type_sniffing():
+    assert serve_images.content_type(b"\xff\xd8\xff\xe0") == "image/jpeg"
+    assert serve_images.content_type(b"RIFF\x00\x00\x00\x00WEBPVP8 ") == "image/webp"
+    assert serve_images.content_type(b"\x00" * 16) == "application/octet-stream"
+
+
+def test_metrics_endpoint():
+    pool = FakePool([make_row(IMAGE_ID)])
+    request(pool, "GET", f"/images/{IMAGE_ID}", headers={"If-None-Match": f'"{IMAGE_ID}"'})
+    status, headers, body = request(pool, "GET", "/metrics")
+    assert status == 200
+    assert headers["Content-Type"].startswith("text/plain")
+    assert b"cifar_serve_not_modified_total" in body
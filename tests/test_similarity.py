@@ -0,0 +1,94 @@
+from unittest.mock import MagicMock
+
+import numpy as np
+import pytest
+
+import download_images
+import similarity
+
+
+def textured_images(count, seed=0):
+    """Random 8x8 colour blocks scaled up to 32x32, in CIFAR's planar row layout."""
+    low = np.random.default_rng(seed).integers(0, 256, (count, 3, 8, 8))
+    return low.repeat(4, axis=2).repeat(4, axis=3).astype(np.uint8).reshape(count, 3072)
+
+
+def write_index(tmp_path, hashes):
+    path = str(tmp_path / "index")
+    np.save(f"{path}.npy", np.asarray(hashes, dtype=np.int64))
+    np.save(f"{path}.ids.npy", np.array([f"id{i}" for i in range(len(hashes))], dtype="U36"))
+    return path
+
+
+def test_perceptual_hash_is_stable_under_noise():
+    pixels = textured_images(20)
+    hashes = download_images.perceptual_hash(pixels)
+    assert hashes.dtype == np.int64
+    assert hashes.shape == (20,)
+    assert np.array_equal(hashes, download_images.perceptual_hash(pixels))
+    noisy = (pixels.astype(np.int16) + np.random.default_rng(1).integers(-3, 4, pixels.shape)).clip(0, 255)
+    near = similarity.hamming_distances(hashes, download_images.perceptual_hash(noisy.astype(np.uint8)))
+    assert np.diagonal(near).max() <= 4
+    off_diagonal = near[~np.eye(20, dtype=bool)]
+    assert np.median(off_diagonal) > 16
+
+
+def test_hamming_distances():
+    distances = similarity.hamming_distances([0, -1], [0, 1, 3, -1])
+    assert distances.tolist() == [[0, 1, 2, 64], [64, 63, 62, 0]]
+
+
+def test_hamming_distances_without_bitwise_count(monkeypatch):
+    rng = np.random.default_rng(1)
+    queries = rng.integers(np.iinfo(np.int64).min, np.iinfo(np.int64).max, 3, dtype=np.int64)
+    hashes = rng.integers(np.iinfo(np.int64).min, np.iinfo(np.int64).max, 40, dtype=np.int64)
+    expected = [[bin((int(q) ^ int(h)) & (2 ** 64 - 1)).count("1") for h in hashes] for q in queries]
+    monkeypatch.delattr(np, "bitwise_count", raising=False)
+    distances = similarity.hamming_distances(queries, hashes)
+    assert distances.dtype == np.uint8
+    assert distances.tolist() == expected
+
+
+def test_search_matches_brute_force(tmp_path, monkeypatch):
+    monkeypatch.setattr(similarity, "SEARCH_CHUNK", 64)
+    rng = np.random.default_rng(0)
+    hashes = rng.integers(np.iinfo(np.int64).min, np.iinfo(np.int64).max, 500, dtype=np.int64)
+    index = similarity.PhashIndex(write_index(tmp_path, hashes))
+    queries = hashes[[3, 250]] ^ np.array([0b101, 0], dtype=np.int64)
+    results = index.search(queries, k=5)
+    brute = similarity.hamming_distances(queries, hashes)
+    for result, row in zip(results, brute):
+        assert [distance for _, distance in result] == sorted(row.tolist())[:5]
+        assert all(row[int(image_id[2:])] == distance for image_id, distance in result)
+    assert results[0][0] == ("id3", 2)
+    assert results[1][0] == ("id250", 0)
+
+
+def test_search_max_distance_and_small_index(tmp_path):
+    index = similarity.PhashIndex(write_index(tmp_path, [0, 1, 0xFF]))
+    assert len(index) == 3
+    assert index.search(0, k=10) == [[("id0", 0), ("id1", 1), ("id2", 8)]]
+    assert index.search(0, k=10, max_distance=1) == [[("id0", 0), ("id1", 1)]]
+    assert index.search(0, k=0) == [[]]
+
+
+def test_similar_to_and_search_pixels(tmp_path):
+    pixels = textured_images(10)
+    index = similarity.PhashIndex(write_index(tmp_path, download_images.perceptual_hash(pixels)))
+    assert index.similar_to("id4", k=1) == [("id4", 0)]
+    assert index.search_pixels(pixels[7], k=1)[0][0] == ("id7", 0)
+    with pytest.raises(KeyError):
+        index.similar_to("missing")
+
+
+def test_build_index_streams_ids_and_hashes(tmp_path):
+    conn = MagicMock()
+    cur = MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cur
+    cur.__iter__.return_value = iter([("a", 5), ("b", -7)])
+    path = str(tmp_path / "index")
+    assert similarity.build_index(conn, path) == 2
+    assert "phash IS NOT NULL" in cur.execute.call_args[0][0]
+    assert conn.cursor.call_args[1]["name"].startswith("phash_index_")
+    assert np.load(f"{path}.npy").tolist() == [5, -7]
+    assert np.load(f"{path}.ids.npy").tolist() == ["a", "b"]